@@ -2,60 +2,82 @@
 #### 'streamlit run streamlit/app.py' in the terminal
 
 ### importing libraries
+import os
+import sys
+import uuid
+from concurrent.futures import CancelledError, TimeoutError as FutureTimeoutError, wait
 import pandas as pd
 import streamlit as st
-from pycaret.regression import *
-from pycaret.regression import  load_model
-import plotly.graph_objects as go
-import plotly.express as px
-import plotly.figure_factory as ff
 import numpy as np
-import matplotlib as plt
 import pickle
-from IPython.display import display, HTML
 
-from scipy.special import inv_boxcox
-from scipy.stats import boxcox
+# The shared transit_cost package lives at the repo root, one level above this script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from transit_cost.boxcox import inv_boxcox
+from transit_cost.calculator import (CURRENCY_CONVERSION_RATES, FEATURE_RANGES_KM, KM_PER_MILE,
+                                     SUB_REGIONS_BY_REGION, convert_ranges_to_miles, format_cost, summary_paragraph)
+from transit_cost import accuracy, cube, densities, explain, explorer, profiling, projectmap
+from transit_cost.mlruns_index import leaderboard, sessions
+from transit_cost.warmup import app_resources, start as start_warmup
+
+# Plotting libraries are imported inside the pages that draw with them, so a cold start
+# (and the calculator page) doesn't pay for plotly/matplotlib.
+
+
+### Profiling
+# Operators can profile a rerun with ?profile=<PROFILE_TOKEN>; the report is drawn at the bottom
+# of the page (of the calculator, for its fragment reruns, which skip this module-level code).
+# `profiling.mark` labels the sections it attributes time to and does nothing otherwise.
+profiler = profiling.SamplingProfiler().start() if profiling.requested(st.query_params) else None
 
 
 ### Importing Data
+profiling.mark('artifact loads')
 @st.cache_data()
 def load_data(file_name):
     with open(file_name, 'rb') as f:
         return pickle.load(f)
 
 df_engineered = load_data('pickles/df_engineered.pkl')
-df_user = load_data('pickles/df_user.pkl')
-df_cleaned = load_data('pickles/df_cleaned.pkl')
 df_streamlit = load_data('pickles/df_streamlit.pkl')
-df_plot_melted = load_data('pickles/df_plot_melted.pkl')
 predictions = load_data('pickles/predictions_user.pkl')
 combined_metrics = load_data('pickles/combined_metrics.pkl')
 importances = load_data('pickles/importances.pkl')
 feature_names = load_data('pickles/feature_names.pkl')
 lambdas_dict = load_data('pickles/lambdas_dict.pkl')
+mlruns_index = load_data('pickles/mlruns_index.pkl')  # built by `python -m transit_cost.mlruns_index`
+project_map = load_data('pickles/project_map.pkl')  # built by `python -m transit_cost.projectmap`
+residual_densities = load_data('pickles/residual_densities.pkl')  # built by `python -m transit_cost.densities`
 
 
-### Importing Model
 @st.cache_resource()
-def get_model():
-    return load_model('models/finalized_user_model')
+def load_cost_cube():
+    # Shared rather than copied per rerun, so the cube's memoized rollups persist
+    return cube.load_cube()
 
-model = get_model()
+cost_cube = load_cost_cube()  # built by `python -m transit_cost.cube`
 
 
-# Custom HTML and CSS for the buttons
-st.markdown("""
-<style>
-    div.stButton > button:first-child {
-        background-color: #00cc00; /* Green */
-        color: white;
-        font-size: 30px;
-        height: 3em;
-        width: 50%;
-        border-radius: 10px 10px 10px 10px;
-    }
-</style>""", unsafe_allow_html=True)
+### Importing Model
+profiling.mark('model & shared resources')
+# The handle resolves the registry's "current" version (or the legacy models/finalized_user_model.pkl
+# when nothing is registered) and only deserializes the model the first time a prediction is made.
+# Promoting a new version swaps it in on the next check, without restarting the app.
+# It, the prediction worker, the what-if curve cache and the scenario store are shared by every
+# session and built once per process by transit_cost.warmup, which also warms them up and serves
+# the /ready probe. Launched with `python -m transit_cost.warmup --serve` that is done before the
+# first visitor arrives; under a plain `streamlit run` it starts with the first session.
+resources = app_resources()
+start_warmup()
+model_handle = resources.model_handle
+segment_metrics = resources.segment_metrics
+
+
+@st.cache_data()
+def load_shap_plot(artifact):
+    # SHAP values saved next to the served version's artifact by transit_cost.explain (or
+    # `pipeline --fit --explain`); pickles/df_plot_melted.pkl for a version without them
+    return explain.plot_frame(artifact)
 
 
 ### Start of streamlit app
@@ -73,6 +95,7 @@ menu = st.sidebar.radio(
 
 
 if menu == 'Introduction':
+    profiling.mark('introduction page')
     st.sidebar.header(" ")
     st.sidebar.header(" ")
     st.sidebar.header(" ")
@@ -204,6 +227,10 @@ if menu == 'Introduction':
     ''')
 
 elif menu == 'The Data & Model':
+    profiling.mark('data page')
+    import plotly.graph_objects as go
+    import plotly.express as px
+
     st.title('The Data & Model')
     st.write('_________')
     st.write('This app uses a machine learning model that was trained on the data provided by The Transit Project. To learn more about the data, please go to their [webpage](https://transitcosts.com/about/).')
@@ -236,32 +263,38 @@ elif menu == 'The Data & Model':
     st.write('____________')
     st.subheader('The Data')
 
-    df_engineered
-
-    fig = px.scatter_geo(df_engineered, 
-                        lat='lat', 
-                        lon='lng', 
-                        color="country",
-                        hover_name="country",
-                        hover_data=['city','length'],
-                        projection="natural earth")
-
-    fig.update_geos(
-        resolution=110,
-        showcoastlines=True, coastlinecolor="Purple",
-        showland=True, landcolor="lightgreen",
-        showocean=True, oceancolor="LightBlue",
-        showlakes=False, lakecolor="Blue",
-        showrivers=False, rivercolor="Blue"
-    )
-    fig.update_layout(
-        plot_bgcolor='rgba(0,0,0,0)',
-        paper_bgcolor='rgba(0,0,0,0)',
-        geo_bgcolor='rgba(0,0,0,0)',
-        showlegend=False
-    )
-    fig.update_layout(margin=dict(t=0, b=0, l=0, r=0))
-    st.plotly_chart(fig,use_container_width=True)
+    # Filtered and paged by SQL on the server; only the visible page is sent to the browser
+    explorer.render(resources.explorer, 'locations', key='explorer-locations')
+
+    # Countries, then a country's cities, then a city's projects: only one level's points are sent
+    map_mode = st.radio('Map', ['By country & city', 'Every project'], horizontal=True, key='project-map-mode')
+    if map_mode == 'By country & city':
+        projectmap.render(project_map, key='project-map')
+    else:
+        fig = px.scatter_geo(df_engineered, 
+                            lat='lat', 
+                            lon='lng', 
+                            color="country",
+                            hover_name="country",
+                            hover_data=['city','length'],
+                            projection="natural earth")
+
+        fig.update_geos(
+            resolution=110,
+            showcoastlines=True, coastlinecolor="Purple",
+            showland=True, landcolor="lightgreen",
+            showocean=True, oceancolor="LightBlue",
+            showlakes=False, lakecolor="Blue",
+            showrivers=False, rivercolor="Blue"
+        )
+        fig.update_layout(
+            plot_bgcolor='rgba(0,0,0,0)',
+            paper_bgcolor='rgba(0,0,0,0)',
+            geo_bgcolor='rgba(0,0,0,0)',
+            showlegend=False
+        )
+        fig.update_layout(margin=dict(t=0, b=0, l=0, r=0))
+        st.plotly_chart(fig,use_container_width=True)
 
     st.write('''
     On the map above, there are a thousand different projects within 54 different countries spanning from 1965 to 2026. Each project is physically unique and required a different level of engineering, diplomacy, coordination, and foresight to make happen. 
@@ -274,12 +307,7 @@ elif menu == 'The Data & Model':
     The dataset, orginally compiled by [The Transit Project](https://transitcosts.com/about/), combines these collective similarities into a structured table that looks like this: 
     
     ''')
-    df_cleaned['start_year'] = df_cleaned['start_year'].astype('str')
-    df_cleaned['end_year'] = df_cleaned['end_year'].astype('str')
-    df_cleaned['start_year'] = df_cleaned['start_year'].str.replace(',', '', regex=False)
-    df_cleaned['end_year'] = df_cleaned['end_year'].str.replace(',', '', regex=False)
-
-    st.dataframe(df_cleaned)
+    explorer.render(resources.explorer, 'projects', key='explorer-projects')
     st.write('''
     The above dataset summarizes the components of a train line on each row. It tells us where and when the project started, when it ended, how long it is and whether the track is above or below us. 
     
@@ -296,11 +324,16 @@ elif menu == 'The Data & Model':
     st.write('At the outset of this analysis I stated that building out a train network is akin to a dance where each party is of a different opinion regarding how to carry out the dance itself. This becomes more apparent when we look at the differences between project cost estimates within each individual country')
 
 ######## Plotting cost per country ########
-    df_engineered = df_engineered[(df_engineered['country']!= 'BY') & (df_engineered['country']!= 'VE') & (df_engineered['country']!= 'AR') & (df_engineered['country']!= 'MY')] 
-    df_engineered = df_engineered[df_engineered['length']<= 50]
-    df_engineered['average_costkm_country'] = df_engineered.groupby('country')['cost_km_2023'].transform('mean')
-    df_engineered['average_cost_country'] = df_engineered.groupby('country')['cost_real_2023'].transform('mean')
-    df_unique_countries = (df_engineered.drop_duplicates(subset='country')).sort_values(by='average_costkm_country', ascending=False)
+    profiling.mark('data page: cost per country (cube rollup + plotly)')
+    # The cost charts leave out these countries' projects and lines over 50 km
+    excluded_countries = ['BY', 'VE', 'AR', 'MY']
+    cube_exclusions = {'country': excluded_countries, 'length_bin': ['>50 km']}
+    df_engineered = df_engineered[~df_engineered['country'].isin(excluded_countries) & (df_engineered['length'] <= 50)]
+    # Rollups come from the precomputed cost cube (transit_cost.cube) instead of grouping the projects
+    df_unique_countries = (cost_cube.rollup(['country'], exclude=cube_exclusions).reset_index()
+                           .rename(columns={'cost_km_2023_mean': 'average_costkm_country',
+                                            'cost_real_2023_mean': 'average_cost_country'})
+                           .sort_values(by='average_costkm_country', ascending=False))
     overall_avg = df_unique_countries['average_costkm_country'].mean()
 
     fig = px.bar(df_unique_countries,
@@ -323,12 +356,14 @@ elif menu == 'The Data & Model':
     st.plotly_chart(fig,use_container_width=True)
 
 ######## END Plotting cost per country ######## 
+    profiling.mark('data page')
 
     st.write('''
     In the above plot, we can see how much transit costs can vary from country to country, but the difference becomes more stark when we look at the differences in construction costs within each country
     ''')
 
 ######## Plotting cost variation country ######## 
+    profiling.mark('data page: cost per km by country (plotly)')
     fig = px.scatter(df_engineered.sort_values(by='country'), 
                     x='country',
                     y='cost_km_2023',
@@ -385,9 +420,9 @@ elif menu == 'The Data & Model':
 
     ######## Plotting cost variation country ######## 
     df_engineered.head(5)
-    avg_cost_by_duration = df_engineered.groupby('duration')['cost_km_2023'].mean().reset_index()
-    count_by_duration = df_engineered.groupby('duration').size().reset_index(name='count')
-    merged_df = avg_cost_by_duration.merge(count_by_duration, on='duration')
+    profiling.mark('data page: cost by duration (cube rollup + plotly)')
+    merged_df = (cost_cube.rollup(['duration'], exclude=cube_exclusions).reset_index()
+                 .rename(columns={'cost_km_2023_mean': 'cost_km_2023'})[['duration', 'cost_km_2023', 'count']])
 
     # Create the bar chart colored by the count
     fig = px.bar(merged_df,
@@ -405,6 +440,7 @@ elif menu == 'The Data & Model':
 
     st.plotly_chart(fig,use_container_width=True)
     ######## END Plotting cost variation country ######## 
+    profiling.mark('data page')
     st.write('''
     This plot however is somewhat inconclusive, potentially because of a lack of data. The majority of projects have a duration under 10 years. Each duration column under 10 years illustrates that as a project takes longer, the project costs more. 
     However after the 10 year mark, outliers (unduly expensive projects) begin to skew the data and there is some variation in project costs.
@@ -433,10 +469,7 @@ elif menu == 'The Data & Model':
     soil type probability for each city in the dataset. This will allow us to visualize if a specific soil type correlates with higher construction costs.
     ''')
     ######## Plotting cost variation country ######## 
-    avg_cost_by_duration = df_engineered.groupby('duration')['cost_km_2023'].mean().reset_index()
-    count_by_duration = df_engineered.groupby('duration').size().reset_index(name='count')
-    merged_df = avg_cost_by_duration.merge(count_by_duration, on='duration')
-
+    profiling.mark('data page: soil type by duration (plotly)')
     fig = px.scatter(df_streamlit,
          x="duration",
          y='cost_km_2023',
@@ -471,6 +504,7 @@ elif menu == 'The Data & Model':
     As you can imagine, it's more difficult to do manual labor when the weather is uncomfortable. In the searing heat you might need to take more frequent breaks and in the freezing cold, you might be bundled up so tight that you don't know where your gloves end and your hand starts. 
     Of course, this is an example of vernacular thinking, but it makes some sense at least in theory. Let's see if the data show that as well.
     ''')
+    profiling.mark('data page: climate (plotly)')
     fig = px.scatter_3d(df_streamlit,
                         x="precipitation_type",
                         y='temperature_category',
@@ -522,7 +556,7 @@ elif menu == 'The Data & Model':
     Within the feature engineering process, I created a number of features that I hoped would help the model more accurately predict the price of a urban railway, but there is some error in that process. 
     Thankfully, in the iterative process of creating a model, there are ways to determine which features work and which features don't. Without going into each details (which are available in the [full analysis](https://github.com/smileshey/TransitCostEstimator)), the final set of features looks like this:    
     ''')
-    df_user
+    explorer.render(resources.explorer, 'model_inputs', key='explorer-model-inputs')
     st.write('''
     Within these features, there are some features we didn't discuss, such as:
     - City & country density (how many people occupy each square km)
@@ -578,6 +612,8 @@ elif menu == 'The Data & Model':
     In contrast, SHAP values provide a detailed decomposition of feature effects, quantifying both magnitude and direction of each feature's contribution for individual predictions.
     ''')
     ##### SHAP plot #####
+    profiling.mark('data page: SHAP (groupby + plotly)')
+    df_plot_melted = load_shap_plot(model_handle.entry()['artifact'])
     df_plot_melted['shap_abs'] = df_plot_melted['SHAP'].abs()
     max_abs_values_by_feature = df_plot_melted.groupby('Feature')['shap_abs'].max().reset_index(name='max_shap_abs')
     df_plot_melted = df_plot_melted.merge(max_abs_values_by_feature, on='Feature')
@@ -625,6 +661,14 @@ elif menu == 'The Data & Model':
     The summary table you see below outlines this process and shows the benefit of this process. 
     ''')
     combined_metrics
+
+    # Every tuning session logged to mlruns/, read from the compacted index
+    experiment_sessions = sessions(mlruns_index)
+    with st.expander(f'All {len(experiment_sessions)} experiment sessions ({len(mlruns_index)} logged runs)'):
+        st.write('Metrics are only comparable within a session: some sessions were scored on the transformed target and others in millions of USD.')
+        st.dataframe(experiment_sessions, hide_index=True, use_container_width=True)
+        selected_session = st.selectbox('Compare the models within a session:', experiment_sessions['Session'])
+        st.dataframe(leaderboard(mlruns_index, session=selected_session), hide_index=True, use_container_width=True)
     st.write('''
     The above table describes the results of each model in the process. From the modelling process, I created two models:
     1. A specialized model intended for professionals, such as engineers, familiar with particular locales.
@@ -635,6 +679,7 @@ elif menu == 'The Data & Model':
     ''')
 
     ##### ERROR BAND PLOT###########
+    profiling.mark('data page: error bands (groupby + plotly)')
     lambda_at_grade = lambdas_dict['at_grade_transformed']
     lambda_elevated = lambdas_dict['elevated_transformed']
     lambda_tunnel = lambdas_dict['tunnel_transformed']
@@ -730,6 +775,7 @@ elif menu == 'The Data & Model':
 
  
     ##### END ERROR BAND PLOT###########
+    profiling.mark('data page')
     st.write('''
     The error band plot above shows how the model's predictions change as the length of the line increases. From the 1700+ datapoints in the dataset, we set aside ~300 datapoints to use as a measuring stick for the model.
     These datapoints are represented in the above plot and show the mean error (blue) as a function of the total length. 
@@ -752,6 +798,11 @@ elif menu == 'The Data & Model':
     ''')
 
 elif menu == 'Evaluating the Model':
+    profiling.mark('evaluation page')
+    import plotly.graph_objects as go
+    import plotly.express as px
+    import matplotlib as plt
+
     st.title('Evaluating the Model')
     st.write('_________')
     st.subheader('What are Predictions?')
@@ -905,40 +956,14 @@ elif menu == 'Evaluating the Model':
     Since 'length' was the most important feature for the model, let's see how it performed on different lengths of track.
     ''')
     #### Predictions from model
-    q1 = predictions['length'].quantile(0.25)
-    q2 = predictions['length'].quantile(0.5)
-    q3 = predictions['length'].quantile(0.75)
-    bins = [0, q1, q2, q3, float('inf')]
-    labels = ["short", "medium", "medium-long", "long"]
-    predictions['length_category'] = pd.cut(predictions['length'], bins=bins, labels=labels, right=False)
-    
-    all_projects = predictions['Standardized_Residuals']
-    short_projects = predictions[predictions['length_category'] == 'short']['Standardized_Residuals']
-    medium_projects = predictions[predictions['length_category'] == 'medium']['Standardized_Residuals']
-    medium_long_projects = predictions[predictions['length_category'] == 'medium-long']['Standardized_Residuals']
-    long_projects = predictions[predictions['length_category'] == 'long']['Standardized_Residuals']
-
+    profiling.mark('evaluation page: residual densities by length')
     # Generate colors from viridis colormap
     colors = plt.cm.viridis(np.linspace(0, 1, 5))
     hex_colors = [plt.colors.rgb2hex(color) for color in colors]
 
-    # Create distplot
-    fig = ff.create_distplot([all_projects, short_projects, medium_projects, medium_long_projects, long_projects], 
-                         group_labels=['All','Short', 'Medium', 'Medium-Long', 'Long'], 
-                         bin_size=.5, 
-                         curve_type='normal',
-                         histnorm='probability density',
-                         show_hist=False)
-
-    # Set colors for density plots
-    for i, trace in enumerate(fig.data[:5]):  # Assuming there are 4 density plots
-        trace['line']['color'] = hex_colors[i]
-
-    # Set colors for rug plots
-    num_density_plots = 5
-    for i, trace in enumerate(fig.data[-5:]):  # Assuming there are 4 rug plots
-        if 'marker' in trace:
-            trace['marker']['color'] = hex_colors[i]
+    # Density curves (binned KDE) and downsampled rugs of the residuals by length quartile,
+    # precomputed by `python -m transit_cost.densities`
+    fig = densities.figure(residual_densities['length'], hex_colors)
 
     # Customize the layout
     fig.update_layout(
@@ -972,38 +997,13 @@ elif menu == 'Evaluating the Model':
     In the previously discussed SHAP plot, we showed that length and tunnel length were the most important features. Let's repeat this for the tunnel length.
     ''')
     ### dist plot for length of tunnel
-    bins = [0, 1, 90, float('inf')]
-    labels = ["no tunnel", "mixed", "subway"]
-    lambda_tunnel = lambdas_dict['tunnel_transformed']
-    predictions['tunnel']= inv_boxcox(predictions['tunnel_transformed'], lambda_tunnel)-1
-    predictions['tunnel_per'] = (predictions['tunnel']/predictions['length'])*100
-    predictions['tunnel_category'] = pd.cut(predictions['tunnel_per'], bins=bins, labels=labels, right=False)
-
-    all_projects = predictions['Standardized_Residuals']
-    no_tunnel_projects = predictions[predictions['tunnel_category'] == 'no tunnel']['Standardized_Residuals']
-    mixed_projects = predictions[predictions['tunnel_category'] == 'mixed']['Standardized_Residuals']
-    subway_projects = predictions[predictions['tunnel_category'] == 'subway']['Standardized_Residuals']
-
+    profiling.mark('evaluation page: residual densities by tunnel share')
     # Generate colors from viridis colormap
     colors = plt.cm.viridis(np.linspace(0, 1, 4))
     hex_colors = [plt.colors.rgb2hex(color) for color in colors]
 
-    # Create distplot with the new categories
-    fig = ff.create_distplot([all_projects,no_tunnel_projects, mixed_projects, subway_projects], 
-                            group_labels=['All','No Tunnel', 'Mixed', 'Subway'], 
-                            bin_size=.5, 
-                            curve_type='normal',
-                            histnorm='probability density',
-                            show_hist=False)
-
-    # Set colors for density plots
-    for i, trace in enumerate(fig.data[:4]):  # Now assuming there are 3 density plots
-        trace['line']['color'] = hex_colors[i]
-
-    # Set colors for rug plots
-    for i, trace in enumerate(fig.data[-4:]):  # Now assuming there are 3 rug plots
-        if 'marker' in trace:
-            trace['marker']['color'] = hex_colors[i]
+    # Groups: no tunnel (<1%), mixed (1-90%) and subway (>90% underground)
+    fig = densities.figure(residual_densities['tunnel'], hex_colors)
 
     # Customize the layout
     fig.update_layout(
@@ -1032,12 +1032,23 @@ elif menu == 'Evaluating the Model':
     Additionally, since the density plots show a relatively normal distribution for the data and its 
     important subsets, this indicates that model is lacking significant Homoscedasticity and the residuals are equally spread across all independent variables (assumption #3).
     ''')
+
+    profiling.mark('evaluation page: segment accuracy')
+    st.subheader('Accuracy by Segment')
+    st.write(f'''
+    Most of these segments only hold a few dozen of the held-out projects, some only a handful, so a single error number for each would be misleading. 
+    The table below gives each segment's error in millions of 2023 USD with a 95% bootstrap confidence interval: the range the metric falls in when the segment's projects are resampled thousands of times. 
+    Wide intervals mean there are too few projects to say much about the model's accuracy for that segment, and segments with fewer than {accuracy.MIN_PROJECTS} projects get no interval at all. The bias is the average of the predicted minus the actual cost.
+    ''')
+    # Computed once per model version by transit_cost.accuracy
+    st.dataframe(accuracy.display_table(segment_metrics.report()), hide_index=True, use_container_width=True)
     st.write('_________')
     st.subheader('Auxillary Features')
     st.write('''
     Since we've shown that the assumptions for a machine learning model were met within this analysis, let's evaluate the auxillary features that weren't discussed above. 
     Features like climate, soil type, and socioeconomic conditions weren't as important to the model as the length components, but they still added value. Let's plot the standardized residuals to show how the model performs with each auxillary feature set.
     ''')
+    profiling.mark('evaluation page: residual plots (plotly)')
     predictions_socio = predictions
 
     fig = px.scatter(
@@ -1099,75 +1110,7 @@ elif menu == 'Evaluating the Model':
 
 
 elif menu == ':sparkles: **:rainbow[Project Cost Calculator]** :sparkles:':
-    ### Existing Features
-    cont_feats = ['end_year','at_grade_transformed','tunnel_transformed',
-              'elevated_transformed', 'duration_transformed','stations_transformed',
-              'tunnel_MRT_interaction','tunnel_asia_interaction','at_grade_MRT_interaction','at_grade_asia_interaction','stations_Streetcar_interaction',
-              'stations_LightRail_interaction', 'stations_MRT_interaction','stations_tunnel_interaction',
-              'stations_atgrade_interaction','stations_elevated_interaction','duration_tunnel_interaction',
-              'duration_atgrade_interaction', 'duration_elevated_interaction',
-              'extension_tunnel_interaction', 'extension_atgrade_interaction','extension_elevated_interaction']
-
-    cat_feats = ['region', 'sub_region', 'train_type', 'soil_type', 'city_size',
-            'country_income_class', 'precipitation_type','elevation_class',
-             'poverty_rate','temperature_category', 'city_density_type','project_type']
-
-    ### Feature categories
-    feature_categories = {'region': ['Africa', 'Americas', 'Asia', 'Europe', 'Oceania'],
-    'sub_region': ['Australia and New Zealand',
-    'Eastern Asia',
-    'Eastern Europe',
-    'Latin America and the Caribbean',
-    'Northern Africa',
-    'Northern America',
-    'Northern Europe',
-    'South-eastern Asia',
-    'Southern Asia',
-    'Southern Europe',
-    'Western Asia',
-    'Western Europe'],
-    'soil_type': ['Clay Dominant',
-    'Cold Climates (Permafrost, Rock Outcrops)',
-    'Environment Dependent (Wetlands, Volcanic Ash, Mineral Rich)',
-    'Fertile/Agricultural (Grasslands, Food Bearing, Pasture)',
-    'High Altitude/Wet (Mountain, Swampy)',
-    'River Valleys/Deltas (River Sediments)',
-    'Saline/Arid (Desert Soils, High Salt Content)'],
-    'city_size': ['Large (5M-15M)',
-    'Medium (1M-5M)',
-    'Metropolis (>15M)',
-    'Small (<1M)'],
-    'train_type': ['Light Rail', 'MRT', 'Monorail/APM', 'Streetcar'],
-    'country_income_class': ['high-income', 'low-income', 'middle-income'],
-    'elevation_class': ['Coastal', 'High-land', 'Mid-land'],
-    'precipitation_type': ['High', 'Low', 'Moderate'],
-    'temperature_category': ['Cold', 'Hot', 'Mild'],
-    'poverty_rate': ['High Poverty', 'Low Poverty', 'Moderate Poverty'],
-    'city_density_type': ['High Density', 'Low Density', 'Medium Density'],
-    'project_type': ['Extension', 'New']}
-
-    #### Sorting Features for better UI
-    # feature_categories['region'].sort()
-    # feature_categories['sub_region'].sort()
-    
-    # gauge_width_order = ['standard', 'non-standard']
-    # feature_categories['gauge_width'] = sorted(feature_categories['gauge_width'], key=lambda x: gauge_width_order.index(x))
-
-    city_size_order = ['Small (<1M)','Medium (1M-5M)','Large (5M-15M)','Metropolis (>15M)']
-    feature_categories['city_size'] = sorted(feature_categories['city_size'], key=lambda x: city_size_order.index(x))
-
-    precipitation_order = ['Low', 'Moderate', 'High', 'Very High']
-    feature_categories['precipitation_type'] = sorted(feature_categories['precipitation_type'], key=lambda x: precipitation_order.index(x))  
-
-    poverty_order = ['High Poverty', 'Moderate Poverty','Low Poverty']
-    feature_categories['poverty_rate'] = sorted(feature_categories['poverty_rate'], key=lambda x: poverty_order.index(x))
-
-    city_density_order = ['High Density', 'Medium Density','Low Density']
-    feature_categories['city_density_type'] = sorted(feature_categories['city_density_type'], key=lambda x: city_density_order.index(x))
-
-    # country_density_order = ['High Density', 'Medium Density','Low Density']
-    # feature_categories['country_density_type'] = sorted(feature_categories['country_density_type'], key=lambda x: country_density_order.index(x))
-
+    profiling.mark('calculator page')
     ### Creating the user interface
     st.header('Generating Your Own Predictions')
     st.write('---------------------------')
@@ -1178,106 +1121,115 @@ elif menu == ':sparkles: **:rainbow[Project Cost Calculator]** :sparkles:':
     predictions['length'] = (inv_boxcox(predictions['at_grade_transformed'], lambda_at_grade) + 
                             inv_boxcox(predictions['elevated_transformed'], lambda_elevated) + 
                             inv_boxcox(predictions['tunnel_transformed'], lambda_tunnel))
-    subset_predictions = predictions[(predictions['length'] >= 0) & (predictions['length'] <= 20)]
-    subset_predictions['absolute_error'] = (subset_predictions['cost_real_2023_transformed'] - subset_predictions['prediction_label']).abs()
-    subset_mae = subset_predictions['absolute_error'].mean()    
-    formatted_subset_mae = "{:.0f}".format(subset_mae)
-
-    # subset_predictions['error'] = subset_predictions['cost_real_2023_transformed'] - subset_predictions['prediction_label']
-    # subset_mean_error = abs(subset_predictions['error']).mean()
-    # formatted_subset_mean_error = "{:.1f}".format(subset_mean_error)
+    predictions['absolute_error'] = (predictions['cost_real_2023_transformed'] - predictions['prediction_label']).abs()
 
     st.write(f'''
     In this section, you can estimate the construction cost for your own project. While not exact, the predictions offer a reasonable approximation. Keep in mind, the model might not fully account for exceptionally unique projects, projects set to take place far into the future, and it does not cover rolling stock or financial costs like loans or interest.
 
-    The model’s Mean Absolute Error (MAE) is ±$470M USD across all lengths. A more precise error adjusted for your project's length will appear beneath the predicted value in the sidebar
+    The model’s Mean Absolute Error (MAE) is ±$470M USD across all lengths. A more precise error adjusted for your project's length will appear beneath the predicted value.
     ''')
     st.write('---------------------------')
-    st.subheader("0. Choose Your Units")
-
-    # continuous features
-    feature_ranges_km = {
-        'length': (.5, 20.0),  # Specify as floats
-        'tunnel': (0.0, 20.0),  # Specify as floats
-        'elevated': (0.0, 20.0),  # Specify as floats
-        'at_grade': (0.0, 20.0),  # Specify as floats
-        'stations': (0.0, 25.0),  # Specify as floats, if you want to allow tenths for stations as well
-        'duration': (1.0, 25.0)  # Specify as floats
-    }
-
-    currency_conversion_rates = {
-        'USD': 1,  # Base rate for conversion, U.S. dollar
-        'EUR': 0.92,  # Euro
-        'JPY': 147.46,  # Japanese yen
-        'GBP': 0.80,  # Pound sterling
-        'AUD': 1.52,  # Australian dollar
-        'CAD': 1.34,  # Canadian dollar
-        'CHF': 0.86,  # Swiss franc
-        'CNY': 7.1,  # Renminbi (Chinese yuan)
-        'HKD': 7.80,  # Hong Kong dollar
-        'NZD': 1.60,  # New Zealand dollar
-        'SEK': 10.40,  # Swedish krona
-        'KRW': 1330.00,  # South Korean won
-        'SGD': 1.35,  # Singapore dollar
-        'NOK': 10.50,  # Norwegian krone
-        'MXN': 19.00,  # Mexican peso
-        'INR': 79.85,  # Indian rupee
-        'RUB': 90.00,  # Russian ruble
-        'ZAR': 18.8,  # South African rand
-        'TRY': 30.37,  # Turkish lira
-        'BRL': 5.00,  # Brazilian real
-    }
-
-    cont_input_values = {}
-    cat_input_values = {}
-
-    def convert_ranges_to_miles(feature_ranges_km):
-        feature_ranges_miles = {}
-        for key, value in feature_ranges_km.items():
-            feature_ranges_miles[key] = (value[0] * 0.621371, value[1] * 0.621371 if key == 'length' else value[1])
-        return feature_ranges_miles
-
-    col1, col2 = st.columns(2)
-
-    # Place unit selection radio button in the first column
-    with col1:
-        unit = st.selectbox("Length Unit:", ('Kilometers', 'Miles'))
-
-    # Place currency selection selectbox in the second column
-    with col2:
-        selected_currency = st.selectbox('Choose the currency for the results:', options=list(currency_conversion_rates.keys()))
-
-
-    # Update feature ranges based on the selected unit
-    feature_ranges = feature_ranges_km if unit == 'Kilometers' else convert_ranges_to_miles(feature_ranges_km)
-    def miles_to_km(value_in_miles):
-        return value_in_miles * 1.60934
-    st.write('---------------------------')
 
-    st.subheader("1. Describe the Type of Railway Being Constructed")
-    # Single column for 'length' slider
-    length_col = st.container()
+    st.sidebar.header(" ")
+    st.sidebar.write(":zap: Your estimate updates as you change the inputs")
+
+    # The calculator is a fragment: changing an input reruns only this function, not the
+    # whole page. Predictions are scored by a shared background worker that debounces
+    # quick successive changes and drops superseded requests; the predicted cost is a
+    # fragment of its own that polls the worker rather than waiting, so the session's next
+    # change can rerun the calculator meanwhile.
+    prediction_worker = resources.prediction_worker
+    # Seconds a fragment rerun (or a full-page run) waits for its prediction before drawing the
+    # last one, and between polls
+    PREDICTION_WAIT = 0.05
+    PREDICTION_TIMEOUT = 30
+    PREDICTION_POLL = 0.1
+    curve_cache = resources.curve_cache
+    scenario_store = resources.scenario_store
+    comparables_index = resources.comparables
+    if 'prediction_session' not in st.session_state:
+        st.session_state.prediction_session = uuid.uuid4().hex
+    # Saved scenarios belong to this browser: its owner id rides along in the URL, so a reload
+    # (or a bookmark) finds them again while other visitors never see them
+    if 'scenario_owner' not in st.session_state:
+        st.session_state.scenario_owner = st.query_params.get('scenarios') or uuid.uuid4().hex
+    st.query_params['scenarios'] = st.session_state.scenario_owner
+
+    def prediction_result():
+        """The predicted cost block, for the request and display settings in session state."""
+        # Reads everything from session state: its polls rerun the function as first declared
+        shown = st.session_state.prediction_display
+        request = st.session_state.prediction_request
+        scoring = False
+        # Each cost comes with the model version that produced it
+        try:
+            prediction = request[1].result(timeout=0)
+            st.session_state.last_prediction = prediction
+        except (FutureTimeoutError, CancelledError):
+            scoring = True
+            prediction = st.session_state.get('last_prediction', (None, None))
+        except Exception as exc:
+            st.error(f'The model could not score these inputs: {exc}')
+            prediction = (None, None)
+        predicted_value, _ = prediction
+        if predicted_value is None:
+            display_value_converted = 'Scoring...'
+        else:
+            display_value_converted = format_cost(predicted_value, shown['currency']) + (' ...' if scoring else '')
+
+        cols = st.columns([1, 2])
+        with cols[0]:
+            st.markdown(f"<div style='text-align: center; font-size: 30px;'>Predicted Cost</div>", unsafe_allow_html=True)
+            st.markdown(f"<div style='text-align: center; font-size: 25px; color: orange;'>{display_value_converted}</div>", unsafe_allow_html=True)
+            st.markdown(f"<div style='text-align: center; font-size: 12px;'>±${shown['mae']}M USD (2023)</div>", unsafe_allow_html=True)
+            st.markdown(f"<div style='text-align: center; font-size: 20px;'> To build this project today</div>", unsafe_allow_html=True)
+        with cols[1]:
+            st.markdown("**Summary of Your Selections:**")
+            st.markdown(shown['summary'], unsafe_allow_html=True)
+
+    @st.fragment
+    def calculator():
+        # Set by the full-page run just before it draws the calculator; fragment reruns skip that code
+        fragment_run = not st.session_state.pop('calculator_full_run', False)
+        fragment_profiler = None
+        if fragment_run and profiling.requested(st.query_params):
+            fragment_profiler = profiling.SamplingProfiler().start('calculator page')
+        # The options, and their order, are the served model's training vocabulary
+        feature_categories = model_handle.schema.categories
+        cont_input_values = {}
+        cat_input_values = {}
+
+        # Filled in once all inputs are read, but shown at the top of the calculator
+        results = st.container()
+
+        st.subheader("0. Choose Your Units")
+        col1, col2 = st.columns(2)
+
+        # Place unit selection radio button in the first column
+        with col1:
+            unit = st.selectbox("Length Unit:", ('Kilometers', 'Miles'))
+
+        # Place currency selection selectbox in the second column
+        with col2:
+            selected_currency = st.selectbox('Choose the currency for the results:', options=list(CURRENCY_CONVERSION_RATES.keys()))
+
+        # Update feature ranges based on the selected unit
+        feature_ranges = FEATURE_RANGES_KM if unit == 'Kilometers' else convert_ranges_to_miles(FEATURE_RANGES_KM)
+        st.write('---------------------------')
 
-    with length_col:
-        if 'length' not in st.session_state:
-            st.session_state.length = max(feature_ranges['length'][0], .5)  # Ensure at least 1 unit to prevent 0, as float
+        st.subheader("1. Describe the Type of Railway Being Constructed")
         # Correct the step type mismatch error by making min_value and max_value floats and allowing for unit selection
         slider_format = "%.1f " + unit
-        st.session_state.length = st.slider('Select Total Length', min_value=float(feature_ranges['length'][0]), max_value=float(feature_ranges['length'][1]), step=0.1, format=slider_format)
+        length = st.slider('Select Total Length', min_value=float(feature_ranges['length'][0]), max_value=float(feature_ranges['length'][1]), step=0.1, format=slider_format)
         # Convert length from miles to kilometers if necessary
-        cont_input_values = {'length': miles_to_km(st.session_state.length) if unit == 'Miles' else st.session_state.length}
+        cont_input_values['length'] = length * KM_PER_MILE if unit == 'Miles' else length
 
-
-    slider_format = "%.1f km" if unit == 'Kilometers' else "%.1f mi"
-    if st.session_state.length > 0.0:
+        slider_format = "%.1f km" if unit == 'Kilometers' else "%.1f mi"
         st.write("Of the Total Length, What Portion of the Track is Underground, At Grade, or Elevated?")
-        st.session_state.length_set = True
-
-    if st.session_state.length_set:
         cols = st.columns(3)
         # Add step=0.1 to all sliders to allow for tenths of a kilometer increments
-        cont_input_values['tunnel'] = cols[0].slider('Underground Track Length', min_value=0.0, max_value=st.session_state.length, step=0.1, format=slider_format)
-        available_length = st.session_state.length - cont_input_values['tunnel']
+        cont_input_values['tunnel'] = cols[0].slider('Underground Track Length', min_value=0.0, max_value=length, step=0.1, format=slider_format)
+        available_length = length - cont_input_values['tunnel']
 
         if available_length > 0:
             cont_input_values['at_grade'] = cols[1].slider('Street Level Track Length', min_value=0.0, max_value=available_length, step=0.1, format=slider_format)
@@ -1289,22 +1241,18 @@ elif menu == ':sparkles: **:rainbow[Project Cost Calculator]** :sparkles:':
             cont_input_values['elevated'] = cols[2].slider('Elevated Track Length', min_value=0.0, max_value=available_length, step=0.1, format=slider_format)
         else:
             cont_input_values['elevated'] = 0
+        # Saved scenarios keep what the track sliders read, together with the unit
+        track_sliders = {'length': length, **{part: cont_input_values[part] for part in ('tunnel', 'at_grade', 'elevated')}}
+        # The track sliders read in the chosen unit; the model, curves and comparables all take km
+        if unit == 'Miles':
+            for part in ('tunnel', 'at_grade', 'elevated'):
+                cont_input_values[part] *= KM_PER_MILE
 
+        cat_input_values['train_type'] = st.radio('What kind of train is it?', options=feature_categories['train_type'], horizontal=True)
 
-        if 'train_type' in feature_categories:
-            cols = st.columns(1)
-            cat_input_values['train_type'] = cols[0].radio('What kind of train is it?', options=feature_categories['train_type'], horizontal=True)
-            del feature_categories['train_type']
-
-        if 'project_type' in feature_categories:
-            project_type_question = 'Is This Project an Extension of an Existing Line?'
-            project_type_options = ['No', 'Yes']
-
-            user_response = st.radio(project_type_question, project_type_options, horizontal=True)
-            project_type_mapping = {'Yes': 'Extension', 'No': 'New'}
-
-            cat_input_values['project_type'] = project_type_mapping[user_response]
-            del feature_categories['project_type']
+        project_type_mapping = {'Yes': 'Extension', 'No': 'New'}
+        user_response = st.radio('Is This Project an Extension of an Existing Line?', ['No', 'Yes'], horizontal=True)
+        cat_input_values['project_type'] = project_type_mapping[user_response]
 
         cols = st.columns(2)
         cont_input_values['duration'] = cols[0].slider('How Long will the Project take to Build?', min_value=1, max_value=25, format="%d Years")
@@ -1313,269 +1261,137 @@ elif menu == ':sparkles: **:rainbow[Project Cost Calculator]** :sparkles:':
         cont_input_values['end_year'] = cont_input_values['start_year'] + cont_input_values['duration']
         st.write('---------------------------')
 
-    st.subheader("2. Describe the Project Area")
-    cols = st.columns(2)
-        
-    # Streamlit dropdown for region selection
-    if 'region' in feature_categories and 'sub_region' in feature_categories and 'city_size' in feature_categories and 'soil_type' in feature_categories:
-            cols = st.columns(2)
-
-            cat_input_values['region'] = cols[0].selectbox('What Region is the Project in?', options=feature_categories['region'])
-            
-            # Define subregion choices based on the selected region
-            if cat_input_values['region'] == 'Asia':
-                sub_region_choices = ['Eastern Asia', 'Central Asia', 'Southern Asia', 'Western Asia', 'South-eastern Asia']
-            elif cat_input_values['region'] == 'Europe':
-                sub_region_choices = ['Southern Europe', 'Western Europe', 'Eastern Europe', 'Northern Europe']
-            elif cat_input_values['region'] == 'Americas':
-                sub_region_choices = ['Northern America', 'Latin America and the Caribbean']
-            elif cat_input_values['region'] == 'Africa':
-                sub_region_choices = ['Northern Africa','Sub-Saharan Africa']
-            elif cat_input_values['region'] == 'Oceania':
-                sub_region_choices = ['Australia and New Zealand']
-            else:
-                sub_region_choices = feature_categories['sub_region']
-
-            cat_input_values['sub_region'] = cols[1].selectbox('What Sub-Region is the Project in?', options=sub_region_choices)
-            cat_input_values['city_size'] = cols[0].selectbox('What\'s the population of the city?', options=feature_categories['city_size'])
-            cat_input_values['soil_type'] = cols[1].selectbox('What kind of soil is this city built on?', options=feature_categories['soil_type'])
-
-            del feature_categories['region']
-            del feature_categories['sub_region']
-            del feature_categories['city_size']
-            del feature_categories['soil_type']
-
-
-    if 'city_density_type' in feature_categories:
-        cols = st.columns(1)
-        cat_input_values['city_density_type'] = cols[0].radio('How Densely Populated is the City?', options=feature_categories['city_density_type'],horizontal = True)
-        del feature_categories['city_density_type']
-    
-    st.write('---------------------------')
+        st.subheader("2. Describe the Project Area")
+        cols = st.columns(2)
+        cat_input_values['region'] = cols[0].selectbox('What Region is the Project in?', options=feature_categories['region'])
+        # Subregion choices depend on the selected region
+        sub_region_choices = SUB_REGIONS_BY_REGION.get(cat_input_values['region'], feature_categories['sub_region'])
+        # ... and are limited to the ones the model saw in training
+        trained_sub_regions = set(feature_categories['sub_region'])
+        sub_region_choices = [choice for choice in sub_region_choices if choice in trained_sub_regions] or sub_region_choices
+        cat_input_values['sub_region'] = cols[1].selectbox('What Sub-Region is the Project in?', options=sub_region_choices)
+        cat_input_values['city_size'] = cols[0].selectbox('What\'s the population of the city?', options=feature_categories['city_size'])
+        cat_input_values['soil_type'] = cols[1].selectbox('What kind of soil is this city built on?', options=feature_categories['soil_type'])
+        cat_input_values['city_density_type'] = st.radio('How Densely Populated is the City?', options=feature_categories['city_density_type'], horizontal=True)
+        st.write('---------------------------')
 
-    if 'precipitation_type' in feature_categories and 'temperature_category' in feature_categories and 'elevation_class' in feature_categories:
         st.subheader("3. Describe the Type of Climate the Project is in")
-        cols = st.columns(1)
-
-        cat_input_values['precipitation_type'] = cols[0].selectbox('How would you describe the precipitation in the region?', options=feature_categories['precipitation_type'])
-        cat_input_values['temperature_category'] = cols[0].radio('How would you describe the climate there?', options=feature_categories['temperature_category'],horizontal = True)
-        cat_input_values['elevation_class'] = cols[0].radio('What\'s the elevation like at the project site?', options=feature_categories['elevation_class'],horizontal = True)
-
-        # Removing them from the dictionary to avoid duplication in the following loop
-        del feature_categories['precipitation_type']
-        del feature_categories['temperature_category']
-        del feature_categories['elevation_class']
-
-
-    st.write('---------------------------')
-    st.subheader("4. Describe the Socioeconomic Conditions of the Project Area")
-
-    if 'country_income_class' in feature_categories and 'poverty_rate' in feature_categories:
-        cat_input_values['poverty_rate'] = st.radio('How much poverty is present in this country?', options=feature_categories['poverty_rate'],horizontal = True)
-        cat_input_values['country_income_class'] = st.radio('How Wealthy is the Country?', options=feature_categories['country_income_class'],horizontal = True)
-
-        del feature_categories['country_income_class']
-        del feature_categories['poverty_rate']
-
-
-    st.write('---------------------------')
-
-    st.markdown("<div style='text-align: left; font-size: 23px;color: orange'>"
-                "👈 Click the 'Make Prediction' button once you are finished"
-                "</div>", unsafe_allow_html=True)
-
-
-    for idx, (feat, options) in enumerate(feature_categories.items()):
-        
-        if idx % 3 == 0:
-            cols = st.columns(3)
-        cat_input_values[feat] = cols[idx % 3].radio(f'Select {feat}', options=options)
-
-    # Start the summary in the sidebar
-    st.sidebar.header("Summary of Your Selections:")
-    input_values = {**cont_input_values, **cat_input_values}
-
-    markdown_lines = []
-
-    # Iterate over the input values and append styled markdown to the list
-    paragraph_keys = ["train_type", "length", "tunnel", "elevated", "at_grade", "duration", "stations", "sub_region", "city_density", "city_size",'elevation_class']
-
-    components = []
-
-    if float(input_values['tunnel']) > 0:
-        components.append(f"<span style='color:orange;'>{round(float(input_values['tunnel']), 1)} km</span> of tunneled track")
-    if float(input_values['elevated']) > 0:
-        components.append(f"<span style='color:orange;'>{round(float(input_values['elevated']), 1)} km</span> of elevated track")
-    if float(input_values['at_grade']) > 0:
-        components.append(f"<span style='color:orange;'>{round(float(input_values['at_grade']), 1)} km</span> of at-grade track")
-
-    # Format the components list with appropriate conjunctions
-    if len(components) == 0:
-        component_str = ' '
-    elif len(components) == 1:
-        component_str = components[0]
-    elif len(components) == 2:
-        component_str = f"{components[0]} and {components[1]}"
-    else:
-        component_str = ', '.join(components[:-1]) + f", and {components[-1]}"
-
-    if input_values['temperature_category'] == 'Very Hot or Extreme Heat':
-        temperature_str = "Very Hot"
-    else:
-        temperature_str = input_values['temperature_category']
-
-    if input_values['project_type'] == 'Extension':
-        project_str = "an Extension of an existing "
-    else:
-        project_str = 'a New '
-
-    # Simplify precipitation type
-    if input_values['precipitation_type'] == 'Arid':
-        precipitation_str = "very little rainfall"
-    elif input_values['precipitation_type'] == 'Semi-Arid':
-        precipitation_str = "little rainfall"
-    elif input_values['precipitation_type'] == 'Very-Arid':
-        precipitation_str = "almost no rainfall"
-    else:
-        # Extracting the first word (like High, Low, Moderate) for other categories
-        precipitation_str = input_values['precipitation_type'].split('-')[0].lower() + " rainfall"
-
-    if input_values['poverty_rate'] == 'Mostly Impoverished':
-        poverty_str = "A lot of poverty"
-    elif input_values['poverty_rate'] == 'Very Impoverished':
-        poverty_str = "Abundant poverty"
-    else:
-        poverty_str = input_values['poverty_rate']
-
-    paragraph = (f"<span style='font-size: 12.5px;'>"
-                f"You selected a <b> <span style='color:orange;'>{project_str}</span></b><b><span style='color:orange;'>{input_values['train_type']} line </span></b> with a track length of "   
-                f"<span style='color:orange;'>{input_values['length']} km</span>, including {component_str}. "
-                f"The project duration is <span style='color:orange;'>{input_values['duration']} Years</span> and "
-                f"<span style='color:orange;'>{input_values['stations']}</span> stations will be built.<br><br> "  # Two line breaks after stations
-                f"The line will be located in a city within  <b><span style='color:orange;'>{input_values['sub_region']}</span></b> that has a population of "
-                f"<b><span style='color:orange;'>{input_values['city_size']}</span></b> and is "
-                f"<b><span style='color:orange;'>{input_values['city_density_type']}</span></b>. "
-                f"This <span style='color:orange;'>{input_values['elevation_class']} </span>city experiences "
-                f"<b><span style='color:orange;'>{precipitation_str}</span></b> and the temperature is often "
-                f"<b><span style='color:orange;'>{temperature_str}</span></b>. The underlying soil is "
-                f"<b><span style='color:orange;'>{input_values['soil_type']}</span></b>.<br><br> "
-                f"The surrounding country is typically <b><span style='color:orange;'>{input_values['country_income_class']}</span> and has <span style='color:orange;'>{input_values['poverty_rate']}</span></b>. "
-                f"</span>")
-
-
-    markdown_lines = [paragraph]
-    # Join the lines with line breaks to form a multi-line markdown string
-    markdown_content = "<br>".join(markdown_lines)
-    
-    # Display the markdown content in the sidebar
-    st.sidebar.markdown(markdown_content, unsafe_allow_html=True)
-
-    ### Creating Logged versions of the user inputted features
-    features_to_transform = ['tunnel', 'at_grade', 'elevated', 'duration', 'stations']
-    for feature in features_to_transform:
-        original_feature_name = feature  # This is the user input feature name
-        transformed_feature_name = f'{feature}_transformed'  # This is the transformed feature name used in your model
-        if original_feature_name in cont_input_values and transformed_feature_name in lambdas_dict:
-            lambda_value = lambdas_dict[transformed_feature_name]
-            # Apply the Box-Cox transformation to the user input
-            cont_input_values[transformed_feature_name] = boxcox(cont_input_values[original_feature_name] + 1, lambda_value)
-            del cont_input_values[original_feature_name]  # Optionally remove the original feature key if not needed anymore
-    
-
-    # for term in interaction_terms:
-    #     cont_input_values[term] = 0
-
-    # cont_input_values['tunnel_MRT_interaction'] = 0
-    # cont_input_values['at_grade_MRT_interaction'] = 0
-    # cont_input_values['tunnel_asia_interaction'] = 0
-    # cont_input_values['at_grade_asia_interaction'] = 0
-
-
-    cont_feats = ['end_year','at_grade_transformed','tunnel_transformed',
-              'elevated_transformed', 'duration_transformed','stations_transformed',
-              'tunnel_MRT_interaction','tunnel_asia_interaction','at_grade_MRT_interaction','at_grade_asia_interaction','stations_Streetcar_interaction',
-              'stations_LightRail_interaction', 'stations_MRT_interaction','stations_tunnel_interaction',
-              'stations_atgrade_interaction','stations_elevated_interaction','duration_tunnel_interaction',
-              'duration_atgrade_interaction', 'duration_elevated_interaction',
-              'extension_tunnel_interaction', 'extension_atgrade_interaction','extension_elevated_interaction']
-
-    interaction_terms = [feat for feat in cont_feats if '_interaction' in feat]
-    for term in interaction_terms:
-        cont_input_values[term] = 0
-   
-   
-    #### Generating values for interaction terms
-    if 'train_type' in cat_input_values and cat_input_values['train_type'] == 'MRT':
-        cont_input_values['tunnel_MRT_interaction'] = cont_input_values.get('tunnel_transformed', 0)
-        cont_input_values['at_grade_MRT_interaction'] = cont_input_values.get('at_grade_transformed', 0)
-        cont_input_values['stations_MRT_interaction'] = cont_input_values.get('stations_transformed', 0)
-
-    if 'train_type' in cat_input_values and cat_input_values['train_type'] == 'Light Rail':
-        cont_input_values['stations_LightRail_interaction'] = cont_input_values.get('stations_transformed', 0)
-    if 'train_type' in cat_input_values and cat_input_values['train_type'] == 'Streetcar':
-            cont_input_values['stations_Streetcar_interaction'] = cont_input_values.get('stations_transformed', 0)
-    if 'train_type' in cat_input_values and cat_input_values['train_type'] == 'Monorail/APM':
-            cont_input_values['stations_Monorail_interaction'] = cont_input_values.get('stations_transformed', 0)
-
-    if 'region' in cat_input_values and cat_input_values['region'] == 'Asia':
-        cont_input_values['tunnel_asia_interaction'] = cont_input_values.get('tunnel_transformed', 0)
-        cont_input_values['at_grade_asia_interaction'] = cont_input_values.get('at_grade_transformed', 0)
-    
-    if 'project_type' in cat_input_values and cat_input_values['project_type'] == 'Extension':
-        cont_input_values['extension_tunnel_interaction'] = cont_input_values.get('tunnel_transformed', 0)
-        cont_input_values['extension_atgrade_interaction'] = cont_input_values.get('at_grade_transformed', 0)
-        cont_input_values['extension_elevated_interaction'] = cont_input_values.get('elevated_transformed', 0)
-
-
-    cont_input_values['duration_tunnel_interaction'] = cont_input_values['duration_transformed'] * cont_input_values['tunnel_transformed']
-    cont_input_values['duration_atgrade_interaction'] = cont_input_values['duration_transformed'] * cont_input_values['at_grade_transformed']
-    cont_input_values['duration_elevated_interaction'] = cont_input_values['duration_transformed'] * cont_input_values['elevated_transformed']
-    
-    ### Predictions Button
-    col1, col2, col3 = st.sidebar.columns([1,2,1])
-    with col2:
-        # Make Predictions
-        if st.button('Make Prediction', key="actualButton", help="Click to make a prediction",type='primary',use_container_width=False):
-            input_values = {**cont_input_values, **cat_input_values}
-            input_values.pop('length', None)
-            model_feature_order = df_user.drop(columns=['cost_real_2023_transformed']).columns
-        
-            data_for_prediction = [input_values[key] for key in model_feature_order]
-            
-            # Convert the list to a DataFrame & make predictions
-            df_for_prediction = pd.DataFrame([data_for_prediction], columns=model_feature_order)
-            prediction = model.predict(df_for_prediction)
-        
-            
-            # Calculate Error for Prediction
-            user_length = st.session_state.length
-            user_length = max(0, min(user_length, 25))
-            subset_predictions = predictions[predictions['length'] <= user_length]
-            subset_predictions['absolute_error'] = (subset_predictions['cost_real_2023_transformed'] - subset_predictions['prediction_label']).abs()
-            subset_mae = subset_predictions['absolute_error'].mean()
-            formatted_subset_mae = "{:.0f}".format(subset_mae)
-
-            # Format the prediction output
-            lambda_prediction = lambdas_dict['cost_real_2023_transformed']
-            predicted_transformed_value = model.predict(df_for_prediction)
-            predicted_value = inv_boxcox(predicted_transformed_value[0], lambda_prediction)
-            conversion_rate = currency_conversion_rates[selected_currency]
-            predicted_value_in_selected_currency = predicted_value * conversion_rate
-
-            # Format the converted prediction for display
-            if predicted_value_in_selected_currency >= 1_000_000:  # Greater than or equal to 1 trillion in the selected currency
-                display_value_converted = f"{predicted_value_in_selected_currency/1_000_000:.2f}T {selected_currency}"
-            elif predicted_value_in_selected_currency >= 1000:  # Greater than or equal to 1 billion but less than 1 trillion in the selected currency
-                display_value_converted = f"{predicted_value_in_selected_currency/1000:.2f}B {selected_currency}"
-            else:  # Less than 1 billion in the selected currency
-                display_value_converted = f"{predicted_value_in_selected_currency:.2f} Million {selected_currency}"
-            # Displaying the prediction and additional information in the sidebar
-            st.sidebar.markdown(f"<div style='text-align: center; font-size: 30px;'>Predicted Cost</div>", unsafe_allow_html=True)
-            st.sidebar.markdown(f"<div style='text-align: center; font-size: 25px; color: orange;'>{display_value_converted}</div>", unsafe_allow_html=True)
-            st.sidebar.markdown(f"<div style='text-align: center; font-size: 12px;'>±${formatted_subset_mae}M USD (2023)</div>", unsafe_allow_html=True)
-            st.sidebar.markdown(f"<div style='text-align: center; font-size: 20px;'>   </div>", unsafe_allow_html=True)
-            st.sidebar.markdown(f"<div style='text-align: center; font-size: 20px;'> To build this project today</div>", unsafe_allow_html=True)
+        cat_input_values['precipitation_type'] = st.selectbox('How would you describe the precipitation in the region?', options=feature_categories['precipitation_type'])
+        cat_input_values['temperature_category'] = st.radio('How would you describe the climate there?', options=feature_categories['temperature_category'], horizontal=True)
+        cat_input_values['elevation_class'] = st.radio('What\'s the elevation like at the project site?', options=feature_categories['elevation_class'], horizontal=True)
+        st.write('---------------------------')
 
+        st.subheader("4. Describe the Socioeconomic Conditions of the Project Area")
+        cat_input_values['poverty_rate'] = st.radio('How much poverty is present in this country?', options=feature_categories['poverty_rate'], horizontal=True)
+        cat_input_values['country_income_class'] = st.radio('How Wealthy is the Country?', options=feature_categories['country_income_class'], horizontal=True)
+
+        input_values = {**cont_input_values, **cat_input_values}
+
+        # Calculate Error for Prediction
+        user_length = max(0, min(cont_input_values['length'], 25))
+        subset_mae = predictions.loc[predictions['length'] <= user_length, 'absolute_error'].mean()
+        formatted_subset_mae = "{:.0f}".format(subset_mae)
+
+        profiling.mark('calculator: waiting for prediction')
+        with results:
+            # A fragment rerun doesn't block on the worker: it waits briefly, then shows the last
+            # result while the result block polls the same request, so the session's next input
+            # can rerun the calculator and supersede the request. Full-page runs have nothing to
+            # supersede and wait longer.
+            request_key = tuple(sorted(input_values.items()))
+            request = st.session_state.get('prediction_request')
+            if request is None or request[0] != request_key or request[1].cancelled():
+                request = (request_key, prediction_worker.submit(st.session_state.prediction_session, input_values))
+                st.session_state.prediction_request = request
+            st.session_state.prediction_display = {
+                'currency': selected_currency,
+                'mae': formatted_subset_mae,
+                'summary': summary_paragraph(input_values),
+            }
+            wait([request[1]], timeout=PREDICTION_WAIT if fragment_run else PREDICTION_TIMEOUT)
+            # The block polls only once a request is still outstanding; Streamlit keeps polling
+            # until the next full-page run, so it's set up at most once per page run
+            poll = None
+            if not request[1].done() and not st.session_state.get('prediction_polling'):
+                st.session_state.prediction_polling = True
+                poll = PREDICTION_POLL
+            st.fragment(prediction_result, run_every=poll)()
+
+            profiling.mark('calculator: what-if curves')
+            ### What-if curves: cost as one input changes, everything else as selected
+            import plotly.graph_objects as go
+
+            conversion_rate = CURRENCY_CONVERSION_RATES[selected_currency]
+            length_scale = 1 / KM_PER_MILE if unit == 'Miles' else 1
+            unit_label = 'km' if unit == 'Kilometers' else 'mi'
+            curves = curve_cache.curves(input_values)
+            curve_settings = {
+                'length': (f'Total Length ({unit_label})', length_scale, length),
+                'tunnel_share': ('Share of the Line Underground (%)', 100,
+                                 100 * cont_input_values['tunnel'] / cont_input_values['length']),
+                'stations': ('Stations', 1, cont_input_values['stations']),
+            }
+            tabs = st.tabs(['Cost vs. Length', 'Cost vs. Tunnel Share', 'Cost vs. Stations'])
+            for tab, (axis, (grid, costs)) in zip(tabs, curves.items()):
+                x_title, x_scale, x_selected = curve_settings[axis]
+                fig = go.Figure()
+                fig.add_trace(go.Scatter(x=grid * x_scale, y=costs * conversion_rate, mode='lines',
+                                         line=dict(color='orange'), name='Predicted Cost'))
+                fig.add_vline(x=x_selected, line_dash='dash', line_color='grey')
+                fig.update_layout(xaxis_title=x_title, yaxis_title=f'Predicted Cost (Millions {selected_currency})',
+                                  height=300, margin=dict(l=0, r=0, t=20, b=0), showlegend=False)
+                tab.plotly_chart(fig, use_container_width=True)
+
+            profiling.mark('calculator: comparable projects')
+            ### Comparable projects: the most similar built lines of the same train type
+            st.markdown("**Comparable Projects:**")
+            comparable = comparables_index.query(input_values)
+            st.dataframe(pd.DataFrame({
+                'City': comparable['city'] + ', ' + comparable['country'],
+                'Line': comparable['line'],
+                'Years': comparable['start_year'].astype(int).astype(str) + '–' + comparable['end_year'].astype(int).astype(str),
+                f'Length ({unit_label})': (comparable['length'] * length_scale).round(1),
+                'Underground (%)': (100 * comparable['tunnel_share']).round(0),
+                'Stations': comparable['stations'],
+                f'Cost per {unit_label} (Millions {selected_currency})': (comparable['cost_km_2023'] / length_scale * conversion_rate).round(1),
+                f'Total Cost (Millions {selected_currency})': (comparable['cost_real_2023'] * conversion_rate).round(0),
+            }), hide_index=True, use_container_width=True)
+            st.caption('Actual costs (2023 dollars) of the built projects most like yours: same train type, '
+                       'then similar length, track mix, station spacing, sub-region and climate.')
+            st.write('---------------------------')
+
+        profiling.mark('calculator: saved scenarios')
+        st.subheader("5. Save & Compare Scenarios")
+        cols = st.columns([3, 1])
+        scenario_name = cols[0].text_input('Scenario Name', placeholder='e.g. Downtown tunnel, 8 stations')
+        cols[1].write('')
+        if cols[1].button('Save Scenario', disabled=not scenario_name):
+            # Saved with the prediction of these inputs, waiting for it if it's still being scored
+            try:
+                predicted_value, predicted_version = request[1].result(timeout=PREDICTION_TIMEOUT)
+            except Exception as exc:
+                st.error(f'{scenario_name} could not be scored: {exc}')
+            else:
+                scenario_store.save(st.session_state.scenario_owner, scenario_name, {**input_values, **track_sliders},
+                                    unit, selected_currency, predicted_value, predicted_version)
+                st.toast(f'Saved {scenario_name}')
+        saved_names = scenario_store.names(st.session_state.scenario_owner)
+        if saved_names:
+            chosen = st.multiselect('Compare Saved Scenarios', options=saved_names, default=saved_names[:2])
+            if chosen:
+                # Only stored predictions are read here; new model versions re-score in the background
+                table = scenario_store.compare(st.session_state.scenario_owner, chosen, model_handle.version)
+                table.loc['cost'] = [format_cost(cost, selected_currency) if pd.notna(cost) else 'scoring...'
+                                     for cost in table.loc['cost']]
+                st.dataframe(table.astype(str), use_container_width=True)
+
+        if fragment_profiler is not None:
+            profiling.render(fragment_profiler.stop())
+
+    # A full-page run starts over with no polling set up (Streamlit drops it on full runs)
+    st.session_state.calculator_full_run = True
+    st.session_state.prediction_polling = False
+    calculator()
 
         ### END CODE
 
@@ -1586,4 +1402,9 @@ elif menu == ':sparkles: **:rainbow[Project Cost Calculator]** :sparkles:':
             # - XXX Maybe highlight the model name in yellow to show to click there
             # - global average line on bar plot 2nd section not labelled
             # - summary of model results includes many user models results
-        ####
\ No newline at end of file
+        ####
+
+
+### Profile of this rerun (operators only, see above)
+if profiler is not None:
+    profiling.render(profiler.stop())
@@ -0,0 +1,5 @@
+"""Shared code for the Transit Cost Estimator app and model pipeline.
+
+Modules in this package are kept free of pycaret, IPython and plotting imports
+so the app can load them on a cold start without paying for those stacks.
+"""
@@ -0,0 +1,207 @@
+### Bootstrap confidence intervals of the model's held-out accuracy per segment.
+# The evaluation page breaks the residuals down by track length, tunnel share, region, train
+# type and soil type, but most of those segments hold a few dozen held-out projects or fewer,
+# where a point MAE or R2 says little. `segment_report` gives every segment its MAE, RMSE, R2
+# and bias (mean of predicted - actual), in millions of 2023 USD, with percentile bootstrap
+# intervals. Each segment is resampled within itself, and the resamples of all the segments
+# are drawn at once as one index matrix (resamples x the segments' rows laid end to end), so
+# each metric is a few NumPy reductions over it (np.add.reduceat per segment) instead of a
+# loop over resamples and segments. Segments with fewer than MIN_PROJECTS projects get no
+# interval (a 2-project segment resamples to a handful of distinct values and its "interval"
+# collapses onto the point), and neither does a metric that is undefined in too many
+# resamples (R2 of a resample drawing one project over and over).
+#
+# SegmentMetrics scores the held-out rows (pickles/data_user_unseen.pkl) with the model
+# version being served and keeps its report until another version is promoted.
+#
+#   python -m transit_cost.accuracy                        # report for the 'current' model
+#   python -m transit_cost.accuracy --resamples 10000      # ... with more resamples
+#   python -m transit_cost.accuracy --benchmark            # time the bootstrap alone
+import argparse
+import pickle
+import threading
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from transit_cost.boxcox import inv_boxcox
+from transit_cost.densities import categories
+from transit_cost.features import TARGET
+from transit_cost.inference import predict_transformed
+from transit_cost.paths import PICKLES_DIR
+
+HELD_OUT_PATH = PICKLES_DIR / 'data_user_unseen.pkl'
+METRICS = ['MAE', 'RMSE', 'R2', 'Bias']
+RESAMPLES = 2000
+CONFIDENCE = 0.95
+# Smallest segment, and share of resamples in which a metric is defined, that get an interval
+MIN_PROJECTS = 10
+MIN_VALID = 0.9
+# Segment name: column of `segment_columns`
+SEGMENTS = {'Length': 'length_category', 'Tunnel': 'tunnel_category', 'Region': 'region',
+            'Train type': 'train_type', 'Soil type': 'soil_type'}
+
+
+def _metrics(actual, predicted, starts, sizes, owner):
+    """{metric: (resamples x segments)} for segments laid end to end along the last axis."""
+    total = lambda values: np.add.reduceat(values, starts, axis=-1)
+    error = predicted - actual
+    squared = total(error ** 2)
+    # Spread around each segment's own mean, not a difference of sums of squares
+    spread = total((actual - (total(actual) / sizes)[..., owner]) ** 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r2 = np.where(spread > 0, 1 - squared / spread, np.nan)
+    return {'MAE': total(np.abs(error)) / sizes, 'RMSE': np.sqrt(squared / sizes), 'R2': r2,
+            'Bias': total(error) / sizes}
+
+
+def bootstrap(actual, predicted, segments, resamples=RESAMPLES, confidence=CONFIDENCE, random_state=786,
+              min_projects=MIN_PROJECTS, min_valid=MIN_VALID):
+    """Point values and percentile intervals of METRICS for each segment (an array of row positions).
+
+    Returns {metric: (point (segments,), low (segments,), high (segments,))}; segments may overlap.
+    The bounds are NaN for segments smaller than `min_projects`, and for metrics defined in
+    less than `min_valid` of a segment's resamples.
+    """
+    actual, predicted = np.asarray(actual, dtype=float), np.asarray(predicted, dtype=float)
+    sizes = np.array([len(rows) for rows in segments])
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    owner = np.repeat(np.arange(len(segments)), sizes)
+    members = np.concatenate(segments)
+    # Every resample of every segment in one matrix: column c draws from its own segment's rows
+    rng = np.random.default_rng(random_state)
+    draws = starts[owner] + (rng.random((resamples, len(members))) * sizes[owner]).astype(np.intp)
+    rows = members[draws]
+    resampled = _metrics(actual[rows], predicted[rows], starts, sizes, owner)
+    point = _metrics(actual[members], predicted[members], starts, sizes, owner)
+    tail = (1 - confidence) / 2
+    intervals = {}
+    for metric in METRICS:
+        valid = np.isfinite(resampled[metric])
+        with warnings.catch_warnings():
+            # All-NaN columns (R2 of a one-project segment) just give NaN bounds
+            warnings.simplefilter('ignore', RuntimeWarning)
+            low, high = np.nanquantile(resampled[metric], [tail, 1 - tail], axis=0)
+        reliable = (sizes >= min_projects) & (valid.mean(axis=0) >= min_valid)
+        intervals[metric] = (point[metric], np.where(reliable, low, np.nan), np.where(reliable, high, np.nan))
+    return intervals
+
+
+def segment_columns(predictions, lambdas):
+    """The columns the held-out predictions are segmented by, with the page's group labels."""
+    _, length_category, tunnel_category = categories(predictions, lambdas)
+    frame = predictions[['region', 'train_type', 'soil_type']].copy()
+    frame['length_category'] = length_category.cat.rename_categories(str.title)
+    frame['tunnel_category'] = tunnel_category.cat.rename_categories(str.title)
+    return frame
+
+
+def segment_report(predictions, lambdas, resamples=RESAMPLES, confidence=CONFIDENCE, random_state=786):
+    """Bootstrap intervals of METRICS (millions of 2023 USD) for every segment of held-out predictions.
+
+    `predictions` are the held-out rows with `prediction_label` (Box-Cox space of the target).
+    One row per (segment, group), 'All' first: the group's project count, then each metric
+    with its `_low` and `_high` bounds.
+    """
+    lambda_target = lambdas[TARGET]
+    actual = inv_boxcox(predictions[TARGET].to_numpy(dtype=float), lambda_target)
+    predicted = inv_boxcox(predictions['prediction_label'].to_numpy(dtype=float), lambda_target)
+    columns = segment_columns(predictions, lambdas)
+    keys, segments = [('All', 'All')], [np.arange(len(predictions))]
+    for segment, column in SEGMENTS.items():
+        values = pd.Categorical(columns[column])
+        for group in values.categories:
+            rows = np.flatnonzero(values == group)
+            if len(rows):
+                keys.append((segment, str(group)))
+                segments.append(rows)
+    intervals = bootstrap(actual, predicted, segments, resamples, confidence, random_state)
+    report = pd.DataFrame({'projects': [len(rows) for rows in segments]},
+                          index=pd.MultiIndex.from_tuples(keys, names=['segment', 'group']))
+    for metric, (point, low, high) in intervals.items():
+        report[metric], report[f'{metric}_low'], report[f'{metric}_high'] = point, low, high
+    return report
+
+
+def display_table(report, min_projects=MIN_PROJECTS):
+    """The report as the evaluation page shows it: each metric as 'value (low to high)'.
+
+    Metrics without an interval read 'value (n too small)' below `min_projects`, and just
+    'value' otherwise.
+    """
+    table = pd.DataFrame({'Segment': report.index.get_level_values('segment'),
+                          'Group': report.index.get_level_values('group'),
+                          'Projects': report['projects'].to_numpy()})
+    formats = {'MAE': ('MAE ($M)', '{:,.0f}'), 'RMSE': ('RMSE ($M)', '{:,.0f}'), 'R2': ('R²', '{:.2f}'),
+               'Bias': ('Bias ($M)', '{:+,.0f}')}
+
+    def cell(fmt, projects, point, low, high):
+        value = fmt.format(point) if np.isfinite(point) else '–'
+        if np.isfinite(low):
+            return f'{value} ({fmt.format(low)} to {fmt.format(high)})'
+        return f'{value} (n too small)' if projects < min_projects else value
+
+    for metric, (label, fmt) in formats.items():
+        table[label] = [cell(fmt, *values)
+                        for values in report[['projects', metric, f'{metric}_low', f'{metric}_high']].to_numpy()]
+    return table
+
+
+def held_out_predictions(model, feature_order, path=HELD_OUT_PATH):
+    """The held-out rows with `prediction_label` from `model`."""
+    with open(path, 'rb') as f:
+        held_out = pickle.load(f)
+    return held_out.assign(prediction_label=predict_transformed(model, held_out[list(feature_order)]))
+
+
+class SegmentMetrics:
+    """`segment_report` of the held-out rows for the model version being served, once per version."""
+
+    def __init__(self, model_handle, resamples=RESAMPLES, confidence=CONFIDENCE):
+        self.model_handle = model_handle
+        self.resamples = resamples
+        self.confidence = confidence
+        self._reports = {}
+        self._lock = threading.Lock()
+        model_handle.on_swap(lambda old_version, new_version: self._reports.pop(old_version, None))
+
+    def report(self):
+        entry, model, _ = self.model_handle.served()
+        with self._lock:
+            if entry['version'] not in self._reports:
+                predictions = held_out_predictions(model, entry['feature_order'])
+                self._reports[entry['version']] = segment_report(predictions, entry['lambdas'],
+                                                                 self.resamples, self.confidence)
+            return self._reports[entry['version']]
+
+
+def main():
+    from transit_cost.registry import ModelHandle
+
+    parser = argparse.ArgumentParser(description='Bootstrap intervals of the held-out accuracy per segment.')
+    parser.add_argument('--resamples', type=int, default=RESAMPLES)
+    parser.add_argument('--confidence', type=float, default=CONFIDENCE)
+    parser.add_argument('--benchmark', action='store_true', help='time the bootstrap on pickles/predictions_user.pkl')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        with open(PICKLES_DIR / 'predictions_user.pkl', 'rb') as f:
+            predictions = pickle.load(f)
+        with open(PICKLES_DIR / 'lambdas_dict.pkl', 'rb') as f:
+            lambdas = pickle.load(f)
+        start = time.perf_counter()
+        report = segment_report(predictions, lambdas, args.resamples, args.confidence)
+        print(f'{args.resamples:,} resamples of {len(report)} segments in {time.perf_counter() - start:.2f}s')
+        return
+    handle = ModelHandle()
+    metrics = SegmentMetrics(handle, args.resamples, args.confidence)
+    start = time.perf_counter()
+    report = metrics.report()
+    print(f'model {handle.version}, {args.resamples:,} resamples in {time.perf_counter() - start:.2f}s')
+    print(display_table(report).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
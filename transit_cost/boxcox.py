@@ -0,0 +1,17 @@
+### Box-Cox transforms with a fixed lambda.
+# The lambdas are fitted once in the notebooks (pickles/lambdas_dict.pkl), so the app
+# only ever needs the closed-form transforms. Doing them with numpy keeps scipy out of
+# the inference path. Same formulas as scipy.special.boxcox / inv_boxcox.
+import numpy as np
+
+
+def boxcox(x, lmbda):
+    if lmbda == 0:
+        return np.log(x)
+    return np.expm1(lmbda * np.log(x)) / lmbda
+
+
+def inv_boxcox(y, lmbda):
+    if lmbda == 0:
+        return np.exp(y)
+    return np.exp(np.log1p(lmbda * y) / lmbda)
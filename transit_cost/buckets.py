@@ -0,0 +1,81 @@
+### Categorical buckets of the city attributes used by the user model.
+# Notebook 10 derived these with a row-wise `apply` per feature, each call inverting the
+# Box-Cox transform and walking an if-chain. Here every bucket is data: the raw column, the
+# edges, the labels and which side of an edge is closed. `bucket` evaluates one over a whole
+# column with np.digitize, for training (transit_cost.pipeline) and batch scoring
+# (transit_cost.schema).
+#
+# Most notebook functions compared inv_boxcox(<col>_transformed) to the edges. The columns
+# were transformed as boxcox(x + 1), so that is the raw value plus one; `offset` keeps that
+# so the buckets match the ones the model was trained on.
+import numpy as np
+import pandas as pd
+
+BUCKET_SPECS = {
+    'city_size': {
+        'column': 'calculated_population', 'offset': 1, 'right': False,
+        'edges': [1_000_000, 5_000_000, 15_000_000],
+        'labels': ['Small (<1M)', 'Medium (1M-5M)', 'Large (5M-15M)', 'Metropolis (>15M)'],
+    },
+    'country_income_class': {
+        'column': 'reporting_gdp', 'offset': 1, 'right': True,
+        'edges': [8017.431435, 35812.343790],
+        'labels': ['low-income', 'middle-income', 'high-income'],
+    },
+    'elevation_class': {
+        'column': 'elevation', 'offset': 1, 'right': True,
+        'edges': [20, 500],
+        'labels': ['Coastal', 'Mid-land', 'High-land'],
+    },
+    'precipitation_type': {
+        'column': 'prcp', 'offset': 1, 'right': False,
+        'edges': [50, 150, 250],
+        'labels': ['Low', 'Moderate', 'High', 'Very High'],
+    },
+    'temperature_category': {
+        'column': 'tavg', 'offset': 0, 'right': False,
+        'edges': [12, 25],
+        'labels': ['Cold', 'Mild', 'Hot'],
+    },
+    'poverty_rate': {
+        'column': 'per_below_line', 'offset': 1, 'right': True,
+        'edges': [10, 30],
+        'labels': ['Low Poverty', 'Moderate Poverty', 'High Poverty'],
+    },
+    'city_density_type': {
+        'column': 'city_density', 'offset': 1, 'right': True,
+        'edges': [1500, 10000],
+        'labels': ['Low Density', 'Medium Density', 'High Density'],
+    },
+}
+
+# WRB reference soil groups, simplified to the classes the user model uses
+SOIL_GROUPS = {
+    'Organic (Bogs & Peats)': ['Histosols'],
+    'Human-altered (Urban, Cut/Fill, Artifacts)': ['Anthrosols', 'Technosols'],
+    'Cold Climates (Permafrost, Rock Outcrops)': ['Cryosols', 'Leptosols'],
+    'Environment Dependent (Wetlands, Volcanic Ash, Mineral Rich)': ['Andosols', 'Podzols', 'Plinthosols', 'Ferralsols', 'Gleysols'],
+    'High Altitude/Wet (Mountain, Swampy)': ['Stagnosols', 'Nitisols', 'Regosols'],
+    'Fertile/Agricultural (Grasslands, Food Bearing, Pasture)': ['Chernozems', 'Kastanozems', 'Phaeozems', 'Umbrisols', 'Cambisols'],
+    'Saline/Arid (Desert Soils, High Salt Content)': ['Arenosols', 'Durisols', 'Gypsisols', 'Calcisols', 'Planosols', 'Solonchaks', 'Solonetzs'],
+    'Clay Dominant': ['Retisols', 'Acrisols', 'Lixisols', 'Alisols', 'Luvisols', 'Albeluvisols', 'Vertisols'],
+    'River Valleys/Deltas (River Sediments)': ['Fluvisols'],
+}
+OTHER_SOIL = 'Others'
+
+
+def bucket(values, spec):
+    """Categorical of `spec`'s labels for raw `values`; missing values stay missing."""
+    values = np.asarray(values, dtype=float)
+    codes = np.digitize(values + spec['offset'], spec['edges'], right=spec['right'])
+    codes[np.isnan(values)] = -1
+    return pd.Categorical.from_codes(codes, categories=spec['labels'])
+
+
+def soil_type(wrb_class_values, class_names, groups=SOIL_GROUPS):
+    """Simplified soil class for WRB class values; `class_names` maps value -> WRB group name."""
+    simplified = {name: group for group, names in groups.items() for name in names}
+    lookup = {value: simplified.get(name, OTHER_SOIL) for value, name in dict(class_names).items()}
+    values = pd.Series(wrb_class_values)
+    return pd.Categorical(values.map(lookup).fillna(OTHER_SOIL).to_numpy(),
+                          categories=[*groups, OTHER_SOIL])
@@ -0,0 +1,107 @@
+### Static content of the Project Cost Calculator page.
+# Built once at import instead of on every rerun of the page.
+
+#### Sub-regions offered for each region (the categorical options come from the served model's schema)
+SUB_REGIONS_BY_REGION = {
+    'Asia': ['Eastern Asia', 'Central Asia', 'Southern Asia', 'Western Asia', 'South-eastern Asia'],
+    'Europe': ['Southern Europe', 'Western Europe', 'Eastern Europe', 'Northern Europe'],
+    'Americas': ['Northern America', 'Latin America and the Caribbean'],
+    'Africa': ['Northern Africa', 'Sub-Saharan Africa'],
+    'Oceania': ['Australia and New Zealand'],
+}
+
+#### Continuous inputs
+FEATURE_RANGES_KM = {
+    'length': (.5, 20.0),
+    'tunnel': (0.0, 20.0),
+    'elevated': (0.0, 20.0),
+    'at_grade': (0.0, 20.0),
+    'stations': (0.0, 25.0),
+    'duration': (1.0, 25.0),
+}
+
+KM_PER_MILE = 1.60934
+
+CURRENCY_CONVERSION_RATES = {
+    'USD': 1,  # Base rate for conversion, U.S. dollar
+    'EUR': 0.92,  # Euro
+    'JPY': 147.46,  # Japanese yen
+    'GBP': 0.80,  # Pound sterling
+    'AUD': 1.52,  # Australian dollar
+    'CAD': 1.34,  # Canadian dollar
+    'CHF': 0.86,  # Swiss franc
+    'CNY': 7.1,  # Renminbi (Chinese yuan)
+    'HKD': 7.80,  # Hong Kong dollar
+    'NZD': 1.60,  # New Zealand dollar
+    'SEK': 10.40,  # Swedish krona
+    'KRW': 1330.00,  # South Korean won
+    'SGD': 1.35,  # Singapore dollar
+    'NOK': 10.50,  # Norwegian krone
+    'MXN': 19.00,  # Mexican peso
+    'INR': 79.85,  # Indian rupee
+    'RUB': 90.00,  # Russian ruble
+    'ZAR': 18.8,  # South African rand
+    'TRY': 30.37,  # Turkish lira
+    'BRL': 5.00,  # Brazilian real
+}
+
+
+def convert_ranges_to_miles(feature_ranges_km):
+    feature_ranges_miles = {}
+    for key, value in feature_ranges_km.items():
+        feature_ranges_miles[key] = (value[0] * 0.621371, value[1] * 0.621371 if key == 'length' else value[1])
+    return feature_ranges_miles
+
+
+def format_cost(predicted_value, selected_currency):
+    """Predicted cost (millions of USD) as a display string in the selected currency."""
+    converted = predicted_value * CURRENCY_CONVERSION_RATES[selected_currency]
+    if converted >= 1_000_000:  # Greater than or equal to 1 trillion in the selected currency
+        return f"{converted/1_000_000:.2f}T {selected_currency}"
+    elif converted >= 1000:  # Greater than or equal to 1 billion but less than 1 trillion in the selected currency
+        return f"{converted/1000:.2f}B {selected_currency}"
+    return f"{converted:.2f} Million {selected_currency}"
+
+
+def summary_paragraph(input_values):
+    """HTML narrative describing the user's selections."""
+    components = []
+    if float(input_values['tunnel']) > 0:
+        components.append(f"<span style='color:orange;'>{round(float(input_values['tunnel']), 1)} km</span> of tunneled track")
+    if float(input_values['elevated']) > 0:
+        components.append(f"<span style='color:orange;'>{round(float(input_values['elevated']), 1)} km</span> of elevated track")
+    if float(input_values['at_grade']) > 0:
+        components.append(f"<span style='color:orange;'>{round(float(input_values['at_grade']), 1)} km</span> of at-grade track")
+
+    # Format the components list with appropriate conjunctions
+    if len(components) == 0:
+        component_str = ' '
+    elif len(components) == 1:
+        component_str = components[0]
+    elif len(components) == 2:
+        component_str = f"{components[0]} and {components[1]}"
+    else:
+        component_str = ', '.join(components[:-1]) + f", and {components[-1]}"
+
+    if input_values['project_type'] == 'Extension':
+        project_str = "an Extension of an existing "
+    else:
+        project_str = 'a New '
+
+    # Extracting the first word (like High, Low, Moderate)
+    precipitation_str = input_values['precipitation_type'].split('-')[0].lower() + " rainfall"
+
+    return (f"<span style='font-size: 12.5px;'>"
+            f"You selected a <b> <span style='color:orange;'>{project_str}</span></b><b><span style='color:orange;'>{input_values['train_type']} line </span></b> with a track length of "
+            f"<span style='color:orange;'>{input_values['length']} km</span>, including {component_str}. "
+            f"The project duration is <span style='color:orange;'>{input_values['duration']} Years</span> and "
+            f"<span style='color:orange;'>{input_values['stations']}</span> stations will be built.<br><br> "
+            f"The line will be located in a city within  <b><span style='color:orange;'>{input_values['sub_region']}</span></b> that has a population of "
+            f"<b><span style='color:orange;'>{input_values['city_size']}</span></b> and is "
+            f"<b><span style='color:orange;'>{input_values['city_density_type']}</span></b>. "
+            f"This <span style='color:orange;'>{input_values['elevation_class']} </span>city experiences "
+            f"<b><span style='color:orange;'>{precipitation_str}</span></b> and the temperature is often "
+            f"<b><span style='color:orange;'>{input_values['temperature_category']}</span></b>. The underlying soil is "
+            f"<b><span style='color:orange;'>{input_values['soil_type']}</span></b>.<br><br> "
+            f"The surrounding country is typically <b><span style='color:orange;'>{input_values['country_income_class']}</span> and has <span style='color:orange;'>{input_values['poverty_rate']}</span></b>. "
+            f"</span>")
@@ -0,0 +1,224 @@
+### Comparable historical projects for an estimate.
+# Every project of the dataset (pickles/df.pkl, with line names from costs.csv) is encoded once
+# into a vector: standardized log length, tunnel/elevated/at-grade shares of the track,
+# stations per km and start year, plus one-hot sub-region and climate buckets, each scaled by
+# its weight in FEATURE_WEIGHTS. The vectors are partitioned by train type, so comparables
+# always share the scenario's train type, and saved as pickles/comparables_index.pkl.
+#
+# A query is a brute-force nearest-neighbour search in NumPy: one matrix product against the
+# train type's vectors and an argpartition, which stays in the low milliseconds at 100k
+# projects (see --benchmark). `query_batch` answers a whole frame of scenarios at once.
+#
+#   python -m transit_cost.comparables                        # build pickles/comparables_index.pkl
+#   python -m transit_cost.comparables scenarios.csv --k 5    # comparables of each scenario in a CSV
+#   python -m transit_cost.comparables --benchmark 100000     # query latency at 100k projects
+import argparse
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+
+from transit_cost.buckets import BUCKET_SPECS, bucket
+from transit_cost.paths import PICKLES_DIR
+
+INDEX_PATH = PICKLES_DIR / 'comparables_index.pkl'
+K = 5
+NUMERIC = ['log_length', 'tunnel_share', 'elevated_share', 'at_grade_share', 'stations_per_km', 'start_year']
+CATEGORICAL = ['sub_region', 'precipitation_type', 'temperature_category']
+# How much a standard deviation of a numeric feature, or a mismatched category, counts
+FEATURE_WEIGHTS = {'log_length': 1.0, 'tunnel_share': 1.5, 'elevated_share': 1.0, 'at_grade_share': 1.0,
+                   'stations_per_km': 1.0, 'start_year': 0.5,
+                   'sub_region': 1.5, 'precipitation_type': 0.75, 'temperature_category': 0.75}
+DISPLAY_COLUMNS = ['country', 'city', 'line', 'start_year', 'end_year', 'length', 'tunnel_share', 'stations',
+                   'cost_km_2023', 'cost_real_2023']
+# Scenarios scored per matrix product in query_batch
+BATCH_ROWS = 1024
+
+
+def features(raw):
+    """{feature: array} of the index's raw features for projects or calculator scenarios.
+
+    `raw` is a frame or a mapping of columns to arrays. Shares are of the track that is given
+    (tunnel + elevated + at grade), so they don't depend on the length unit; stations per km
+    uses `length`, in km. Plain arrays rather than a frame: a single query is mostly overhead.
+    """
+    column = lambda name: np.asarray(raw[name], dtype=float)
+    tunnel, elevated, at_grade, length = column('tunnel'), column('elevated'), column('at_grade'), column('length')
+    total = tunnel + elevated + at_grade
+    total = np.where(total > 0, total, np.nan)
+    frame = {
+        'log_length': np.log1p(length),
+        'tunnel_share': np.nan_to_num(tunnel / total),
+        'elevated_share': np.nan_to_num(elevated / total),
+        # No breakdown given: counted as at grade
+        'at_grade_share': np.nan_to_num(at_grade / total, nan=1.0),
+        'stations_per_km': column('stations') / np.where(length > 0, length, np.nan),
+        'start_year': column('start_year'),
+    }
+    for name in [*CATEGORICAL, 'train_type']:
+        frame[name] = np.asarray(raw[name], dtype=object)
+    return frame
+
+
+class ComparablesIndex:
+    """Weighted, standardized project vectors partitioned by train type."""
+
+    def __init__(self, projects, mean, std, vocabulary):
+        self.projects = projects.reset_index(drop=True)
+        self.mean = mean
+        self.std = std
+        self.vocabulary = vocabulary
+        self._display = self.projects[DISPLAY_COLUMNS]
+        vectors = self.encode(features(self.projects))
+        self.partitions = {}
+        for train_type, rows in self.projects.groupby('train_type').indices.items():
+            block = np.ascontiguousarray(vectors[rows])
+            self.partitions[train_type] = (rows, block, np.einsum('ij,ij->i', block, block))
+
+    @classmethod
+    def build(cls, projects):
+        frame = pd.DataFrame(features(projects), index=projects.index)
+        keep = frame[NUMERIC].notna().all(axis=1) & frame['train_type'].notna()
+        projects, frame = projects[keep], frame[keep]
+        vocabulary = {name: sorted(frame[name].dropna().unique().tolist()) for name in CATEGORICAL}
+        return cls(projects, frame[NUMERIC].mean().to_dict(), frame[NUMERIC].std().replace(0, 1).to_dict(), vocabulary)
+
+    def encode(self, frame):
+        """float32 vectors of `features` rows; unknown categories match nothing."""
+        blocks = [((frame[name] - self.mean[name]) / self.std[name] * FEATURE_WEIGHTS[name])[:, None]
+                  for name in NUMERIC]
+        for name in CATEGORICAL:
+            # Two mismatched one-hots differ in two places, so each carries weight / sqrt(2)
+            values = frame[name]
+            blocks.append(np.stack([values == category for category in self.vocabulary[name]], axis=1)
+                          * (FEATURE_WEIGHTS[name] / np.sqrt(2)))
+        return np.nan_to_num(np.hstack(blocks)).astype(np.float32)
+
+    def _partition(self, train_type):
+        if train_type in self.partitions:
+            return self.partitions[train_type]
+        # A train type without projects: compare against all of them
+        rows = np.arange(len(self.projects))
+        block = np.ascontiguousarray(np.vstack([self.partitions[name][1] for name in self.partitions])
+                                     [np.argsort(np.concatenate([self.partitions[name][0] for name in self.partitions]))])
+        return rows, block, np.einsum('ij,ij->i', block, block)
+
+    def _nearest(self, vectors, train_type, k):
+        rows, block, norms = self._partition(train_type)
+        k = min(k, len(rows))
+        # Squared distance without the query's own norm, which doesn't change the order
+        distances = norms[None, :] - 2 * vectors @ block.T
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        order = np.take_along_axis(distances, nearest, axis=1).argsort(axis=1)
+        nearest = np.take_along_axis(nearest, order, axis=1)
+        squared = np.take_along_axis(distances, nearest, axis=1) + np.einsum('ij,ij->i', vectors, vectors)[:, None]
+        return rows[nearest], np.sqrt(np.maximum(squared, 0))
+
+    def _found(self, positions, rows, distances):
+        found = self._display.iloc[rows.ravel()].reset_index(drop=True)
+        found.insert(0, 'scenario', np.repeat(positions, rows.shape[1]))
+        found['distance'] = distances.ravel()
+        return found
+
+    def query_batch(self, raw, k=K):
+        """The `k` nearest projects of every scenario in `raw`, nearest first.
+
+        One row per (scenario, comparable): `scenario` is the scenario's position in `raw`,
+        then DISPLAY_COLUMNS and `distance`.
+        """
+        frame = features(raw)
+        vectors = self.encode(frame)
+        train_types = pd.Series(frame['train_type'])
+        results = []
+        for train_type, positions in train_types.groupby(train_types, dropna=False).indices.items():
+            for start in range(0, len(positions), BATCH_ROWS):
+                chunk = positions[start:start + BATCH_ROWS]
+                results.append(self._found(chunk, *self._nearest(vectors[chunk], train_type, k)))
+        if not results:
+            return pd.DataFrame(columns=['scenario', *DISPLAY_COLUMNS, 'distance'])
+        return pd.concat(results, ignore_index=True).sort_values(['scenario', 'distance'], ignore_index=True)
+
+    def query(self, inputs, k=K):
+        """The `k` projects most like one calculator scenario (a mapping of inputs), nearest first."""
+        frame = features({name: [value] for name, value in inputs.items()})
+        rows, distances = self._nearest(self.encode(frame), inputs['train_type'], k)
+        return self._found(np.zeros(1, dtype=int), rows, distances).drop(columns='scenario')
+
+    def state(self):
+        return {'projects': self.projects, 'mean': self.mean, 'std': self.std, 'vocabulary': self.vocabulary}
+
+
+def load_index(path=INDEX_PATH):
+    with open(path, 'rb') as f:
+        return ComparablesIndex(**pickle.load(f))
+
+
+def save_index(index, path=INDEX_PATH):
+    # Saved as plain data; the vectors are re-encoded on load
+    with open(path, 'wb') as f:
+        pickle.dump(index.state(), f)
+
+
+def dataset_projects():
+    """Projects of pickles/df.pkl with their line names and climate buckets."""
+    from transit_cost.pipeline import Pipeline
+
+    with open(PICKLES_DIR / 'df.pkl', 'rb') as f:
+        projects = pickle.load(f)
+    cleaned = Pipeline().run(['cleaned'])[0]['cleaned']
+    key = ['country', 'city', 'start_year', 'end_year', 'length']
+    lines = cleaned[key + ['line']].assign(length=cleaned['length'].astype(float).round(3)).drop_duplicates(key)
+    projects = (projects.assign(length_key=projects['length'].astype(float).round(3))
+                .merge(lines.rename(columns={'length': 'length_key'}), on=[*key[:-1], 'length_key'], how='left')
+                .drop(columns='length_key'))
+    for name in ['precipitation_type', 'temperature_category']:
+        projects[name] = np.asarray(bucket(projects[BUCKET_SPECS[name]['column']], BUCKET_SPECS[name]), dtype=object)
+    projects['tunnel_share'] = features(projects)['tunnel_share'].round(3)
+    return projects
+
+
+def benchmark(index, n_projects, queries=200, random_state=786):
+    """Median single-scenario query time (ms) against `n_projects` resampled, jittered projects."""
+    rng = np.random.default_rng(random_state)
+    projects = index.projects.iloc[rng.integers(len(index.projects), size=n_projects)].reset_index(drop=True)
+    for column in ['length', 'tunnel', 'elevated', 'at_grade', 'stations']:
+        projects[column] = projects[column].astype(float) * rng.lognormal(0, 0.2, size=n_projects)
+    large = ComparablesIndex(projects, index.mean, index.std, index.vocabulary)
+    scenarios = index.projects.iloc[rng.integers(len(index.projects), size=queries)]
+    times = []
+    for _, scenario in scenarios.iterrows():
+        start = time.perf_counter()
+        large.query(scenario.to_dict())
+        times.append(time.perf_counter() - start)
+    return 1000 * np.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or query the index of comparable projects.')
+    parser.add_argument('scenarios', nargs='?', help='CSV of scenarios to find comparables for (calculator inputs)')
+    parser.add_argument('--k', type=int, default=K)
+    parser.add_argument('--out', help='write the comparables to this CSV instead of printing them')
+    parser.add_argument('--benchmark', type=int, metavar='N', help='time queries against N projects')
+    args = parser.parse_args()
+
+    if args.scenarios is None and args.benchmark is None:
+        index = ComparablesIndex.build(dataset_projects())
+        save_index(index)
+        print(f'{len(index.projects)} projects indexed -> {INDEX_PATH}')
+        return
+    index = load_index()
+    if args.benchmark:
+        print(f'{benchmark(index, args.benchmark):.2f} ms per query at {args.benchmark:,} projects')
+        return
+    start = time.perf_counter()
+    found = index.query_batch(pd.read_csv(args.scenarios), args.k)
+    print(f'{found["scenario"].nunique()} scenarios in {1000 * (time.perf_counter() - start):.1f} ms')
+    if args.out:
+        found.to_csv(args.out, index=False)
+    else:
+        print(found.to_string(float_format='{:.2f}'.format))
+
+
+if __name__ == '__main__':
+    main()
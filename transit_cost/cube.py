@@ -0,0 +1,215 @@
+### Materialized aggregate cube of project costs for the Data page's rollup charts.
+# Projects are aggregated once into cells of country x sub_region x train_type x length bin x
+# decade x duration. Each cell holds the project count and, for every measure, its sum, sum of
+# squares and a quantile sketch (log-spaced buckets with SKETCH_ACCURACY relative error, which
+# merge by adding counts). Any rollup (mean, std, quantiles of a measure over a subset of the
+# dimensions, with filters) is then a group-by over the cells instead of the projects, and
+# adding projects only adds cells. Rollups are memoized on the cube until it changes.
+#
+# df_engineered has no train type or region, so they are joined from pickles/df.pkl, whose rows
+# are the same projects in the same order.
+#
+#   python -m transit_cost.cube                                       # rebuild pickles/cost_cube.pkl
+#   python -m transit_cost.cube --add new_projects.pkl                # add projects to the saved cube
+#   python -m transit_cost.cube --by train_type --where sub_region='Western Europe'
+import argparse
+import math
+import pickle
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from transit_cost.paths import PICKLES_DIR
+
+CUBE_PATH = PICKLES_DIR / 'cost_cube.pkl'
+DIMENSIONS = ['country', 'sub_region', 'train_type', 'length_bin', 'decade', 'duration']
+MEASURES = ['cost_km_2023', 'cost_real_2023', 'length']
+LENGTH_EDGES = [0, 5, 10, 20, 30, 50, float('inf')]
+LENGTH_LABELS = ['<=5 km', '5-10 km', '10-20 km', '20-30 km', '30-50 km', '>50 km']
+SKETCH_ACCURACY = 0.01
+_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+# Values at or below this share the sketch's lowest bucket
+_SKETCH_FLOOR = 1e-6
+
+
+def with_dimensions(rows):
+    """Projects with the derived dimensions (length bin, decade) added."""
+    rows = rows.copy()
+    rows['length_bin'] = pd.cut(rows['length'], LENGTH_EDGES, labels=LENGTH_LABELS, include_lowest=True).astype(str)
+    rows['decade'] = rows['start_year'] // 10 * 10
+    return rows
+
+
+def project_rows(engineered, enriched):
+    """Projects with the cube's dimensions, from df_engineered and the matching rows of df."""
+    return with_dimensions(engineered.join(enriched[['train_type', 'region', 'sub_region', 'start_year']]))
+
+
+def _sketch_key(value):
+    return math.ceil(math.log(max(value, _SKETCH_FLOOR), _GAMMA))
+
+
+def _sketch_value(key):
+    return 2 * _GAMMA ** key / (_GAMMA + 1)
+
+
+def _sketch(values):
+    return Counter(_sketch_key(value) for value in values if not np.isnan(value))
+
+
+def _merge(sketches):
+    merged = Counter()
+    for sketch in sketches:
+        merged.update(sketch)
+    return merged
+
+
+def sketch_quantile(sketch, q):
+    """Estimated `q` quantile of the values in a sketch (within SKETCH_ACCURACY)."""
+    total = sum(sketch.values())
+    if not total:
+        return np.nan
+    rank = q * (total - 1)
+    seen = 0
+    for key in sorted(sketch):
+        seen += sketch[key]
+        if seen > rank:
+            return _sketch_value(key)
+    return _sketch_value(max(sketch))
+
+
+def cells(rows):
+    """Cube cells of project rows: one per combination of DIMENSIONS present."""
+    grouped = rows.groupby(DIMENSIONS, dropna=False, sort=False)
+    frame = grouped.size().rename('count').to_frame()
+    for measure in MEASURES:
+        frame[f'{measure}_sum'] = grouped[measure].sum()
+        frame[f'{measure}_sumsq'] = grouped[measure].apply(lambda values: float(np.sum(np.square(values))))
+        # Iterated rather than aggregated: pandas would expand the dicts into rows
+        frame[f'{measure}_sketch'] = [_sketch(values.to_numpy(dtype=float)) for _, values in grouped[measure]]
+    return frame
+
+
+def _combine(frame):
+    # Cells with the same coordinates (e.g. old and newly added) summed, sketches merged
+    grouped = frame.groupby(level=list(range(frame.index.nlevels)), dropna=False, sort=False)
+    numeric = grouped[[column for column in frame.columns if not column.endswith('_sketch')]].sum()
+    for measure in MEASURES:
+        numeric[f'{measure}_sketch'] = [_merge(sketches) for _, sketches in grouped[f'{measure}_sketch']]
+    return numeric
+
+
+class Cube:
+    """Aggregate cells of projects; `rollup` and `quantile` answer chart queries from them."""
+
+    def __init__(self, cells):
+        self.cells = cells
+        self._memo = {}
+
+    @classmethod
+    def from_rows(cls, rows):
+        return cls(cells(rows))
+
+    def add(self, rows):
+        """Add projects (rows with the DIMENSIONS columns and MEASURES)."""
+        self.cells = _combine(pd.concat([self.cells, cells(rows)]))
+        self._memo.clear()
+
+    @property
+    def projects(self):
+        return int(self.cells['count'].sum())
+
+    def _select(self, where, exclude):
+        index = self.cells.index
+        keep = np.ones(len(index), dtype=bool)
+        for dimension, values in (where or {}).items():
+            keep &= index.get_level_values(dimension).isin(list(values))
+        for dimension, values in (exclude or {}).items():
+            keep &= ~index.get_level_values(dimension).isin(list(values))
+        return self.cells[keep]
+
+    @staticmethod
+    def _key(*args):
+        return repr([sorted((name, sorted(map(str, values))) for name, values in (arg or {}).items())
+                     if isinstance(arg, dict) else arg for arg in args])
+
+    def rollup(self, by, where=None, exclude=None):
+        """count and each measure's sum/mean/std per combination of the `by` dimensions.
+
+        `where` keeps cells whose dimensions take the given values, `exclude` drops them.
+        """
+        key = self._key('rollup', list(by), where, exclude)
+        if key not in self._memo:
+            selected = self._select(where, exclude)
+            numeric = [column for column in selected.columns if not column.endswith('_sketch')]
+            frame = selected[numeric].groupby(level=list(by), sort=True).sum()
+            count = frame['count']
+            for measure in MEASURES:
+                total, squares = frame[f'{measure}_sum'], frame[f'{measure}_sumsq']
+                frame[f'{measure}_mean'] = total / count
+                frame[f'{measure}_std'] = np.sqrt(((squares - total ** 2 / count) / (count - 1)).clip(lower=0))
+            self._memo[key] = frame.drop(columns=[f'{measure}_sumsq' for measure in MEASURES])
+        return self._memo[key]
+
+    def quantile(self, by, measure, q, where=None, exclude=None):
+        """Estimated `q` quantile of `measure` per combination of the `by` dimensions."""
+        key = self._key('quantile', list(by), measure, q, where, exclude)
+        if key not in self._memo:
+            selected = self._select(where, exclude)
+            grouped = selected[f'{measure}_sketch'].groupby(level=list(by), sort=True)
+            values = {name: sketch_quantile(_merge(sketches), q) for name, sketches in grouped}
+            self._memo[key] = pd.Series(values, name=f'{measure}_q{q:g}').rename_axis(list(by))
+        return self._memo[key]
+
+
+def load_cube(path=CUBE_PATH):
+    with open(path, 'rb') as f:
+        return Cube(pickle.load(f))
+
+
+def save_cube(cube, path=CUBE_PATH):
+    # Only the cells (a plain frame) are saved; the memo is rebuilt on demand
+    with open(path, 'wb') as f:
+        pickle.dump(cube.cells, f)
+
+
+def build_cube():
+    with open(PICKLES_DIR / 'df_engineered.pkl', 'rb') as f:
+        engineered = pickle.load(f)
+    with open(PICKLES_DIR / 'df.pkl', 'rb') as f:
+        enriched = pickle.load(f)
+    return Cube.from_rows(project_rows(engineered, enriched))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or query the aggregate cost cube.')
+    parser.add_argument('--add', metavar='PATH', help='pickle or CSV of new projects to add to the saved cube')
+    parser.add_argument('--by', nargs='+', help='print a rollup by these dimensions')
+    parser.add_argument('--where', action='append', default=[], metavar='DIMENSION=VALUE',
+                        help='with --by, keep cells where a dimension has this value (repeatable)')
+    args = parser.parse_args()
+
+    if args.by:
+        cube = load_cube()
+        where = {}
+        for condition in args.where:
+            dimension, value = condition.split('=', 1)
+            where.setdefault(dimension, []).append(int(value) if dimension in ('decade', 'duration') else value)
+        rollup = cube.rollup(args.by, where)
+        rollup['cost_km_2023_median'] = cube.quantile(args.by, 'cost_km_2023', 0.5, where)
+        columns = ['count', 'cost_km_2023_mean', 'cost_km_2023_median', 'cost_km_2023_std', 'cost_real_2023_mean']
+        print(rollup[columns].to_string(float_format='{:.1f}'.format))
+        return
+    if args.add:
+        cube = load_cube()
+        rows = pd.read_csv(args.add) if args.add.endswith('.csv') else pd.read_pickle(args.add)
+        cube.add(with_dimensions(rows))
+    else:
+        cube = build_cube()
+    save_cube(cube)
+    print(f'{cube.projects} projects in {len(cube.cells)} cells -> {CUBE_PATH}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+### Residual density curves of the "Evaluating the Model" page, precomputed.
+# The page used to call ff.create_distplot on every rerun, which fits each group in Python and
+# draws one rug marker per held-out prediction for every group. Here each group's standardized
+# residuals are reduced once, when the artifacts are built, to
+#   - a Gaussian kernel density (Scott's bandwidth, as scipy's gaussian_kde), computed by
+#     linearly binning the residuals onto a grid and convolving with the kernel by FFT:
+#     O(n + m log m) for n residuals on m grid points, instead of O(n m)
+#   - a rug of at most MAX_RUG residuals, taken at evenly spaced ranks so it keeps the
+#     distribution's shape
+# saved to pickles/residual_densities.pkl. `figure` lays them out the way create_distplot does.
+#
+#   python -m transit_cost.densities    # rebuild pickles/residual_densities.pkl from predictions_user.pkl
+import argparse
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from transit_cost.boxcox import inv_boxcox
+from transit_cost.paths import PICKLES_DIR
+
+DENSITIES_PATH = PICKLES_DIR / 'residual_densities.pkl'
+GRID_POINTS = 512
+MAX_RUG = 200
+# Grid margin beyond the data, in bandwidths, so the curves reach ~0 at both ends
+GRID_MARGIN = 3
+
+
+def scott_bandwidth(values):
+    return np.std(values, ddof=1) * len(values) ** (-1 / 5)
+
+
+def binned_kde(values, grid_points=GRID_POINTS, bandwidth=None):
+    """(grid, density) of a Gaussian KDE of `values`, by linear binning and FFT convolution."""
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    h = scott_bandwidth(values) if bandwidth is None else bandwidth
+    grid = np.linspace(values.min() - GRID_MARGIN * h, values.max() + GRID_MARGIN * h, grid_points)
+    dx = grid[1] - grid[0]
+    # Linear binning: each value splits its weight between the two nearest grid points
+    position = (values - grid[0]) / dx
+    left = np.clip(np.floor(position).astype(int), 0, grid_points - 2)
+    right_share = position - left
+    counts = np.bincount(left, 1 - right_share, minlength=grid_points) + np.bincount(left + 1, right_share, minlength=grid_points)
+    # Kernel on the grid's spacing, out to 4 bandwidths (or the whole grid)
+    reach = min(grid_points - 1, int(np.ceil(4 * h / dx)))
+    offsets = np.arange(-reach, reach + 1) * dx
+    kernel = np.exp(-0.5 * (offsets / h) ** 2) / (h * np.sqrt(2 * np.pi))
+    size = 1 << int(np.ceil(np.log2(grid_points + len(kernel) - 1)))
+    smoothed = np.fft.irfft(np.fft.rfft(counts, size) * np.fft.rfft(kernel, size), size)
+    density = smoothed[reach:reach + grid_points] / len(values)
+    return grid, np.maximum(density, 0)
+
+
+def rug(values, max_points=MAX_RUG):
+    """At most `max_points` of `values`, at evenly spaced ranks (all of them if there are fewer)."""
+    values = np.sort(np.asarray(values, dtype=float))
+    if len(values) <= max_points:
+        return values
+    return values[np.round(np.linspace(0, len(values) - 1, max_points)).astype(int)]
+
+
+def categories(predictions, lambdas):
+    """(length, length category, tunnel category) of each prediction, as the page groups them."""
+    length = (inv_boxcox(predictions['at_grade_transformed'], lambdas['at_grade_transformed']) +
+              inv_boxcox(predictions['elevated_transformed'], lambdas['elevated_transformed']) +
+              inv_boxcox(predictions['tunnel_transformed'], lambdas['tunnel_transformed']))
+    q1, q2, q3 = length.quantile([0.25, 0.5, 0.75])
+    length_category = pd.cut(length, bins=[0, q1, q2, q3, float('inf')],
+                             labels=['short', 'medium', 'medium-long', 'long'], right=False)
+    tunnel = inv_boxcox(predictions['tunnel_transformed'], lambdas['tunnel_transformed']) - 1
+    tunnel_category = pd.cut(tunnel / length * 100, bins=[0, 1, 90, float('inf')],
+                             labels=['no tunnel', 'mixed', 'subway'], right=False)
+    return length, length_category, tunnel_category
+
+
+def residual_groups(predictions, lambdas):
+    """{'length': {label: residuals}, 'tunnel': {label: residuals}} of the page's density plots."""
+    residuals = predictions['cost_real_2023_transformed'] - predictions['prediction_label']
+    standardized = (residuals - np.mean(residuals)) / np.std(residuals)
+    _, length_category, tunnel_category = categories(predictions, lambdas)
+    return {
+        'length': {'All': standardized, 'Short': standardized[length_category == 'short'],
+                   'Medium': standardized[length_category == 'medium'],
+                   'Medium-Long': standardized[length_category == 'medium-long'],
+                   'Long': standardized[length_category == 'long']},
+        'tunnel': {'All': standardized, 'No Tunnel': standardized[tunnel_category == 'no tunnel'],
+                   'Mixed': standardized[tunnel_category == 'mixed'],
+                   'Subway': standardized[tunnel_category == 'subway']},
+    }
+
+
+def build_densities(predictions, lambdas, grid_points=GRID_POINTS, max_rug=MAX_RUG):
+    """{plot: {group label: {'x', 'density', 'rug', 'n'}}} for every group of `residual_groups`."""
+    densities = {}
+    for plot, groups in residual_groups(predictions, lambdas).items():
+        densities[plot] = {}
+        for label, values in groups.items():
+            grid, density = binned_kde(values.to_numpy(dtype=float), grid_points)
+            densities[plot][label] = {'x': grid, 'density': density, 'rug': rug(values, max_rug), 'n': len(values)}
+    return densities
+
+
+def build(path=DENSITIES_PATH):
+    with open(PICKLES_DIR / 'predictions_user.pkl', 'rb') as f:
+        predictions = pickle.load(f)
+    with open(PICKLES_DIR / 'lambdas_dict.pkl', 'rb') as f:
+        lambdas = pickle.load(f)
+    densities = build_densities(predictions, lambdas)
+    with open(path, 'wb') as f:
+        pickle.dump(densities, f)
+    return densities
+
+
+def figure(groups, colors):
+    """Density curves over rug plots, laid out like ff.create_distplot(show_hist=False)."""
+    import plotly.graph_objects as go
+
+    fig = go.Figure()
+    for (label, group), color in zip(groups.items(), colors):
+        fig.add_trace(go.Scatter(x=group['x'], y=group['density'], mode='lines', name=label, legendgroup=label,
+                                 line=dict(color=color), xaxis='x1', yaxis='y1'))
+    for (label, group), color in zip(groups.items(), colors):
+        fig.add_trace(go.Scatter(x=group['rug'], y=[label] * len(group['rug']), mode='markers', name=label,
+                                 legendgroup=label, showlegend=False, xaxis='x1', yaxis='y2',
+                                 marker=dict(color=color, symbol='line-ns-open')))
+    fig.update_layout(
+        barmode='overlay', hovermode='closest',
+        xaxis1=dict(domain=[0.0, 1.0], anchor='y2', zeroline=False),
+        yaxis1=dict(domain=[0.35, 1], anchor='free', position=0.0),
+        yaxis2=dict(domain=[0, 0.25], anchor='x1', dtick=1, showticklabels=False),
+        legend=dict(traceorder='reversed'))
+    return fig
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute the residual density plots of the evaluation page.')
+    parser.parse_args()
+
+    densities = build()
+    for plot, groups in densities.items():
+        print(plot + ': ' + ', '.join(f"{label} ({group['n']})" for label, group in groups.items()))
+    print(f'wrote {DENSITIES_PATH}')
+
+
+if __name__ == '__main__':
+    main()
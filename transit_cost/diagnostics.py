@@ -0,0 +1,139 @@
+### Influence and outlier diagnostics for the modelling frames.
+# Notebook 05 fits a statsmodels OLS formula to get Cook's distance, then screens z-scores and
+# IsolationForest scores in separate cells. Here the linear diagnostics all come from one
+# pivoted QR decomposition of the design matrix: leverage is the row norm of Q, and Cook's
+# distance and studentized residuals follow in closed form, so nothing is refit per row.
+# Everything is combined into one ranked report.
+#
+#   python -m transit_cost.diagnostics --data pickles/df_user.pkl
+import argparse
+import pickle
+
+import numpy as np
+import pandas as pd
+from scipy.linalg import qr
+
+from transit_cost.features import TARGET
+from transit_cost.paths import PICKLES_DIR
+
+# Conventional screening thresholds
+STUDENTIZED_LIMIT = 3
+ZSCORE_LIMIT = 3
+
+
+def design_matrix(df, target=TARGET, exclude=()):
+    """Intercept, numeric columns and drop-first dummies of the categorical columns."""
+    X = df.drop(columns=[target, *exclude])
+    categorical = X.select_dtypes(include=['object', 'category']).columns.tolist()
+    X = pd.get_dummies(X, columns=categorical, drop_first=True, dtype=float)
+    X.insert(0, 'intercept', 1.0)
+    return X.astype(float)
+
+
+def linear_influence(X, y):
+    """Leverage, Cook's distance & studentized residuals of the OLS fit of y on X.
+
+    Uses a column-pivoted QR so collinear dummy columns are dropped instead of breaking
+    the fit. Memory and time are O(n p^2); nothing is refit per observation.
+    """
+    X = np.asarray(X, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = X.shape[0]
+    Q, R, _ = qr(X, mode='economic', pivoting=True)
+    diag = np.abs(np.diag(R))
+    rank = int((diag > diag[0] * max(X.shape) * np.finfo(float).eps).sum())
+    Q = Q[:, :rank]
+
+    leverage = np.einsum('ij,ij->i', Q, Q)
+    residuals = y - Q @ (Q.T @ y)
+    dof = n - rank
+    sigma2 = residuals @ residuals / dof
+    one_minus_h = np.clip(1 - leverage, np.finfo(float).eps, None)
+
+    internal = residuals / np.sqrt(sigma2 * one_minus_h)
+    cooks = internal ** 2 * leverage / (rank * one_minus_h)
+    # Leave-one-out variance from the internal residual, no refit needed
+    external = internal * np.sqrt((dof - 1) / np.clip(dof - internal ** 2, np.finfo(float).eps, None))
+    return pd.DataFrame({
+        'leverage': leverage,
+        'cooks_distance': cooks,
+        'studentized_residual': external,
+        'residual': residuals,
+    }), rank
+
+
+def zscores(df, target=TARGET, exclude=()):
+    numeric = df.drop(columns=[target, *exclude]).select_dtypes(include='number')
+    std = numeric.std(ddof=0).replace(0, np.nan)
+    return ((numeric - numeric.mean()) / std).fillna(0.0)
+
+
+def isolation_scores(X, n_estimators=500, random_state=42):
+    """IsolationForest scores (higher is more anomalous) on the standardized design."""
+    from sklearn.ensemble import IsolationForest
+
+    X = np.asarray(X, dtype=float)
+    std = X.std(axis=0)
+    X_scaled = (X - X.mean(axis=0)) / np.where(std > 0, std, 1.0)
+    iso_forest = IsolationForest(n_estimators=n_estimators, contamination='auto', random_state=random_state)
+    iso_forest.fit(X_scaled)
+    return -iso_forest.decision_function(X_scaled), iso_forest.predict(X_scaled) == -1
+
+
+def outlier_report(df, target=TARGET, exclude=(), isolation=True, n_estimators=500):
+    """One row per project, most suspicious first.
+
+    `score` is the mean percentile rank over the individual diagnostics and `flags`
+    counts how many conventional thresholds the project crosses.
+    """
+    X = design_matrix(df, target, exclude)
+    report, rank = linear_influence(X.to_numpy(), df[target].to_numpy())
+    report.index = df.index
+    n = len(df)
+
+    z = zscores(df, target, exclude)
+    report['max_abs_zscore'] = z.abs().max(axis=1)
+    report['max_zscore_feature'] = z.abs().idxmax(axis=1)
+
+    flags = pd.DataFrame({
+        'high_leverage': report['leverage'] > 2 * rank / n,
+        'high_cooks_distance': report['cooks_distance'] > 4 / n,
+        'large_residual': report['studentized_residual'].abs() > STUDENTIZED_LIMIT,
+        'extreme_zscore': report['max_abs_zscore'] > ZSCORE_LIMIT,
+    }, index=df.index)
+    ranked = ['leverage', 'cooks_distance', 'max_abs_zscore']
+
+    if isolation:
+        report['isolation_score'], flags['isolated'] = isolation_scores(X.to_numpy(), n_estimators)
+        ranked.append('isolation_score')
+
+    percentiles = report[ranked].rank(pct=True)
+    percentiles['studentized_residual'] = report['studentized_residual'].abs().rank(pct=True)
+    report['score'] = percentiles.mean(axis=1)
+    report['flags'] = flags.sum(axis=1)
+    report = pd.concat([report, flags], axis=1)
+    return report.sort_values(['flags', 'score'], ascending=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rank projects by influence and outlier diagnostics.')
+    parser.add_argument('--data', default=str(PICKLES_DIR / 'df_user.pkl'))
+    parser.add_argument('--target', default=TARGET)
+    parser.add_argument('--exclude', nargs='*', default=['cost_real_2023'],
+                        help='columns to leave out of the design (e.g. the untransformed target)')
+    parser.add_argument('--no-isolation', action='store_true')
+    parser.add_argument('--out', default=str(PICKLES_DIR / 'outlier_report.pkl'))
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+
+    with open(args.data, 'rb') as f:
+        df = pickle.load(f)
+    exclude = [col for col in args.exclude if col in df.columns]
+    report = outlier_report(df, args.target, exclude, isolation=not args.no_isolation)
+    with open(args.out, 'wb') as f:
+        pickle.dump(report, f)
+    print(report.head(args.top).to_string())
+
+
+if __name__ == '__main__':
+    main()
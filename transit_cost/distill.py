@@ -0,0 +1,166 @@
+### Distilling the blended user model into a compact student.
+# The production blend (tuned CatBoost + 100 bagged ExtraTrees) is large on disk and slow
+# to score one scenario at a time, which is all the calculator does. The student is a single
+# shallow CatBoost model (oblivious trees, categoricals handled natively so it needs no
+# preprocessing pipeline) trained to reproduce the blend's predictions, over the training
+# projects plus synthetic scenarios perturbed from them. The track lengths, and every
+# interaction term built from one of them, are monotone constraints: more track never makes
+# the student's estimate cheaper.
+#
+# A student only replaces the blend if it matches it on the holdout (data_user_unseen):
+# MAE at most MAE_TOLERANCE worse and R² at most R2_TOLERANCE lower.
+#
+#   python -m transit_cost.distill              # distill the 'current' model and report parity/size/latency
+#   python -m transit_cost.distill --promote    # ... and register & promote the student if it passes
+import argparse
+import pickle
+import sys
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from transit_cost.features import INTERACTIONS, TARGET
+from transit_cost.paths import PICKLES_DIR
+
+MAE_TOLERANCE = 0.05
+R2_TOLERANCE = 0.01
+
+STUDENT_PARAMS = {'depth': 6, 'iterations': 800, 'learning_rate': 0.08, 'l2_leaf_reg': 3, 'random_seed': 786}
+TRACK_COLUMNS = ['tunnel_transformed', 'at_grade_transformed', 'elevated_transformed']
+# A track column enters the model through the interaction terms too, each a non-negative
+# multiple of it (Box-Cox of x + 1 is >= 0 for x >= 0), so those have to increase with it as well
+MONOTONE_INCREASING = TRACK_COLUMNS + [name for name, definition in INTERACTIONS.items()
+                                       if definition['base'] in TRACK_COLUMNS or definition.get('times') in TRACK_COLUMNS]
+
+# Raw inputs jittered multiplicatively (log-normal sigma) when making synthetic scenarios
+JITTER = {'tunnel': 0.3, 'at_grade': 0.3, 'elevated': 0.3, 'stations': 0.3, 'duration': 0.2}
+# Categorical columns swapped together with another project's, so regions stay consistent
+SWAP_GROUPS = [['region', 'sub_region'], ['train_type'], ['project_type'], ['soil_type'], ['city_size'],
+               ['country_income_class'], ['poverty_rate'], ['precipitation_type'], ['temperature_category'],
+               ['elevation_class'], ['city_density_type']]
+
+
+def augment(raw, n, swap_rate=0.2, year_shift=5, random_state=786):
+    """`n` synthetic raw scenarios perturbed from the rows of `raw`."""
+    rng = np.random.default_rng(random_state)
+    synthetic = raw.iloc[rng.integers(len(raw), size=n)].reset_index(drop=True)
+    for col, sigma in JITTER.items():
+        synthetic[col] = synthetic[col] * rng.lognormal(0, sigma, size=n)
+    synthetic['stations'] = synthetic['stations'].round()
+    synthetic['duration'] = synthetic['duration'].clip(lower=1)
+    shift = rng.integers(-year_shift, year_shift + 1, size=n)
+    synthetic['start_year'] += shift
+    synthetic['end_year'] += shift
+    for group in SWAP_GROUPS:
+        swap = rng.random(n) < swap_rate
+        donors = rng.integers(len(raw), size=swap.sum())
+        for col in group:
+            synthetic.loc[swap, col] = raw[col].to_numpy()[donors]
+    return synthetic
+
+
+def student_model(feature_order, categorical, params=STUDENT_PARAMS):
+    from catboost import CatBoostRegressor
+
+    constraints = {name: 1 for name in MONOTONE_INCREASING if name in feature_order}
+    # Categorical CTR combinations can take in splits of the constrained columns, which the
+    # constraints don't cover; single-feature CTRs keep the student monotone
+    return CatBoostRegressor(**params, cat_features=list(categorical), monotone_constraints=constraints,
+                             max_ctr_complexity=1, verbose=False, allow_writing_files=False)
+
+
+def distill(teacher, schema, train, n_synthetic=10000, params=STUDENT_PARAMS, random_state=786):
+    """Student fitted to the teacher's predictions on `train` plus `n_synthetic` augmented scenarios.
+
+    `schema` is the teacher's FeatureSchema; the student takes the same input frame.
+    """
+    real = train.drop(columns=[TARGET])[schema.feature_order]
+    synthetic = schema.build(augment(schema.raw_inputs(real), n_synthetic, random_state=random_state))
+    X = pd.concat([real, synthetic], ignore_index=True)
+    student = student_model(schema.feature_order, schema.categories, params)
+    student.fit(X, teacher.predict(X))
+    return student
+
+
+def passes_gate(teacher_scores, student_scores, mae_tolerance=MAE_TOLERANCE, r2_tolerance=R2_TOLERANCE):
+    return (student_scores['MAE'] <= teacher_scores['MAE'] * (1 + mae_tolerance)
+            and student_scores['R2'] >= teacher_scores['R2'] - r2_tolerance)
+
+
+def footprint(model, X, repeats=50):
+    """Pickled size and scoring latency (one row, and all of `X` at once) of a model."""
+    single = []
+    for i in range(repeats):
+        row = X.iloc[[i % len(X)]]
+        start = time.perf_counter()
+        model.predict(row)
+        single.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    model.predict(X)
+    batch = time.perf_counter() - start
+    return {'size (MB)': len(pickle.dumps(model)) / 1e6, 'single row (ms)': 1000 * np.median(single),
+            f'{len(X)} rows (ms)': 1000 * batch}
+
+
+def compare(teacher, student, validation, lambdas):
+    """Holdout scores and footprint of the teacher and the student, one row each."""
+    from transit_cost.update import scores
+
+    X = validation.drop(columns=[TARGET])
+    rows = {name: {**scores(model, validation, lambdas), **footprint(model, X)}
+            for name, model in (('teacher', teacher), ('student', student))}
+    return pd.DataFrame(rows).T
+
+
+def print_report(report, passed):
+    print(report.to_string(float_format='{:.4f}'.format))
+    teacher, student = report.loc['teacher'], report.loc['student']
+    print(f"student is {teacher['size (MB)'] / student['size (MB)']:.0f}x smaller and scores one row "
+          f"{teacher['single row (ms)'] / student['single row (ms)']:.0f}x faster")
+    print(f"parity gate (MAE within {MAE_TOLERANCE:.0%}, R2 within {R2_TOLERANCE}): {'passed' if passed else 'FAILED'}")
+
+
+def _load_pickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def main():
+    from transit_cost.inference import load_model
+    from transit_cost.pipeline import CACHE_DIR
+    from transit_cost.registry import DEFAULT_ALIAS, register_model, resolve
+    from transit_cost.schema import schema_for
+
+    parser = argparse.ArgumentParser(description='Distill the blended user model into a compact student.')
+    parser.add_argument('--alias', default=DEFAULT_ALIAS, help='registry alias of the model to distill')
+    parser.add_argument('--synthetic', type=int, default=10000, help='synthetic scenarios to add to the training rows')
+    parser.add_argument('--promote', action='store_true', help='register and promote the student if it passes the gate')
+    args = parser.parse_args()
+
+    entry = resolve(args.alias)
+    teacher = load_model(entry['artifact'])
+    schema = schema_for(entry)
+    train, validation = (_load_pickle(PICKLES_DIR / name) for name in ('data_user.pkl', 'data_user_unseen.pkl'))
+
+    start = time.perf_counter()
+    student = distill(teacher, schema, train, args.synthetic)
+    print(f"distilled {entry['version']} in {time.perf_counter() - start:.1f}s")
+    report = compare(teacher, student, validation, entry['lambdas'])
+    passed = passes_gate(report.loc['teacher'], report.loc['student'])
+    print_report(report, passed)
+    if not passed:
+        sys.exit(1)
+
+    CACHE_DIR.mkdir(exist_ok=True)
+    artifact = CACHE_DIR / f"student-of-{entry['version']}.pkl"
+    joblib.dump(student, artifact)
+    metrics = {name: float(value) for name, value in report.loc['student'].items()}
+    version = register_model(artifact, schema.feature_order, entry['lambdas'], metrics, promote=args.promote,
+                             schema=schema.schema)
+    print(f'registered {version}' + (' (promoted)' if args.promote else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,418 @@
+### Entity resolution between projects and the external city & country datasets.
+# The enrichment sources name the same places differently: ISO codes in some, English or
+# official UN names in others ("Republic of Korea", "Viet Nam"), local spellings ("WIEN",
+# "Genova"), typos ("Donguan"). Every name is normalized once (case, accents,
+# transliteration, punctuation, bracketed qualifiers, aliases) and then
+#   - countries resolve to ISO alpha-2 codes, by code, exact name or alias, and
+#   - cities resolve within their country (the blocking key), first by exact normalized name,
+#     then through a character trigram inverted index: the candidates are the names sharing a
+#     trigram with the query, scored together by Dice similarity from their shared trigram counts.
+# OVERRIDES pins (or rules out) matches the scoring gets wrong. `resolve` matches every
+# project key against every source in one pass, `join` attaches the sources' values (the
+# nearest year for yearly series) and `report` gives match rates, methods, doubtful matches and
+# agreement with the notebook-era enrichment in pickles/df.pkl.
+#
+# The pipeline fills new locations' ENRICHMENT_COLUMNS through `enrichment`: the static
+# values, which agree with df.pkl for 95-100% of its projects. The yearly poverty series
+# don't: per_below_line and reporting_gdp agree for about 20% whichever year is picked
+# (middle, start or end of construction), as notebook 04 took them from survey years it
+# didn't record, so they are only reported here and stay with notebook 04's lookups.
+#
+#   python -m transit_cost.entities                 # resolve costs.csv's cities, print the quality report
+#   python -m transit_cost.entities --unmatched     # ... and list what didn't match, per source
+import argparse
+import pickle
+import re
+import time
+import unicodedata
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from transit_cost.paths import DATA_DIR, PICKLES_DIR
+
+CITY_DATA = DATA_DIR / 'CityPopDen' / 'data'
+COUNTRY_CODES = DATA_DIR / 'CountryPopulationDensity' / 'CountryCodes.csv'
+NGRAM = 3
+# Fuzzy matches below these Dice scores are rejected
+MIN_CITY_SCORE = 0.6
+MIN_COUNTRY_SCORE = 0.75
+# Fuzzy matches below this are reported as low confidence, and as ambiguous when the
+# runner-up scores within AMBIGUITY_MARGIN of them
+CONFIDENT_SCORE = 0.8
+AMBIGUITY_MARGIN = 0.05
+
+# Where each value comes from. `country` is a column of ISO codes (kind 'code') or names
+# (kind 'name'); `city` is None for country-level sources; `year` is None for static ones.
+# Of several rows of the same entity the first is kept: worldcities appends metro-area rows
+# named like their city ("Luxembourg", 626108 people) after the city's own row.
+SOURCES = {
+    'worldcities': {
+        'path': CITY_DATA / 'worldcities.csv', 'country': 'iso2', 'kind': 'code', 'city': 'city_ascii',
+        'year': None, 'values': {'lat': 'lat', 'lng': 'lng', 'population': 'population'},
+    },
+    'un_citypop': {
+        'path': CITY_DATA / 'un_citypop.csv', 'country': 'Country or Area', 'kind': 'name', 'city': 'City',
+        'year': 'Year', 'values': {'Value': 'un_population'},
+    },
+    'land_area': {
+        'path': CITY_DATA / 'land_area.csv', 'country': 'Country', 'kind': 'name', 'city': 'City',
+        'year': None, 'values': {'Area_km': 'area_km'},
+    },
+    'poverty_index': {
+        'path': CITY_DATA / 'poverty_index.csv', 'country': 'Entity', 'kind': 'name', 'city': None, 'year': 'Year',
+        'values': {'Share below $6.85 a day': 'per_below_line', 'reporting_gdp': 'reporting_gdp'},
+    },
+    'land_cost': {
+        'path': DATA_DIR / 'LandCost' / 'land_cost.csv', 'country': 'code', 'kind': 'code', 'city': None, 'year': 'year',
+        'values': {'price_income_ratio': 'price_income_ratio', 'mortgage_perc_income': 'mortgage_perc_income',
+                   'affordability_index': 'affordability_index'},
+    },
+    'union_density': {
+        'path': DATA_DIR / 'TradeUnionDensity' / 'adjusted' / 'unions_pivot.csv', 'country': 'country',
+        'kind': 'code', 'city': None, 'year': None, 'values': {'avg_value': 'union_density'},
+    },
+}
+
+# Values the pipeline's enrichment takes from here: {column: source}
+ENRICHMENT_COLUMNS = {'population': 'worldcities', 'area_km': 'land_area', 'union_density': 'union_density'}
+
+TRANSLITERATION = str.maketrans({'ß': 'ss', 'ø': 'o', 'æ': 'ae', 'œ': 'oe', 'ł': 'l', 'đ': 'd', 'ð': 'd',
+                                 'þ': 'th', 'ı': 'i', "'": '', '’': '', 'ʼ': '', '`': ''})
+# Words that qualify a place rather than name it
+NOISE_WORDS = {'city', 'of', 'the', 'metropolitan', 'municipality', 'greater', 'sar', 'province'}
+# Codes the sources use that aren't ISO alpha-2
+CODE_ALIASES = {'UK': 'GB', 'EL': 'GR', 'KO': 'XK'}
+# Normalized country names missing from CountryCodes.csv
+COUNTRY_ALIASES = {
+    'uk': 'GB', 'uae': 'AE', 'saudi': 'SA', 'russia': 'RU', 'taiwan': 'TW', 'vietnam': 'VN', 'laos': 'LA',
+    'syria': 'SY', 'moldova': 'MD', 'republic moldova': 'MD', 'tanzania': 'TZ', 'united republic tanzania': 'TZ',
+    'czech republic': 'CZ', 'republic korea': 'KR', 'korea republic': 'KR', 'north korea': 'KP',
+    'democratic peoples republic korea': 'KP', 'china hong kong': 'HK', 'china macao': 'MO', 'macau': 'MO',
+    'ivory coast': 'CI', 'cape verde': 'CV', 'swaziland': 'SZ', 'macedonia': 'MK', 'tfyr macedonia': 'MK',
+    'kosovo': 'XK', 'palestine': 'PS', 'state palestine': 'PS', 'occupied palestinian territory': 'PS',
+    'dr congo': 'CD', 'democratic republic congo': 'CD', 'congo democratic republic': 'CD',
+    'congo kinshasa': 'CD', 'congo brazzaville': 'CG', 'timor': 'TL', 'brunei': 'BN', 'bahamas': 'BS',
+    'gambia': 'GM', 'united states america': 'US', 'united kingdom': 'GB',
+    'united kingdom great britain and northern ireland': 'GB',
+}
+# Normalized city spellings, mapped to the one both sides are normalized to
+CITY_ALIASES = {
+    'wien': 'vienna', 'munchen': 'munich', 'koln': 'cologne', 'nurnberg': 'nuremberg', 'roma': 'rome',
+    'milano': 'milan', 'torino': 'turin', 'napoli': 'naples', 'genova': 'genoa', 'firenze': 'florence',
+    'lisboa': 'lisbon', 'praha': 'prague', 'warszawa': 'warsaw', 'bucuresti': 'bucharest',
+    'kobenhavn': 'copenhagen', 'athina': 'athens', 'athinai': 'athens', 'moskva': 'moscow', 'kiev': 'kyiv',
+    'sankt peterburg': 'saint petersburg', 'st petersburg': 'saint petersburg', 'bombay': 'mumbai',
+    'calcutta': 'kolkata', 'madras': 'chennai', 'bangalore': 'bengaluru', 'peking': 'beijing',
+    'canton': 'guangzhou', 'saigon': 'ho chi minh', 'thanh pho ho chi minh': 'ho chi minh',
+    'bruxelles': 'brussels', 'brussel': 'brussels', 'den haag': 'the hague',
+    's gravenhage': 'the hague', 'hague': 'the hague', 'sevilla': 'seville', 'zaragoza': 'saragossa',
+    'krung thep': 'bangkok', 'al qahirah': 'cairo', 'al iskandariyah': 'alexandria', 'dilli': 'delhi',
+    'new delhi': 'delhi', 'teheran': 'tehran', 'mexico ciudad de': 'mexico', 'ciudad de mexico': 'mexico',
+    'padova': 'padua', 'venezia': 'venice', 'goteborg': 'gothenburg', 'luzern': 'lucerne', 'kharkov': 'kharkiv',
+    'freiburg im breisgau': 'freiburg', 'santiago de los caballeros': 'santiago', 'haerbin': 'harbin',
+}
+# (source, country, city) of a project: the source's (ISO code, city name) to use, or None for no match
+OVERRIDES = {
+    # Listed under US in costs.csv
+    ('worldcities', 'US', 'Montreal'): ('CA', 'Montreal'),
+    ('un_citypop', 'US', 'Montreal'): ('CA', 'Montreal'),
+    ('land_area', 'US', 'Montreal'): ('CA', 'Montreal'),
+    # Closest by spelling, but another city
+    ('un_citypop', 'US', 'Trenton'): None,
+}
+
+
+def normalize(name):
+    """Lower-case ASCII words of a place name, without bracketed qualifiers or NOISE_WORDS."""
+    if not isinstance(name, str):
+        return ''
+    text = re.sub(r'\(.*?\)|\[.*?\]', ' ', name.lower().translate(TRANSLITERATION))
+    text = ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+    words = [word for word in re.sub(r'[^a-z0-9]+', ' ', text).split() if word not in NOISE_WORDS]
+    return ' '.join(words)
+
+
+def city_key(name):
+    text = normalize(name)
+    return CITY_ALIASES.get(text, text)
+
+
+def ngrams(text, n=NGRAM):
+    padded = f' {text} '
+    return {padded[i:i + n] for i in range(max(1, len(padded) - n + 1))}
+
+
+class NameIndex:
+    """Character n-gram inverted index over names, blocked by a key (the country).
+
+    `match` looks a name up exactly, then scores every name of its block that shares an
+    n-gram with it, all at once: Dice = 2 * shared / (n-grams of the query + of the name).
+    """
+
+    def __init__(self, names, blocks):
+        self.names = np.asarray(names, dtype=object)
+        self.blocks = np.asarray(blocks, dtype=object)
+        self.exact = defaultdict(list)
+        postings = defaultdict(list)
+        sizes = np.zeros(len(self.names), dtype=np.int32)
+        for i, (name, block) in enumerate(zip(self.names, self.blocks)):
+            self.exact[block, name].append(i)
+            grams = ngrams(name)
+            sizes[i] = len(grams)
+            for gram in grams:
+                postings[block, gram].append(i)
+        self.sizes = sizes
+        self.postings = {key: np.asarray(ids, dtype=np.int64) for key, ids in postings.items()}
+
+    def candidates(self, name, block):
+        """(ids, scores) of the names in `block` sharing an n-gram with `name`, best first."""
+        grams = ngrams(name)
+        lists = [self.postings[block, gram] for gram in grams if (block, gram) in self.postings]
+        if not lists:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        ids, shared = np.unique(np.concatenate(lists), return_counts=True)
+        scores = 2 * shared / (len(grams) + self.sizes[ids])
+        order = np.argsort(-scores, kind='stable')
+        return ids[order], scores[order]
+
+    def match(self, name, block, min_score):
+        """(ids, score, method, runner-up score): exact matches, else the best fuzzy one above `min_score`."""
+        if (block, name) in self.exact:
+            return self.exact[block, name], 1.0, 'exact', np.nan
+        ids, scores = self.candidates(name, block)
+        if not len(ids) or scores[0] < min_score:
+            return [], (scores[0] if len(ids) else np.nan), None, np.nan
+        return [ids[0]], scores[0], 'fuzzy', (scores[1] if len(ids) > 1 else np.nan)
+
+
+class CountryResolver:
+    """ISO alpha-2 codes for country codes and names."""
+
+    def __init__(self, path=COUNTRY_CODES):
+        codes = pd.read_csv(path, keep_default_na=False)
+        self.codes = set(codes['alpha-2']) | set(COUNTRY_ALIASES.values())
+        names = {normalize(name): code for name, code in zip(codes['name'], codes['alpha-2'])}
+        names.update({normalize(code): code for code in codes['alpha-3']})
+        names.update(COUNTRY_ALIASES)
+        self.by_name = names
+        self.index = NameIndex(list(names), [None] * len(names))
+        self._codes = list(names.values())
+
+    def code(self, value):
+        """ISO alpha-2 of a source's country code, or None."""
+        if not isinstance(value, str):
+            return None
+        value = CODE_ALIASES.get(value.strip().upper(), value.strip().upper())
+        return value if value in self.codes else None
+
+    def name(self, value):
+        """ISO alpha-2 of a country name, or None."""
+        text = normalize(value)
+        if not text:
+            return None
+        if text in self.by_name:
+            return self.by_name[text]
+        ids, _, method, _ = self.index.match(text, None, MIN_COUNTRY_SCORE)
+        return self._codes[ids[0]] if method else None
+
+
+def _numeric(series):
+    if series.dtype == object:
+        series = series.str.replace(',', '', regex=False)
+    return pd.to_numeric(series, errors='coerce')
+
+
+def load_source(name, countries, spec=None):
+    """A source's rows as country (ISO alpha-2), city key, year and its values."""
+    spec = spec or SOURCES[name]
+    raw = pd.read_csv(spec['path'], keep_default_na=False, na_values=[''])
+    resolve = countries.code if spec['kind'] == 'code' else countries.name
+    lookup = {value: resolve(value) for value in raw[spec['country']].dropna().unique()}
+    rows = pd.DataFrame({'country': raw[spec['country']].map(lookup)})
+    rows['source_country'] = raw[spec['country']]
+    if spec['city'] is not None:
+        rows['source_city'] = raw[spec['city']]
+        rows['city_key'] = [city_key(city) for city in raw[spec['city']]]
+    if spec['year'] is not None:
+        rows['year'] = _numeric(raw[spec['year']])
+    for column, value in spec['values'].items():
+        rows[value] = _numeric(raw[column])
+    return rows
+
+
+class Source:
+    """One source's rows and, for city-level sources, the index of its city names."""
+
+    def __init__(self, name, rows, spec):
+        self.name = name
+        self.spec = spec
+        self.unresolved_countries = sorted(rows.loc[rows['country'].isna(), 'source_country'].dropna().unique())
+        self.rows = rows[rows['country'].notna()].reset_index(drop=True)
+        if spec['city'] is not None:
+            # Entities are (country, city)
+            self.entities = self.rows.drop_duplicates(['country', 'city_key']).reset_index(drop=True)
+            self.index = NameIndex(self.entities['city_key'], self.entities['country'])
+        else:
+            self.entities = self.rows.drop_duplicates('country').reset_index(drop=True)
+            self.countries = set(self.entities['country'])
+
+    def match(self, country, city):
+        """(entity key, score, method, runner-up score) of a project's (country, city)."""
+        if self.spec['city'] is None:
+            return (country, 1.0, 'exact', np.nan) if country in self.countries else (None, np.nan, None, np.nan)
+        override = OVERRIDES.get((self.name, country, city), ...)
+        if override is not ...:
+            entity = None if override is None else (override[0], city_key(override[1]))
+            if entity not in self.index.exact:
+                return None, np.nan, 'override', np.nan
+            return entity, 1.0, 'override', np.nan
+        key = city_key(city)
+        ids, score, method, runner_up = self.index.match(key, country, MIN_CITY_SCORE)
+        if not method:
+            return None, score, None, runner_up
+        if method == 'exact' and key != normalize(city):
+            method = 'alias'
+        return (country, self.entities['city_key'].iat[ids[0]]), score, method, runner_up
+
+
+def load_sources(sources=SOURCES):
+    countries = CountryResolver()
+    return {name: Source(name, load_source(name, countries, spec), spec) for name, spec in sources.items()}
+
+
+def resolve(keys, sources):
+    """Matches of every project (country, city) key in every source.
+
+    One row per key: for each source its matched entity, score, method and runner-up score.
+    """
+    countries = CountryResolver()
+    keys = pd.DataFrame(keys, columns=['country', 'city']).drop_duplicates().reset_index(drop=True)
+    iso = [countries.code(country) for country in keys['country']]
+    frame = keys.copy()
+    for name, source in sources.items():
+        matches = [source.match(code, city) for code, city in zip(iso, keys['city'])]
+        frame[f'{name}_entity'] = [match[0] for match in matches]
+        frame[f'{name}_score'] = [match[1] for match in matches]
+        frame[f'{name}_method'] = [match[2] for match in matches]
+        frame[f'{name}_runner_up'] = [match[3] for match in matches]
+    return frame.set_index(['country', 'city'])
+
+
+def join(projects, matches, sources):
+    """Projects with every source's values.
+
+    Yearly sources give the year nearest the middle of construction (`start_year` to
+    `end_year`), the later of two equally near, as the notebook-era land cost year was chosen.
+    """
+    joined = projects.reset_index(drop=True)
+    entity_of = matches.reindex(pd.MultiIndex.from_frame(joined[['country', 'city']]))
+    for name, source in sources.items():
+        entity_columns = ['country'] if source.spec['city'] is None else ['country', 'city_key']
+        values = list(source.spec['values'].values())
+        entities = entity_of[f'{name}_entity'].to_numpy()
+        if source.spec['city'] is None:
+            left = pd.DataFrame({'country': entities})
+        else:
+            left = pd.DataFrame([entity if entity is not None else (None, None) for entity in entities],
+                                columns=entity_columns)
+        left['_row'] = np.arange(len(joined))
+        if source.spec['year'] is None:
+            found = left.merge(source.entities[entity_columns + values], on=entity_columns, how='left')
+        else:
+            left['_middle'] = (joined['start_year'].to_numpy(dtype=float) + joined['end_year'].to_numpy(dtype=float)) / 2
+            candidates = left.merge(source.rows[entity_columns + ['year'] + values].dropna(subset=values, how='all'),
+                                    on=entity_columns, how='inner')
+            distance = (candidates['year'] - candidates['_middle']).abs()
+            candidates = (candidates.assign(_distance=distance)
+                          .sort_values(['_row', '_distance', 'year'], ascending=[True, True, False]))
+            found = candidates.drop_duplicates('_row')
+        found = found.set_index('_row').reindex(np.arange(len(joined)))
+        for value in values:
+            joined[value] = found[value].to_numpy()
+    return joined
+
+
+def enrichment(keys, columns=ENRICHMENT_COLUMNS):
+    """`columns` for (country, city, start_year, end_year) keys, indexed by them; NaN where unmatched."""
+    keys = pd.DataFrame(keys, columns=['country', 'city', 'start_year', 'end_year'])
+    sources = load_sources({name: SOURCES[name] for name in set(columns.values())})
+    joined = join(keys, resolve(keys[['country', 'city']], sources), sources)
+    return joined.set_index(list(keys.columns))[list(columns)]
+
+
+def report(matches, sources, joined=None, seed=None):
+    """Match quality per source, and agreement of the joined values with `seed` where it has them."""
+    rows = []
+    for name, source in sources.items():
+        method = matches[f'{name}_method']
+        score, runner_up = matches[f'{name}_score'], matches[f'{name}_runner_up']
+        fuzzy = method == 'fuzzy'
+        row = {
+            'source': name, 'keys': len(matches), 'matched': int(matches[f'{name}_entity'].notna().sum()),
+            'exact': int((method == 'exact').sum()), 'alias': int((method == 'alias').sum()),
+            'fuzzy': int(fuzzy.sum()), 'override': int((method == 'override').sum()),
+            'low_confidence': int((fuzzy & (score < CONFIDENT_SCORE)).sum()),
+            'ambiguous': int((fuzzy & (score - runner_up < AMBIGUITY_MARGIN)).sum()),
+            'unresolved_countries': len(source.unresolved_countries),
+        }
+        row['match_rate'] = row['matched'] / max(row['keys'], 1)
+        if joined is not None and seed is not None:
+            agreement = []
+            for value in source.spec['values'].values():
+                if value in seed.columns:
+                    ours, theirs = joined[value].to_numpy(dtype=float), seed[value].to_numpy(dtype=float)
+                    if pd.api.types.is_integer_dtype(seed[value]):
+                        # The notebooks truncated some values to integers
+                        ours = np.floor(ours)
+                    both = ~np.isnan(ours) & ~np.isnan(theirs)
+                    same = np.isclose(ours[both], theirs[both], rtol=0.01, atol=1e-6)
+                    agreement.append(f'{value} {same.mean():.0%} of {both.sum()}')
+            row['agreement_with_seed'] = ', '.join(agreement)
+        rows.append(row)
+    return pd.DataFrame(rows).set_index('source')
+
+
+def unmatched(matches, sources):
+    """{source: frame of the keys it didn't match, with the best rejected score}."""
+    return {name: matches.loc[matches[f'{name}_entity'].isna(), [f'{name}_score']].rename(columns={f'{name}_score': 'best_score'})
+            for name in sources}
+
+
+def project_keys():
+    """(country, city) of every project in costs.csv, cleaned as the pipeline does."""
+    from transit_cost.pipeline import Pipeline
+
+    cleaned = Pipeline().run(['cleaned'])[0]['cleaned']
+    return cleaned[['country', 'city']].dropna()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Resolve project cities against the external datasets.')
+    parser.add_argument('--unmatched', action='store_true', help='list the keys each source did not match')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    sources = load_sources()
+    loaded = time.perf_counter()
+    matches = resolve(project_keys(), sources)
+    resolved = time.perf_counter()
+    with open(PICKLES_DIR / 'df.pkl', 'rb') as f:
+        seed = pickle.load(f)
+    joined = join(seed[['country', 'city', 'start_year', 'end_year']], matches, sources)
+    joined_at = time.perf_counter()
+
+    print(f'{len(matches)} cities against {len(sources)} sources: loaded in {loaded - start:.2f} s, '
+          f'resolved in {resolved - loaded:.2f} s, joined in {joined_at - resolved:.2f} s')
+    with pd.option_context('display.width', 200, 'display.max_colwidth', 80):
+        print(report(matches, sources, joined, seed.reset_index(drop=True)).to_string(float_format='{:.1%}'.format))
+        if args.unmatched:
+            for name, frame in unmatched(matches, sources).items():
+                print(f'\n{name}: {len(frame)} unmatched')
+                if len(frame):
+                    print(frame.to_string(float_format='{:.2f}'.format))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+### SHAP values of the production model over the full training set.
+# pickles/df_plot_melted.pkl, behind the Data page's SHAP plot, used to be exported once from
+# a LightGBM stand-in for the model. Here the values are computed for the registered blend
+# itself, with path-dependent TreeSHAP over the leaves of its trees (TreeEnsemble.leaves in
+# transit_cost.incremental). A leaf with output v, whose path splits on d distinct columns,
+# where p_j is the share of the training rows that followed the path's splits on column j and
+# o_j is 1 when the row's value of j falls inside the path's interval (0 otherwise), adds
+#     phi_i = v (o_i - p_i) sum_k w(k, d) [t^k] prod_{j != i} (p_j + o_j t),   w(k, d) = k! (d-k-1)! / d!
+# to column i: the same values as the recursive TreeSHAP algorithm, which sum with the
+# expected value to the prediction. Pairwise interaction values take two factors out of the
+# product instead of one. shap isn't a dependency, so this is plain numpy: leaves are grouped
+# by path length into blocks evaluated for a chunk of rows at a time, and the chunks are
+# spread over a process pool.
+#
+# The values are saved next to the model in the registry as Parquet: shap.parquet holds one
+# float32 column per preprocessed column plus the prediction, with the expected value in the
+# file's metadata, and shap_interactions.parquet the non-zero pairs in long form. The Data
+# page plots the values saved for the version being served (`plot_frame`), so they follow
+# promotions; a version without them falls back to the exported df_plot_melted.pkl.
+#
+#   python -m transit_cost.explain                              # the 'current' model over data_user
+#   python -m transit_cost.explain --interactions --workers 4   # ... with pairwise interaction values
+import argparse
+import math
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from transit_cost.incremental import TreeEnsemble
+from transit_cost.inference import blend_parts
+from transit_cost.paths import PICKLES_DIR
+
+MELTED_PATH = PICKLES_DIR / 'df_plot_melted.pkl'
+VALUES_FILE = 'shap.parquet'
+INTERACTIONS_FILE = 'shap_interactions.parquet'
+# Features shown in the Data page's plot, by mean |SHAP|
+TOP_FEATURES = 10
+WORKERS = os.cpu_count() or 1
+# Rows per task sent to a worker, and rows x leaves x polynomial terms per numpy step
+CHUNK_ROWS = 128
+BLOCK_SIZE = 1 << 21
+
+
+def shapley_weights(depth):
+    """w[d, k] = k! (d - k - 1)! / d!: the weight of a coalition of k of the other d - 1 columns."""
+    w = np.zeros((depth + 1, depth + 1))
+    for d in range(1, depth + 1):
+        for k in range(d):
+            w[d, k] = math.factorial(k) * math.factorial(d - k - 1) / math.factorial(d)
+    return w
+
+
+def _expand(p, o):
+    """Coefficients of prod_j (p_j + o_j t), one power per row of the first axis, lowest first."""
+    coef = np.zeros((len(o) + 1,) + o.shape[1:])
+    coef[0] = 1
+    for j in range(len(o)):
+        shifted = coef[:j + 1] * o[j]
+        coef[:j + 2] *= p[j]
+        coef[1:j + 2] += shifted
+    return coef
+
+
+def _inverse(p):
+    return np.divide(1, p, out=np.zeros_like(p), where=p > 0)
+
+
+def _divide(coef, p, o):
+    """coef / (p + o t), for polynomials that have that factor and o either 0 or 1."""
+    # o = 1: synthetic division from the highest power down
+    quotient = np.zeros_like(coef)
+    for k in range(len(coef) - 1, 0, -1):
+        quotient[k - 1] = coef[k] - p * quotient[k]
+    # o = 0: a constant factor; with p = 0 the leaf can't be reached without the column anyway
+    return np.where(o > 0, quotient, coef * _inverse(p))
+
+
+def _weighted_division(w, p):
+    """(g0, g1 - g0), where sum_k w_k [t^k] (c / (p + o t)) = sum_m c_m g_o[m] for each leaf.
+
+    The shares only depend on the leaf, so dividing by a factor and weighting the quotient's
+    coefficients is one contraction of the product's coefficients with these.
+    """
+    g0 = w[:, None] * _inverse(p)
+    g1 = np.zeros((len(w), len(p)))
+    for m in range(1, len(w)):
+        g1[m] = w[m - 1] - p * g1[m - 1]
+    return g0, g1 - g0
+
+
+def _contract(coef, g, o):
+    g0, g1 = g
+    return np.einsum('mrl,ml->rl', coef, g0) + o * np.einsum('mrl,ml->rl', coef, g1)
+
+
+def _block_values(X, block, weights, interactions):
+    """SHAP values (rows x leaves x slots) of a block of leaves, with pairs (... x slots) if asked."""
+    depth = block['feature'].shape[1]
+    # Slots first, so every step below works on contiguous (rows x leaves) planes
+    x = np.moveaxis(X[:, block['feature'].T], 1, 0)
+    o = ((x > block['lo'].T[:, None]) & (x <= block['hi'].T[:, None])).astype(float)
+    p = block['share'].T
+    coef = _expand(p[:, None], o)
+    single = [_weighted_division(weights[depth, :depth + 1], p[i]) for i in range(depth)]
+    values = np.empty(o.shape)
+    if interactions:
+        pair = [_weighted_division(weights[depth - 1, :depth + 1], p[j]) for j in range(depth)]
+        pairs = np.zeros((depth,) + o.shape)
+    for i in range(depth):
+        lead = block['value'] * (o[i] - p[i])
+        values[i] = lead * _contract(coef, single[i], o[i])
+        if interactions:
+            without = _divide(coef, p[i], o[i])
+            for j in range(i + 1, depth):
+                pairs[i, j] = pairs[j, i] = 0.5 * lead * (o[j] - p[j]) * _contract(without, pair[j], o[j])
+    # Back to (rows, leaves, slots...), the order of the block's scatter maps
+    values = np.moveaxis(values, 0, -1)
+    return values, (np.moveaxis(pairs, (0, 1), (-2, -1)) if interactions else None)
+
+
+def leaf_blocks(table, n_columns, interactions=False, rows=CHUNK_ROWS, block_size=BLOCK_SIZE):
+    """Leaves of a TreeEnsemble leaf table in blocks of one path length, with the sparse maps
+    scattering their slots onto the preprocessed columns (and column pairs)."""
+    blocks = []
+    for depth in np.unique(table['length']):
+        if depth == 0:
+            # A tree that is a single leaf only moves the expected value
+            continue
+        leaves = np.flatnonzero(table['length'] == depth)
+        per_block = max(1, block_size // (rows * (depth + 1) * (depth if interactions else 1)))
+        for start in range(0, len(leaves), per_block):
+            chosen = leaves[start:start + per_block]
+            block = {name: table[name][chosen][:, :depth] for name in ('feature', 'lo', 'hi', 'share')}
+            block['value'] = table['value'][chosen]
+            feature = block['feature'].ravel()
+            block['columns'] = sparse.csr_matrix((np.ones(len(feature)), (np.arange(len(feature)), feature)),
+                                                 shape=(len(feature), n_columns))
+            if interactions:
+                first = np.repeat(block['feature'][:, :, None], depth, axis=2).ravel()
+                second = np.repeat(block['feature'][:, None, :], depth, axis=1).ravel()
+                block['pairs'] = sparse.csr_matrix((np.ones(len(first)), (np.arange(len(first)), first * n_columns + second)),
+                                                   shape=(len(first), n_columns * n_columns))
+            blocks.append(block)
+    return blocks
+
+
+def explain_rows(X, blocks, n_columns, max_depth, interactions=False):
+    """(SHAP values (rows x columns), interaction values (rows x columns x columns) or None)."""
+    weights = shapley_weights(max_depth)
+    values = np.zeros((len(X), n_columns))
+    pairs = np.zeros((len(X), n_columns * n_columns)) if interactions else None
+    for block in blocks:
+        block_values, block_pairs = _block_values(X, block, weights, interactions)
+        # Sparse map on the left: (columns x slots) @ (slots x rows)
+        values += (block['columns'].T @ block_values.reshape(len(X), -1).T).T
+        if interactions:
+            pairs += (block['pairs'].T @ block_pairs.reshape(len(X), -1).T).T
+    if not interactions:
+        return values, None
+    pairs = pairs.reshape(len(X), n_columns, n_columns)
+    # The main effect is what the pairs leave of each column's value
+    diagonal = np.arange(n_columns)
+    pairs[:, diagonal, diagonal] = values - pairs.sum(axis=2)
+    return values, pairs
+
+
+_worker = {}
+
+
+def _start_worker(blocks, n_columns, max_depth, interactions):
+    _worker.update(blocks=blocks, n_columns=n_columns, max_depth=max_depth, interactions=interactions)
+
+
+def _explain_chunk(X):
+    return explain_rows(X, **_worker)
+
+
+def column_names(preprocess, Xt):
+    """Names of the preprocessed columns, without sklearn's 'transformer__' prefixes."""
+    if isinstance(Xt, pd.DataFrame):
+        return [str(name) for name in Xt.columns]
+    try:
+        names = preprocess.get_feature_names_out()
+    except (AttributeError, ValueError):
+        return [f'x{i}' for i in range(Xt.shape[1])]
+    return [str(name).split('__', 1)[-1] for name in names]
+
+
+def explain(model, features, interactions=False, workers=WORKERS, chunk_rows=CHUNK_ROWS):
+    """TreeSHAP values of a fitted (blended) tree model for a frame of model inputs.
+
+    Returns {'values': frame of rows x preprocessed columns, 'expected_value', 'predictions',
+    'interactions': rows x columns x columns array (or None), 'additivity_error'}; the values of
+    a row sum with the expected value to its prediction, in the model's (Box-Cox) output space.
+    """
+    preprocess, estimator = blend_parts(model)
+    Xt = features if preprocess is None else preprocess.transform(features)
+    X = np.asarray(Xt.toarray() if sparse.issparse(Xt) else Xt, dtype=float)
+    n_columns = X.shape[1]
+    ensemble = TreeEnsemble(estimator, n_columns)
+    table = ensemble.leaves()
+    expected_value = ensemble.bias + float(table['value'] @ table['share'].prod(axis=1))
+    blocks = leaf_blocks(table, n_columns, interactions, min(chunk_rows, len(X)))
+    max_depth = int(table['length'].max())
+
+    # Trees compare float32 inputs against their thresholds
+    X = X.astype(np.float32).astype(float)
+    chunks = [X[start:start + chunk_rows] for start in range(0, len(X), chunk_rows)]
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(min(workers, len(chunks)), initializer=_start_worker,
+                                 initargs=(blocks, n_columns, max_depth, interactions)) as pool:
+            results = list(pool.map(_explain_chunk, chunks))
+    else:
+        results = [explain_rows(chunk, blocks, n_columns, max_depth, interactions) for chunk in chunks]
+
+    values = np.vstack([chunk_values for chunk_values, _ in results])
+    predictions = np.asarray(model.predict(features), dtype=float)
+    return {
+        'values': pd.DataFrame(values, index=features.index, columns=column_names(preprocess, Xt)).rename_axis('row'),
+        'expected_value': expected_value,
+        'predictions': predictions,
+        'interactions': np.concatenate([pairs for _, pairs in results]) if interactions else None,
+        'additivity_error': float(np.abs(values.sum(axis=1) + expected_value - predictions).max()),
+    }
+
+
+### Columnar store
+def save(result, directory):
+    """Write shap.parquet (and shap_interactions.parquet) into `directory`; returns the paths."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    values = result['values']
+    frame = values.astype(np.float32).assign(prediction=result['predictions'])
+    table = pa.Table.from_pandas(frame, preserve_index=True)
+    table = table.replace_schema_metadata({**table.schema.metadata,
+                                           b'expected_value': repr(float(result['expected_value'])).encode()})
+    paths = [os.path.join(directory, VALUES_FILE)]
+    pq.write_table(table, paths[0], compression='zstd')
+
+    if result['interactions'] is not None:
+        # Symmetric, so only the upper triangle; most pairs never share a path and stay zero
+        first, second = np.triu_indices(values.shape[1])
+        upper = result['interactions'][:, first, second]
+        rows, pairs = np.nonzero(upper)
+        names = pa.array(list(values.columns))
+        long = pa.table({
+            'row': pa.array(values.index.to_numpy()[rows]),
+            'feature': pa.DictionaryArray.from_arrays(pa.array(first[pairs].astype(np.int32)), names),
+            'other': pa.DictionaryArray.from_arrays(pa.array(second[pairs].astype(np.int32)), names),
+            'value': pa.array(upper[rows, pairs].astype(np.float32)),
+        })
+        paths.append(os.path.join(directory, INTERACTIONS_FILE))
+        pq.write_table(long, paths[1], compression='zstd')
+    return paths
+
+
+def load(directory, interactions=True):
+    """The saved values of `save`: {'values', 'predictions', 'expected_value', 'interactions'}.
+
+    'interactions' is None when they weren't saved or `interactions` is False.
+    """
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(os.path.join(directory, VALUES_FILE))
+    frame = table.to_pandas()
+    values = frame.drop(columns='prediction')
+    path = os.path.join(directory, INTERACTIONS_FILE)
+    pairs = None
+    if interactions and os.path.exists(path):
+        long = pq.read_table(path).to_pandas()
+        position = pd.Series(np.arange(len(values)), index=values.index)
+        column = pd.Series(np.arange(values.shape[1]), index=values.columns)
+        rows = position[long['row']].to_numpy()
+        first = column[long['feature'].astype(str)].to_numpy()
+        second = column[long['other'].astype(str)].to_numpy()
+        pairs = np.zeros((len(values), values.shape[1], values.shape[1]), dtype=np.float32)
+        pairs[rows, first, second] = pairs[rows, second, first] = long['value'].to_numpy()
+    return {'values': values, 'predictions': frame['prediction'].to_numpy(),
+            'expected_value': float(table.schema.metadata[b'expected_value']), 'interactions': pairs}
+
+
+def melted(values, predictions, top=TOP_FEATURES):
+    """The Data page's SHAP plot frame: one row per (row, feature) for the `top` features by mean |SHAP|."""
+    mean_abs = values.abs().mean().sort_values(ascending=False)
+    chosen = list(mean_abs.index[:top])
+    frame = (values[chosen].astype(float).assign(predictions=np.asarray(predictions, dtype=float))
+             .melt(id_vars='predictions', var_name='Feature', value_name='SHAP'))
+    frame['size'] = frame['SHAP'].abs()
+    frame['difference'] = frame['predictions'] + frame['SHAP']
+    frame['SHAP_Range'] = frame.groupby('Feature')['SHAP'].transform(lambda shap: shap.max() - shap.min())
+    frame['abs_avg'] = mean_abs[chosen].mean()
+    return frame[['Feature', 'SHAP', 'predictions', 'size', 'difference', 'SHAP_Range', 'abs_avg']]
+
+
+def plot_frame(artifact, fallback=MELTED_PATH):
+    """`melted` values saved next to the model `artifact`, or the frame at `fallback` if there are none."""
+    directory = os.path.dirname(artifact)
+    if not os.path.exists(os.path.join(directory, VALUES_FILE)):
+        with open(fallback, 'rb') as f:
+            return pickle.load(f)
+    result = load(directory, interactions=False)
+    return melted(result['values'], result['predictions'])
+
+
+def main():
+    from transit_cost.features import TARGET
+    from transit_cost.inference import load_model
+    from transit_cost.registry import resolve
+
+    parser = argparse.ArgumentParser(description='Compute TreeSHAP values of a registered model over data_user.')
+    parser.add_argument('--alias', default='current', help='registry alias of the model to explain')
+    parser.add_argument('--interactions', action='store_true', help='also compute pairwise interaction values')
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    args = parser.parse_args()
+
+    entry = resolve(args.alias)
+    model = load_model(entry['artifact'])
+    with open(PICKLES_DIR / 'data_user.pkl', 'rb') as f:
+        data = pickle.load(f)
+    features = data[entry['feature_order']] if entry.get('feature_order') else data.drop(columns=[TARGET])
+    start = time.perf_counter()
+    result = explain(model, features, args.interactions, args.workers)
+    print(f'{entry["version"]}: {len(features)} rows x {result["values"].shape[1]} columns in '
+          f'{time.perf_counter() - start:.1f}s, expected value {result["expected_value"]:.4f}, '
+          f'largest additivity error {result["additivity_error"]:.2e}')
+    for path in save(result, os.path.dirname(entry['artifact'])):
+        print('wrote', path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+### Server-side dataset explorer for the Data page.
+# Instead of sending whole frames to every browser, the explorable artifacts are copied into
+# a local SQLite database (.pipeline_cache/explorer.db, rebuilt whenever a source pickle is
+# newer) with an index on every filter column. Filters, sorting and pagination run as SQL,
+# and only the visible page of rows is turned into a frame and sent to the browser.
+#
+#   python -m transit_cost.explorer                         # (re)build the database and list the datasets
+#   python -m transit_cost.explorer projects --sort length --descending --where train_type=Streetcar
+import argparse
+import os
+import pickle
+import sqlite3
+import threading
+
+import pandas as pd
+
+from transit_cost.boxcox import inv_boxcox
+from transit_cost.paths import PICKLES_DIR, ROOT
+
+EXPLORER_DB = ROOT / '.pipeline_cache' / 'explorer.db'
+PAGE_SIZE = 25
+# Columns shown without thousands separators
+YEAR_COLUMNS = ['start_year', 'end_year', 'year']
+
+
+def _with_length(frame):
+    # df_cleaned only keeps the Box-Cox transformed length; filtering by length needs kilometres
+    with open(PICKLES_DIR / 'lambdas_dict.pkl', 'rb') as f:
+        lmbda = pickle.load(f)['length_transformed']
+    frame = frame.copy()
+    frame.insert(0, 'length', (inv_boxcox(frame['length_transformed'].to_numpy(dtype=float), lmbda) - 1).round(2))
+    return frame
+
+
+# Table name: source artifact, how to prepare it, categorical and range filters
+DATASETS = {
+    'projects': {
+        'artifact': 'df_cleaned.pkl', 'prepare': _with_length,
+        'categories': ['region', 'sub_region', 'train_type', 'project_type'],
+        'ranges': ['start_year', 'length'],
+    },
+    'locations': {
+        'artifact': 'df_engineered.pkl', 'prepare': None,
+        'categories': ['country', 'city'],
+        'ranges': ['year', 'length'],
+    },
+    'model_inputs': {
+        'artifact': 'df_user.pkl', 'prepare': None,
+        'categories': ['region', 'train_type', 'project_type'],
+        'ranges': ['start_year'],
+    },
+}
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def build(path=EXPLORER_DB, datasets=DATASETS):
+    """Write every dataset into a fresh database at `path`."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_suffix('.db.part')
+    if os.path.exists(partial):
+        os.remove(partial)
+    conn = sqlite3.connect(partial)
+    try:
+        for table, spec in datasets.items():
+            with open(PICKLES_DIR / spec['artifact'], 'rb') as f:
+                frame = pickle.load(f)
+            if spec['prepare'] is not None:
+                frame = spec['prepare'](frame)
+            frame.to_sql(table, conn, index=False)
+            for column in [*spec['categories'], *spec['ranges']]:
+                conn.execute(f'CREATE INDEX {_quote(f"{table}_{column}")} ON {_quote(table)} ({_quote(column)})')
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(partial, path)
+
+
+class Explorer:
+    """Filtered, sorted pages of the DATASETS, queried from the explorer database."""
+
+    def __init__(self, path=EXPLORER_DB, datasets=DATASETS):
+        self.path = path
+        self.datasets = datasets
+        self._lock = threading.Lock()
+        self._options = {}
+        self._columns = {}
+        self._has_tables = False
+
+    def _stale(self):
+        if not os.path.exists(self.path):
+            return True
+        built = os.path.getmtime(self.path)
+        if any(os.path.getmtime(PICKLES_DIR / spec['artifact']) > built for spec in self.datasets.values()):
+            return True
+        if not self._has_tables:
+            # A database built before a dataset was added to DATASETS
+            with sqlite3.connect(f'file:{self.path}?mode=ro', uri=True) as conn:
+                tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            self._has_tables = set(self.datasets) <= tables
+        return not self._has_tables
+
+    def ensure(self):
+        """Build the database if it is missing or older than its source pickles."""
+        with self._lock:
+            if self._stale():
+                build(self.path, self.datasets)
+                self._has_tables = True
+                self._options.clear()
+                self._columns.clear()
+
+    def _connect(self):
+        self.ensure()
+        return sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+
+    def columns(self, dataset):
+        if dataset not in self._columns:
+            with self._connect() as conn:
+                self._columns[dataset] = [row[1] for row in conn.execute(f'PRAGMA table_info({_quote(dataset)})')]
+        return self._columns[dataset]
+
+    def options(self, dataset):
+        """{'categories': {column: values}, 'ranges': {column: (min, max)}} of a dataset's filters."""
+        if dataset not in self._options:
+            spec = self.datasets[dataset]
+            table = _quote(dataset)
+            with self._connect() as conn:
+                categories = {column: [row[0] for row in conn.execute(
+                    f'SELECT DISTINCT {_quote(column)} FROM {table} WHERE {_quote(column)} IS NOT NULL ORDER BY 1')]
+                    for column in spec['categories']}
+                ranges = {column: conn.execute(f'SELECT MIN({_quote(column)}), MAX({_quote(column)}) FROM {table}').fetchone()
+                          for column in spec['ranges']}
+            self._options[dataset] = {'categories': categories, 'ranges': ranges}
+        return self._options[dataset]
+
+    def _where(self, dataset, categories, ranges):
+        spec = self.datasets[dataset]
+        clauses, params = [], []
+        for column, values in (categories or {}).items():
+            if column not in spec['categories']:
+                raise KeyError(f'{dataset} has no category filter on {column}')
+            if values:
+                clauses.append(f'{_quote(column)} IN ({", ".join("?" * len(values))})')
+                params.extend(values)
+        for column, (low, high) in (ranges or {}).items():
+            if column not in spec['ranges']:
+                raise KeyError(f'{dataset} has no range filter on {column}')
+            clauses.append(f'{_quote(column)} BETWEEN ? AND ?')
+            params.extend([low, high])
+        return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+    def count(self, dataset, categories=None, ranges=None):
+        """Rows matching the filters."""
+        where, params = self._where(dataset, categories, ranges)
+        with self._connect() as conn:
+            return conn.execute(f'SELECT COUNT(*) FROM {_quote(dataset)}{where}', params).fetchone()[0]
+
+    def page(self, dataset, categories=None, ranges=None, sort=None, descending=False, page=0, page_size=PAGE_SIZE):
+        """One page of the rows matching the filters.
+
+        `categories` maps category columns to the values to keep (all if empty) and `ranges`
+        maps range columns to inclusive (low, high) bounds.
+        """
+        where, params = self._where(dataset, categories, ranges)
+        if sort is not None and sort not in self.columns(dataset):
+            raise KeyError(f'{dataset} has no column {sort}')
+        # rowid breaks ties, so pages don't overlap when sorting by a column with repeated values
+        order = (f' ORDER BY {_quote(sort)} {"DESC" if descending else "ASC"}, rowid' if sort else ' ORDER BY rowid')
+        with self._connect() as conn:
+            return pd.read_sql_query(f'SELECT * FROM {_quote(dataset)}{where}{order} LIMIT ? OFFSET ?', conn,
+                                     params=[*params, page_size, page * page_size])
+
+
+def render(explorer, dataset, key, page_size=PAGE_SIZE):
+    """Filter & sort controls, the current page of `dataset` and a pager, drawn in Streamlit."""
+    import streamlit as st
+
+    options = explorer.options(dataset)
+    with st.expander('Filter & sort'):
+        columns = st.columns(len(options['categories']))
+        categories = {column: widget.multiselect(column.replace('_', ' ').title(), values, key=f'{key}-{column}')
+                      for widget, (column, values) in zip(columns, options['categories'].items())}
+        columns = st.columns(len(options['ranges']))
+        ranges = {}
+        for widget, (column, (low, high)) in zip(columns, options['ranges'].items()):
+            if column in YEAR_COLUMNS:
+                low, high = int(low), int(high)
+            else:
+                low, high = float(low), float(high)
+            selected = widget.slider(column.replace('_', ' ').title(), low, high, (low, high), key=f'{key}-{column}')
+            # Left at its full extent, a range doesn't filter (and so keeps rows where it is missing)
+            if selected != (low, high):
+                ranges[column] = selected
+        columns = st.columns([3, 1])
+        sort = columns[0].selectbox('Sort by', ['(original order)', *explorer.columns(dataset)], key=f'{key}-sort')
+        descending = columns[1].toggle('Descending', key=f'{key}-descending')
+
+    total = explorer.count(dataset, categories, ranges)
+    pages = max(1, -(-total // page_size))
+    # Keyed on the page count, so changing the filters goes back to the first page
+    page = st.number_input(f'Page (of {pages})', min_value=1, max_value=pages, value=1, key=f'{key}-page-{pages}') - 1
+    rows = explorer.page(dataset, categories, ranges, None if sort == '(original order)' else sort, descending,
+                         page, page_size)
+    st.dataframe(rows, hide_index=True, use_container_width=True,
+                 column_config={column: st.column_config.NumberColumn(format='%d')
+                                for column in YEAR_COLUMNS if column in rows.columns})
+    first = page * page_size
+    st.caption(f'Rows {first + 1 if total else 0:,}–{first + len(rows):,} of {total:,}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the dataset explorer database.')
+    parser.add_argument('dataset', nargs='?', choices=list(DATASETS), help='dataset to page through')
+    parser.add_argument('--where', action='append', default=[], metavar='COLUMN=VALUE',
+                        help='keep rows where a category column has this value (repeatable)')
+    parser.add_argument('--sort', help='column to sort by')
+    parser.add_argument('--descending', action='store_true')
+    parser.add_argument('--page', type=int, default=1)
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE)
+    args = parser.parse_args()
+
+    explorer = Explorer()
+    if args.dataset is None:
+        build()
+        for dataset in DATASETS:
+            print(f'{dataset}: {explorer.count(dataset):,} rows, {len(explorer.columns(dataset))} columns')
+        return
+    categories = {}
+    for condition in args.where:
+        column, value = condition.split('=', 1)
+        categories.setdefault(column, []).append(value)
+    total = explorer.count(args.dataset, categories)
+    print(f'{total:,} rows match')
+    print(explorer.page(args.dataset, categories, sort=args.sort, descending=args.descending,
+                        page=args.page - 1, page_size=args.page_size).to_string())
+
+
+if __name__ == '__main__':
+    main()
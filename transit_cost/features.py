@@ -0,0 +1,66 @@
+### The user model's features.
+# Names of the model inputs and the definitions of the interaction terms. The training
+# pipeline (transit_cost.pipeline) and the compiled schema the app scores with
+# (transit_cost.schema) both evaluate INTERACTIONS, so the two can't compute them differently.
+import numpy as np
+import pandas as pd
+
+TARGET = 'cost_real_2023_transformed'
+
+# Raw inputs that the model only sees Box-Cox transformed (after adding 1)
+TRANSFORMED_INPUTS = ['tunnel', 'at_grade', 'elevated', 'duration', 'stations']
+
+CONT_FEATS = ['end_year', 'at_grade_transformed', 'tunnel_transformed',
+              'elevated_transformed', 'duration_transformed', 'stations_transformed',
+              'tunnel_MRT_interaction', 'tunnel_asia_interaction', 'at_grade_MRT_interaction', 'at_grade_asia_interaction', 'stations_Streetcar_interaction',
+              'stations_LightRail_interaction', 'stations_MRT_interaction', 'stations_tunnel_interaction',
+              'stations_atgrade_interaction', 'stations_elevated_interaction', 'duration_tunnel_interaction',
+              'duration_atgrade_interaction', 'duration_elevated_interaction',
+              'extension_tunnel_interaction', 'extension_atgrade_interaction', 'extension_elevated_interaction']
+
+CAT_FEATS = ['region', 'sub_region', 'train_type', 'soil_type', 'city_size',
+             'country_income_class', 'precipitation_type', 'elevation_class',
+             'poverty_rate', 'temperature_category', 'city_density_type', 'project_type']
+
+# Each term is `base` times `times` (another numeric column), or `base` where the
+# categorical column `when[0]` equals `when[1]` and 0 elsewhere
+INTERACTIONS = {
+    'tunnel_MRT_interaction': {'base': 'tunnel_transformed', 'when': ['train_type', 'MRT']},
+    'at_grade_MRT_interaction': {'base': 'at_grade_transformed', 'when': ['train_type', 'MRT']},
+    'tunnel_asia_interaction': {'base': 'tunnel_transformed', 'when': ['region', 'Asia']},
+    'at_grade_asia_interaction': {'base': 'at_grade_transformed', 'when': ['region', 'Asia']},
+    'stations_Streetcar_interaction': {'base': 'stations_transformed', 'when': ['train_type', 'Streetcar']},
+    'stations_LightRail_interaction': {'base': 'stations_transformed', 'when': ['train_type', 'Light Rail']},
+    'stations_MRT_interaction': {'base': 'stations_transformed', 'when': ['train_type', 'MRT']},
+    'stations_tunnel_interaction': {'base': 'stations_transformed', 'times': 'tunnel_transformed'},
+    'stations_atgrade_interaction': {'base': 'stations_transformed', 'times': 'at_grade_transformed'},
+    'stations_elevated_interaction': {'base': 'stations_transformed', 'times': 'elevated_transformed'},
+    'duration_tunnel_interaction': {'base': 'duration_transformed', 'times': 'tunnel_transformed'},
+    'duration_atgrade_interaction': {'base': 'duration_transformed', 'times': 'at_grade_transformed'},
+    'duration_elevated_interaction': {'base': 'duration_transformed', 'times': 'elevated_transformed'},
+    'extension_tunnel_interaction': {'base': 'tunnel_transformed', 'when': ['project_type', 'Extension']},
+    'extension_atgrade_interaction': {'base': 'at_grade_transformed', 'when': ['project_type', 'Extension']},
+    'extension_elevated_interaction': {'base': 'elevated_transformed', 'when': ['project_type', 'Extension']},
+}
+
+INTERACTION_TERMS = [feat for feat in CONT_FEATS if '_interaction' in feat]
+
+
+def model_feature_order(df_user):
+    """Column order the model was trained on (df_user without the target)."""
+    return df_user.drop(columns=[TARGET]).columns
+
+
+def interaction_values(definition, columns):
+    """Values of one interaction term; `columns` maps column name to a 1-d array."""
+    base = np.asarray(columns[definition['base']], dtype=float)
+    if 'times' in definition:
+        return base * np.asarray(columns[definition['times']], dtype=float)
+    column, value = definition['when']
+    return np.where(np.asarray(columns[column]) == value, base, 0.0)
+
+
+def interaction_frame(df, definitions=INTERACTIONS):
+    """All interaction terms for a frame holding the transformed & categorical inputs."""
+    return pd.DataFrame({name: interaction_values(definition, df) for name, definition in definitions.items()},
+                        index=df.index)
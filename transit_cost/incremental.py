@@ -0,0 +1,430 @@
+### Incremental re-evaluation of the tree ensemble for one-input-at-a-time changes.
+# The blend is a weighted sum over individual trees: CatBoost's oblivious trees and the
+# ExtraTrees inside every bag. TreeEnsemble flattens a fitted model into those trees, each
+# with its weight and the preprocessed columns (one-hot columns included) it splits on.
+# IncrementalScorer keeps the per-tree outputs of the last scenario it scored together with
+# the columns on each tree's decision path for it. When the next scenario differs in a few
+# columns, only the trees whose path (or, for oblivious trees, whose splits) touch those
+# columns can change, so only they are re-traversed and the cached sum is adjusted.
+#
+# Trees are traversed in lockstep with numpy over arrays holding every tree's nodes, so
+# evaluating a subset costs one pass per tree level, not one sklearn call per tree.
+# Estimators that can't be split into trees (e.g. CatBoost with native categoricals) are
+# kept whole and re-run whenever anything changes.
+#
+# `TreeEnsemble.leaves` lists every leaf with, for each column on its path, the interval of
+# values that reaches it and the share of the training rows that took that path (what
+# transit_cost.explain computes SHAP values from).
+#
+#   python -m transit_cost.incremental    # trees per input and timings for the 'current' model
+import json
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from transit_cost.inference import blend_parts
+
+# Re-evaluate everything when a change reaches more than this fraction of the trees
+FULL_FRACTION = 0.5
+
+
+def _matrix(Xt):
+    """Float copy of preprocessed inputs, or None when they aren't all numeric."""
+    if sparse.issparse(Xt):
+        Xt = Xt.toarray()
+    try:
+        return np.asarray(Xt, dtype=float)
+    except (TypeError, ValueError):
+        return None
+
+
+class _DecisionTrees:
+    """sklearn decision trees (forests and bags of them), stacked into one node array."""
+
+    def __init__(self, trees, n_columns):
+        # trees: [(fitted tree_, global column of each local feature, weight)]
+        self.n_trees = len(trees)
+        self.weights = np.array([weight for _, _, weight in trees])
+        sizes = [tree.node_count for tree, _, _ in trees]
+        self.roots = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.intp)
+        self.depth = max(tree.max_depth for tree, _, _ in trees)
+        left, right, feature, threshold, value, cover = [], [], [], [], [], []
+        self.uses = np.zeros((self.n_trees, n_columns), dtype=bool)
+        for i, ((tree, columns, _), root) in enumerate(zip(trees, self.roots)):
+            leaf = tree.children_left == -1
+            left.append(np.where(leaf, -1, tree.children_left + root))
+            right.append(np.where(leaf, -1, tree.children_right + root))
+            feature.append(np.where(leaf, 0, columns[np.maximum(tree.feature, 0)]))
+            threshold.append(tree.threshold)
+            value.append(tree.value[:, 0, 0])
+            cover.append(tree.weighted_n_node_samples)
+            self.uses[i, feature[-1][~leaf]] = True
+        self.left, self.right, self.feature = (np.concatenate(a).astype(np.intp) for a in (left, right, feature))
+        self.threshold, self.value = np.concatenate(threshold), np.concatenate(value)
+        self.cover = np.concatenate(cover)
+
+    def evaluate(self, Xt, X, trees):
+        """(weighted outputs (rows x trees), columns on each tree's path for the last row)."""
+        # sklearn compares float32 inputs against the thresholds
+        X = X.astype(np.float32).astype(float)
+        rows = np.arange(len(X))[:, None]
+        node = np.broadcast_to(self.roots[trees], (len(X), len(trees))).copy()
+        path = np.zeros((len(trees), X.shape[1]), dtype=bool)
+        last = np.arange(len(trees))
+        while True:
+            internal = self.left[node] != -1
+            if not internal.any():
+                break
+            feature = self.feature[node]
+            path[last[internal[-1]], feature[-1][internal[-1]]] = True
+            goes_left = X[rows, feature] <= self.threshold[node]
+            node = np.where(internal, np.where(goes_left, self.left[node], self.right[node]), node)
+        return self.value[node] * self.weights[trees], path
+
+    def leaves(self):
+        """Leaf table of every tree, built breadth-first over all the trees at once."""
+        width = max(self.depth, 1)
+        node, weight = self.roots.copy(), self.weights.copy()
+        table = _empty_paths(len(node), width)
+        found = []
+        while len(node):
+            leaf = self.left[node] == -1
+            found.append((self.value[node[leaf]] * weight[leaf], {name: a[leaf] for name, a in table.items()}))
+            node, weight = node[~leaf], weight[~leaf]
+            table = {name: a[~leaf] for name, a in table.items()}
+            # A column already on the path narrows its interval; a new one takes the next slot
+            feature, threshold = self.feature[node], self.threshold[node]
+            seen = table['feature'] == feature[:, None]
+            slot = np.where(seen.any(axis=1), seen.argmax(axis=1), table['length'])
+            rows = np.arange(len(node))
+            children = []
+            for child, bound in ((self.left[node], 'hi'), (self.right[node], 'lo')):
+                branch = {name: a.copy() for name, a in table.items()}
+                branch['feature'][rows, slot] = feature
+                limit = np.minimum if bound == 'hi' else np.maximum
+                branch[bound][rows, slot] = limit(branch[bound][rows, slot], threshold)
+                branch['share'][rows, slot] *= self.cover[child] / self.cover[node]
+                branch['length'] = np.maximum(table['length'], slot + 1)
+                children.append((child, branch))
+            node = np.concatenate([child for child, _ in children])
+            weight = np.concatenate([weight, weight])
+            table = {name: np.concatenate([branch[name] for _, branch in children]) for name in table}
+        return _stack_leaves(found)
+
+
+class _ObliviousTrees:
+    """CatBoost oblivious trees over numeric features, read from the model's JSON export."""
+
+    def __init__(self, model, columns, weight, n_columns):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'model.json')
+            model.save_model(path, format='json')
+            with open(path) as f:
+                exported = json.load(f)
+        flat_index = {feat['feature_index']: feat['flat_feature_index']
+                      for feat in exported['features_info']['float_features']}
+        trees = exported['oblivious_trees']
+        depth = max(len(tree['splits']) for tree in trees)
+        self.n_trees = len(trees)
+        self.feature = np.zeros((self.n_trees, depth), dtype=np.intp)
+        # Padding levels compare against +inf, so they never set their bit
+        self.border = np.full((self.n_trees, depth), np.inf)
+        self.uses = np.zeros((self.n_trees, n_columns), dtype=bool)
+        for i, tree in enumerate(trees):
+            for level, split in enumerate(tree['splits']):
+                self.feature[i, level] = columns[flat_index[split['float_feature_index']]]
+                self.border[i, level] = split['border']
+            self.uses[i, self.feature[i, :len(tree['splits'])]] = True
+        self.offsets = np.concatenate([[0], np.cumsum([len(tree['leaf_values']) for tree in trees])[:-1]]).astype(np.intp)
+        self.leaf_values = np.concatenate([tree['leaf_values'] for tree in trees])
+        self.leaf_weights = np.concatenate([tree['leaf_weights'] for tree in trees]).astype(float)
+        self.depths = np.array([len(tree['splits']) for tree in trees])
+        scale, bias = exported.get('scale_and_bias', [1, [0]])
+        self.weight = weight * scale
+        self.bias = weight * float(np.sum(bias))
+
+    def evaluate(self, Xt, X, trees):
+        X = X.astype(np.float32).astype(float)
+        bits = X[:, self.feature[trees]] > self.border[trees]
+        leaves = (bits * (1 << np.arange(self.feature.shape[1]))).sum(axis=-1)
+        return self.leaf_values[self.offsets[trees] + leaves] * self.weight, self.uses[trees]
+
+    def leaves(self):
+        """Leaf table of every tree; leaf b of a tree has bit l of b set when x > border at level l."""
+        found = []
+        for i, depth in enumerate(self.depths):
+            n_leaves = 1 << depth
+            index = np.arange(n_leaves)
+            bits = (index[:, None] >> np.arange(depth)) & 1
+            weights = self.leaf_weights[self.offsets[i]:self.offsets[i] + n_leaves]
+            # CatBoost splits on the last level first: a leaf's node below the splits of levels
+            # `level` and up holds the training rows of the leaves that agree on those bits
+            cover = [weights.reshape(-1, 1 << level).sum(axis=1)[index >> level] for level in range(depth + 1)]
+            table = _empty_paths(n_leaves, max(depth, 1))
+            features = list(dict.fromkeys(self.feature[i, :depth]))
+            for slot, column in enumerate(features):
+                table['feature'][:, slot] = column
+                for level in np.flatnonzero(self.feature[i, :depth] == column):
+                    border = self.border[i, level]
+                    above = bits[:, level] == 1
+                    table['lo'][above, slot] = np.maximum(table['lo'][above, slot], border)
+                    table['hi'][~above, slot] = np.minimum(table['hi'][~above, slot], border)
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        ratio = np.where(cover[level + 1] > 0, cover[level] / cover[level + 1], 0.0)
+                    table['share'][:, slot] *= ratio
+            table['length'][:] = len(features)
+            found.append((self.leaf_values[self.offsets[i]:self.offsets[i] + n_leaves] * self.weight, table))
+        return _stack_leaves(found)
+
+
+class _Whole:
+    """An estimator scored as a single unit that depends on every column it sees."""
+
+    def __init__(self, model, columns, weight, n_columns):
+        self.model = model
+        # Only estimators inside a feature-subsampling bag see a subset of the columns
+        self.subset = None if np.array_equal(columns, np.arange(n_columns)) else columns
+        self.weight = weight
+        self.n_trees = 1
+        self.uses = np.zeros((1, n_columns), dtype=bool)
+        self.uses[0, columns] = True
+
+    def evaluate(self, Xt, X, trees):
+        if self.subset is not None:
+            Xt = Xt.iloc[:, self.subset] if isinstance(Xt, pd.DataFrame) else Xt[:, self.subset]
+        return self.weight * np.asarray(self.model.predict(Xt), dtype=float)[:, None], self.uses[trees]
+
+    def leaves(self):
+        raise ValueError(f'{type(self.model).__name__} can\'t be split into trees')
+
+
+def _empty_paths(n_leaves, width):
+    # Unused slots: no column, every value inside the interval, the whole cover
+    return {'feature': np.full((n_leaves, width), -1, dtype=np.intp), 'lo': np.full((n_leaves, width), -np.inf),
+            'hi': np.full((n_leaves, width), np.inf), 'share': np.ones((n_leaves, width)),
+            'length': np.zeros(n_leaves, dtype=np.intp)}
+
+
+def _stack_leaves(found):
+    """One leaf table out of [(values, path table)], padded to the widest path."""
+    width = max(table['feature'].shape[1] for _, table in found)
+    padded = _empty_paths(sum(len(values) for values, _ in found), width)
+    start = 0
+    for values, table in found:
+        stop = start + len(values)
+        for name in padded:
+            a = table[name]
+            if a.ndim == 2:
+                padded[name][start:stop, :a.shape[1]] = a
+            else:
+                padded[name][start:stop] = a
+        start = stop
+    padded['value'] = np.concatenate([values for values, _ in found])
+    return padded
+
+
+def _is_oblivious(model):
+    return (type(model).__name__ == 'CatBoostRegressor' and not model.get_cat_feature_indices()
+            and model.get_param('grow_policy') in (None, 'SymmetricTree'))
+
+
+class TreeEnsemble:
+    """Every tree of a fitted (blended) model, flattened with its weight and the columns it uses."""
+
+    def __init__(self, estimator, n_columns):
+        self.n_columns = n_columns
+        self.bias = 0.0
+        trees, groups = [], []
+        self._flatten(estimator, np.arange(n_columns), 1.0, trees, groups)
+        if trees:
+            groups.insert(0, _DecisionTrees(trees, n_columns))
+        self.groups = groups
+        self.bias += sum(getattr(group, 'bias', 0.0) for group in groups)
+        bounds = np.cumsum([0] + [group.n_trees for group in groups])
+        self.spans = list(zip(bounds[:-1], bounds[1:]))
+        self.n_trees = int(bounds[-1])
+        self.uses = np.vstack([group.uses for group in groups])
+
+    def _flatten(self, model, columns, weight, trees, groups):
+        name = type(model).__name__
+        if name == 'VotingRegressor':
+            weights = model.weights if model.weights is not None else [1] * len(model.estimators_)
+            for est, w in zip(model.estimators_, weights):
+                self._flatten(est, columns, weight * w / sum(weights), trees, groups)
+        elif name == 'BaggingRegressor':
+            for est, features in zip(model.estimators_, model.estimators_features_):
+                self._flatten(est, columns[features], weight / len(model.estimators_), trees, groups)
+        elif name in ('ExtraTreesRegressor', 'RandomForestRegressor'):
+            for est in model.estimators_:
+                self._flatten(est, columns, weight / len(model.estimators_), trees, groups)
+        elif name in ('DecisionTreeRegressor', 'ExtraTreeRegressor'):
+            trees.append((model.tree_, columns, weight))
+        elif _is_oblivious(model):
+            groups.append(_ObliviousTrees(model, columns, weight, self.n_columns))
+        else:
+            groups.append(_Whole(model, columns, weight, self.n_columns))
+
+    def leaves(self):
+        """Every leaf of every tree, as a dict of arrays with one row per leaf:
+
+        value    the leaf's output times its tree's weight
+        feature  the distinct columns on its path (slots past `length` hold -1)
+        lo, hi   the interval (lo, hi] of each column's values that reaches the leaf
+        share    the share of the training rows that followed the path's splits on that column
+        length   the number of columns on the path
+        """
+        return _stack_leaves([(table['value'], table) for table in (group.leaves() for group in self.groups)])
+
+    def evaluate(self, Xt, X, trees=None):
+        """(weighted per-tree outputs, path columns of the last row) for global tree indices `trees`."""
+        trees = np.arange(self.n_trees) if trees is None else np.asarray(trees)
+        outputs = np.empty((X.shape[0], len(trees)))
+        paths = np.empty((len(trees), self.n_columns), dtype=bool)
+        for group, (start, stop) in zip(self.groups, self.spans):
+            mine = (trees >= start) & (trees < stop)
+            if mine.any():
+                outputs[:, mine], paths[mine] = group.evaluate(Xt, X, trees[mine] - start)
+        return outputs, paths
+
+
+class IncrementalScorer:
+    """Predictions of a fitted model that only re-traverse the trees reached by what changed.
+
+    The per-tree outputs of the last row scored are kept; a call whose rows differ from it in
+    a few columns re-evaluates the affected trees and adjusts the cached sum.
+    """
+
+    def __init__(self, model, full_fraction=FULL_FRACTION):
+        self.preprocess, self.estimator = blend_parts(model)
+        self.full_fraction = full_fraction
+        self.ensemble = None
+        self._last = None
+        self._lock = threading.Lock()
+        self.trees_evaluated = 0
+        self.trees_skipped = 0
+
+    def _preprocessed(self, features):
+        Xt = features if self.preprocess is None else self.preprocess.transform(features)
+        X = _matrix(Xt)
+        if X is None:
+            # Not numeric (e.g. categoricals passed to CatBoost as is): compare values as objects
+            X = np.asarray(Xt, dtype=object)
+        return Xt, X
+
+    def reset(self):
+        with self._lock:
+            self._last = None
+
+    def predict(self, features):
+        """Model output (Box-Cox space of the target) for a frame of model inputs."""
+        Xt, X = self._preprocessed(features)
+        with self._lock:
+            if self.ensemble is None:
+                self.ensemble = TreeEnsemble(self.estimator, X.shape[1])
+            trees = None
+            if self._last is not None:
+                last_X, last_outputs, last_paths = self._last
+                changed = ~((X == last_X) | (pd.isna(X) & pd.isna(last_X))).all(axis=0)
+                affected = np.flatnonzero(last_paths[:, changed].any(axis=1))
+                if len(affected) <= self.full_fraction * self.ensemble.n_trees:
+                    trees = affected
+
+            if trees is None:
+                outputs, paths = self.ensemble.evaluate(Xt, X)
+                predictions = self.ensemble.bias + outputs.sum(axis=1)
+                self._last = (X[-1], outputs[-1], paths)
+                self.trees_evaluated += outputs.size
+            else:
+                outputs, paths = self.ensemble.evaluate(Xt, X, trees)
+                unchanged = last_outputs.sum() - last_outputs[trees].sum()
+                predictions = self.ensemble.bias + unchanged + outputs.sum(axis=1)
+                last_outputs, last_paths = last_outputs.copy(), last_paths.copy()
+                last_outputs[trees], last_paths[trees] = outputs[-1], paths
+                self._last = (X[-1], last_outputs, last_paths)
+                self.trees_evaluated += outputs.size
+                self.trees_skipped += len(X) * (self.ensemble.n_trees - len(trees))
+            return predictions
+
+    def trees_by_input(self, features):
+        """Number of trees splitting on each model input anywhere (one-hot columns folded in)."""
+        Xt, X = self._preprocessed(features.iloc[:1])
+        ensemble = self.ensemble or TreeEnsemble(self.estimator, X.shape[1])
+        return pd.Series({name: int(ensemble.uses[:, columns].any(axis=1).sum())
+                          for name, columns in input_columns(self.preprocess, features).items()})
+
+
+def input_columns(preprocess, features):
+    """{model input column: preprocessed columns it feeds}, found by perturbing each input.
+
+    `features` should be a frame with varied rows (e.g. the training data); each input is
+    replaced by its values shifted one row and the preprocessed columns that change are its.
+    """
+    if preprocess is None:
+        return {name: [i] for i, name in enumerate(features.columns)}
+    base = _matrix(preprocess.transform(features))
+    mapping = {}
+    for name in features.columns:
+        shifted = features.copy()
+        shifted[name] = np.roll(features[name].to_numpy(), 1)
+        changed = ~np.isclose(_matrix(preprocess.transform(shifted)), base, equal_nan=True).all(axis=0)
+        mapping[name] = np.flatnonzero(changed).tolist()
+    return mapping
+
+
+### Command line
+def benchmark(model, schema, raw, changes, repeats=20):
+    """Full vs incremental scoring time for one-input changes to the scenario `raw` (one row)."""
+    scorer = IncrementalScorer(model)
+    base = schema.build(raw)
+    scorer.predict(base)
+    rows = []
+    for name, values in changes.items():
+        scenarios = [schema.build(raw.assign(**{name: value})) for value in values]
+        start = time.perf_counter()
+        for _ in range(repeats):
+            full = [model.predict(scenario)[0] for scenario in scenarios]
+        full_seconds = (time.perf_counter() - start) / repeats / len(scenarios)
+        evaluated = scorer.trees_evaluated
+        start = time.perf_counter()
+        for _ in range(repeats):
+            incremental = [scorer.predict(scenario)[0] for scenario in scenarios]
+        incremental_seconds = (time.perf_counter() - start) / repeats / len(scenarios)
+        rows.append({'input': name, 'full (ms)': 1000 * full_seconds, 'incremental (ms)': 1000 * incremental_seconds,
+                     'trees re-evaluated': (scorer.trees_evaluated - evaluated) / repeats / len(scenarios),
+                     'max difference': float(np.abs(np.subtract(full, incremental)).max())})
+    return pd.DataFrame(rows).set_index('input'), scorer.ensemble.n_trees
+
+
+def main():
+    import pickle
+
+    from transit_cost.features import TARGET
+    from transit_cost.inference import load_model
+    from transit_cost.paths import PICKLES_DIR
+    from transit_cost.registry import resolve
+    from transit_cost.schema import schema_for
+
+    entry = resolve()
+    model = load_model(entry['artifact'])
+    schema = schema_for(entry)
+    with open(PICKLES_DIR / 'data_user_unseen.pkl', 'rb') as f:
+        validation = pickle.load(f)
+    raw = schema.raw_inputs(validation.drop(columns=[TARGET]).iloc[:1]).reset_index(drop=True)
+    changes = {
+        'soil_type': [value for value in schema.categories['soil_type'] if value != raw.at[0, 'soil_type']][:4],
+        'stations': [raw.at[0, 'stations'] + step for step in (1, 2, 3, 4)],
+        'tunnel': [raw.at[0, 'tunnel'] * scale for scale in (0.5, 0.8, 1.2, 1.5)],
+        'sub_region': [value for value in schema.categories['sub_region'] if value != raw.at[0, 'sub_region']][:4],
+    }
+    report, n_trees = benchmark(model, schema, raw, changes)
+    print(f'{n_trees} trees')
+    print(report.to_string(float_format='{:.3g}'.format))
+
+
+if __name__ == '__main__':
+    main()
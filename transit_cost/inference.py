@@ -0,0 +1,82 @@
+### Inference-only entry point for the user model.
+# pycaret's `save_model` writes the fitted preprocessing + estimator pipeline with joblib,
+# so scoring only needs joblib to read it back. Unpickling pulls in the pipeline and
+# transformer classes it references, but not `pycaret.regression`, whose import sets up
+# the whole experiment machinery (model containers, soft-dependency probing for cuml, ...).
+#
+# Run `python -m transit_cost.inference` to measure import and load times.
+import subprocess
+import sys
+import time
+
+import joblib
+import pandas as pd
+
+from transit_cost.boxcox import inv_boxcox
+from transit_cost.paths import MODELS_DIR, ROOT
+
+DEFAULT_MODEL_PATH = MODELS_DIR / 'finalized_user_model.pkl'
+
+
+def load_model(path=DEFAULT_MODEL_PATH):
+    """Deserialize a pipeline written by pycaret's `save_model` (path includes `.pkl`)."""
+    return joblib.load(path)
+
+
+def blend_parts(model):
+    """(fitted preprocessing or None, final estimator) of a finalized pycaret pipeline."""
+    if hasattr(model, 'steps'):
+        return model[:-1], model.steps[-1][1]
+    return None, model
+
+
+def predict_transformed(model, features):
+    """Model output in the Box-Cox space of the target."""
+    return model.predict(features)
+
+
+def predict_cost(model, raw, schema):
+    """Predicted cost in millions of 2023 USD for each raw scenario (`schema` is a FeatureSchema)."""
+    return inv_boxcox(predict_transformed(model, schema.build(raw)), schema.target_lambda)
+
+
+### Measuring cold start
+def measure(statement, setup=''):
+    """Seconds taken by `statement` in a fresh interpreter (nothing cached in sys.modules)."""
+    code = (f'{setup}\nimport time\nt = time.perf_counter()\n{statement}\n'
+            f'print(time.perf_counter() - t)')
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=ROOT)
+    if result.returncode != 0:
+        return None
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def import_report(model_path=DEFAULT_MODEL_PATH):
+    """Import/load timings for the slim runtime next to the imports the app used to do."""
+    statements = {
+        'transit_cost.inference': 'import transit_cost.inference',
+        'load_model (slim)': f'transit_cost.inference.load_model(r"{model_path}")',
+        'pycaret.regression': 'from pycaret.regression import *',
+        'IPython.display': 'from IPython.display import display, HTML',
+        'matplotlib': 'import matplotlib',
+        'plotly.express': 'import plotly.express',
+        'plotly.figure_factory': 'import plotly.figure_factory',
+        'scipy.stats': 'from scipy.stats import boxcox',
+    }
+    setups = {'load_model (slim)': 'import transit_cost.inference'}
+    rows = []
+    for name, statement in statements.items():
+        seconds = measure(statement, setups.get(name, ''))
+        rows.append({'step': name, 'seconds': seconds})
+    return pd.DataFrame(rows)
+
+
+def main():
+    start = time.perf_counter()
+    report = import_report()
+    print(report.to_string(index=False, na_rep='unavailable'))
+    print(f'(measured in {time.perf_counter() - start:.1f}s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+### Background scoring for the live calculator.
+# Every widget change reruns the calculator fragment and submits the current inputs here.
+# A request waits `debounce` seconds before it is scored; if the same session submits again
+# in that window the older request is cancelled, so dragging a slider only scores where it
+# lands. Requests from different sessions that are due together go to the model as one
+# batch, and recent results are kept in a small LRU so revisiting a scenario is free. Every
+# cost travels with the model version that produced it, so nothing downstream has to ask the
+# model handle which version that was.
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import pandas as pd
+
+from transit_cost.boxcox import inv_boxcox
+from transit_cost.incremental import IncrementalScorer
+from transit_cost.profiling import section
+
+
+class PredictionWorker:
+    """Debounced, cancellable predictions on a daemon thread.
+
+    `predict_batch` takes a frame of raw scenarios and returns (one cost per row, the model
+    version that scored them); futures resolve to (cost, version). If given,
+    `on_result(inputs, cost, version, latency, cached)` is called for every answered request,
+    with the seconds from submitting it to its result.
+    """
+
+    def __init__(self, predict_batch, debounce=0.15, cache_size=512, on_result=None):
+        self._predict_batch = predict_batch
+        self.debounce = debounce
+        self.cache_size = cache_size
+        self.on_result = on_result
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='prediction-worker', daemon=True)
+        self._thread.start()
+
+    def submit(self, session_key, inputs, record=True):
+        """Future for the (cost, model version) of `inputs`; supersedes the session's previous request.
+
+        `record=False` keeps the request out of `on_result` (e.g. warm-up traffic).
+        """
+        cache_key = tuple(sorted(inputs.items()))
+        future = Future()
+        with self._cond:
+            stale = self._pending.pop(session_key, None)
+            if stale is not None:
+                stale[2].cancel()
+            cached = self._cache.get(cache_key)
+            if cached is None:
+                self._pending[session_key] = (cache_key, dict(inputs), future, time.monotonic() + self.debounce, record)
+                self._cond.notify()
+                return future
+            self._cache.move_to_end(cache_key)
+        future.set_result(cached)
+        if record and self.on_result is not None:
+            self.on_result(inputs, *cached, 0.0, True)
+        return future
+
+    def clear_cache(self):
+        with self._cond:
+            self._cache.clear()
+
+    def _take_due(self):
+        # Called with the condition held; blocks until at least one request has settled
+        while True:
+            now = time.monotonic()
+            due = [key for key, request in self._pending.items() if request[3] <= now]
+            if due:
+                return [self._pending.pop(key) for key in due]
+            if self._pending:
+                self._cond.wait(min(request[3] for request in self._pending.values()) - now)
+            else:
+                self._cond.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batch = self._take_due()
+            batch = [request for request in batch if request[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                costs, version = self._predict_batch(pd.DataFrame([request[1] for request in batch]))
+            except Exception as exc:
+                for request in batch:
+                    request[2].set_exception(exc)
+                continue
+            with self._cond:
+                for (cache_key, _, _, _, _), cost in zip(batch, costs):
+                    self._cache[cache_key] = (float(cost), version)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            for request, cost in zip(batch, costs):
+                request[2].set_result((float(cost), version))
+            if self.on_result is not None:
+                answered = time.monotonic()
+                for (_, inputs, _, due, record), cost in zip(batch, costs):
+                    if record:
+                        self.on_result(inputs, float(cost), version, answered - (due - self.debounce), False)
+
+
+def batch_predictor(model_handle):
+    """Function scoring a frame of raw scenarios with whichever version `model_handle` serves.
+
+    Returns (costs, version). Scenarios are scored incrementally against the previous call (transit_cost.incremental),
+    so changing one input only re-evaluates the trees it reaches.
+    """
+    scorers = {}
+    lock = threading.Lock()
+
+    def predict_batch(raw):
+        entry, model, schema = model_handle.served()
+        version = entry['version']
+        with lock:
+            if version not in scorers:
+                scorers.clear()
+                scorers[version] = IncrementalScorer(model)
+            scorer = scorers[version]
+        with section('feature building'):
+            features = schema.build(raw)
+        with section('prediction'):
+            return inv_boxcox(scorer.predict(features), schema.target_lambda), version
+    return predict_batch
+
+
+def worker_for(model_handle, telemetry=None, **kwargs):
+    """PredictionWorker scoring with whichever model version `model_handle` serves.
+
+    Answered requests are recorded to `telemetry` (a transit_cost.telemetry.PredictionLog) if given.
+    """
+    if telemetry is not None:
+        kwargs['on_result'] = lambda inputs, cost, version, latency, cached: telemetry.record(
+            inputs, cost, latency, version, cached)
+    worker = PredictionWorker(batch_predictor(model_handle), **kwargs)
+    # Cached costs belong to the old model once a new version is promoted
+    model_handle.on_swap(lambda old_version, new_version: worker.clear_cache())
+    return worker
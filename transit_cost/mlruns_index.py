@@ -0,0 +1,198 @@
+### Columnar index over the MLflow file store in mlruns/.
+# Every run directory keeps each param, metric and tag in its own small file, so a
+# leaderboard query over ~1,500 runs means tens of thousands of reads. The indexer walks the
+# store once and compacts each run into one row of a DataFrame (columns named like
+# MLflow's search_runs: params.*, metrics.* holding the final value, tags.*) saved to
+# pickles/mlruns_index.pkl. Later runs only re-read directories whose mtimes changed.
+#
+#   python -m transit_cost.mlruns_index            # build/refresh the index
+#   python -m transit_cost.mlruns_index --top 10   # ... and print the best runs by MAE
+import argparse
+import os
+import pickle
+import time
+
+import pandas as pd
+
+from transit_cost.paths import PICKLES_DIR, ROOT
+
+MLRUNS_DIR = ROOT / 'mlruns'
+INDEX_PATH = PICKLES_DIR / 'mlruns_index.pkl'
+
+METRICS = ['MAE', 'MSE', 'RMSE', 'R2', 'RMSLE', 'MAPE']
+
+
+def _read_meta(path):
+    """Top-level scalar fields of an MLflow meta.yaml."""
+    meta = {}
+    with open(path) as f:
+        for line in f:
+            if line.startswith((' ', '-')) or ':' not in line:
+                continue
+            key, value = line.split(':', 1)
+            meta[key.strip()] = value.strip().strip("'")
+    return meta
+
+
+def _read_dir(path):
+    values = {}
+    if os.path.isdir(path):
+        for entry in os.scandir(path):
+            if entry.is_file():
+                with open(entry.path) as f:
+                    values[entry.name] = f.read()
+    return values
+
+
+def _final_metric(text):
+    # Lines are "timestamp value step"; the final value is the one logged at the last step
+    last = None
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) >= 2:
+            step = int(parts[2]) if len(parts) > 2 else 0
+            if last is None or step >= last[0]:
+                last = (step, float(parts[1]))
+    return None if last is None else last[1]
+
+
+def run_signature(run_dir):
+    """Latest mtime of anything in the run that changes when MLflow logs to it."""
+    stamps = []
+    for name in ('meta.yaml', 'params', 'metrics', 'tags'):
+        path = os.path.join(run_dir, name)
+        if os.path.exists(path):
+            stamps.append(os.stat(path).st_mtime_ns)
+    metrics_dir = os.path.join(run_dir, 'metrics')
+    if os.path.isdir(metrics_dir):
+        # Metric files are appended to, which doesn't touch the directory mtime
+        stamps.extend(entry.stat().st_mtime_ns for entry in os.scandir(metrics_dir))
+    return max(stamps, default=0)
+
+
+def read_run(run_dir, experiment_id, experiment_name):
+    meta = _read_meta(os.path.join(run_dir, 'meta.yaml'))
+    row = {
+        'run_id': meta.get('run_id', os.path.basename(run_dir)),
+        'experiment_id': experiment_id,
+        'experiment_name': experiment_name,
+        'run_name': meta.get('run_name'),
+        'status': meta.get('status'),
+        'lifecycle_stage': meta.get('lifecycle_stage'),
+        'start_time': pd.to_datetime(int(meta['start_time']), unit='ms') if meta.get('start_time', 'null') != 'null' else pd.NaT,
+        'end_time': pd.to_datetime(int(meta['end_time']), unit='ms') if meta.get('end_time', 'null') != 'null' else pd.NaT,
+    }
+    for name, text in _read_dir(os.path.join(run_dir, 'metrics')).items():
+        row[f'metrics.{name}'] = _final_metric(text)
+    for name, text in _read_dir(os.path.join(run_dir, 'params')).items():
+        row[f'params.{name}'] = text
+    for name, text in _read_dir(os.path.join(run_dir, 'tags')).items():
+        row[f'tags.{name}'] = text
+    return row
+
+
+def load_index(index_path=INDEX_PATH):
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def build_index(mlruns_dir=MLRUNS_DIR, index_path=INDEX_PATH):
+    """Refresh the index, re-reading only new or changed runs. Returns (index, stats)."""
+    previous = load_index(index_path)
+    signatures = {} if previous is None else dict(zip(previous['run_id'], previous['_signature']))
+    kept, rows, seen = [], [], set()
+
+    for experiment in sorted(os.scandir(mlruns_dir), key=lambda entry: entry.name):
+        if not experiment.is_dir() or experiment.name.startswith('.'):
+            continue
+        meta_path = os.path.join(experiment.path, 'meta.yaml')
+        experiment_name = _read_meta(meta_path).get('name') if os.path.exists(meta_path) else None
+        for run in os.scandir(experiment.path):
+            if not run.is_dir() or not os.path.exists(os.path.join(run.path, 'meta.yaml')):
+                continue
+            seen.add(run.name)
+            signature = run_signature(run.path)
+            if signatures.get(run.name) == signature:
+                kept.append(run.name)
+                continue
+            row = read_run(run.path, experiment.name, experiment_name)
+            row['_signature'] = signature
+            rows.append(row)
+
+    frames = []
+    if previous is not None and kept:
+        frames.append(previous[previous['run_id'].isin(kept)])
+    if rows:
+        frames.append(pd.DataFrame(rows))
+    index = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['run_id', '_signature'])
+
+    # Fixed column order: run fields, then metrics, params & tags alphabetically
+    fixed = [col for col in index.columns if '.' not in col and col != '_signature']
+    dotted = sorted(col for col in index.columns if '.' in col)
+    index = index[fixed + dotted + ['_signature']].sort_values('start_time', ignore_index=True)
+    # Params & tags repeat across the runs of a session; categoricals keep the file small
+    for col in dotted:
+        if not col.startswith('metrics.'):
+            index[col] = index[col].astype(str).where(index[col].notna()).astype('category')
+
+    with open(index_path, 'wb') as f:
+        pickle.dump(index, f)
+    stats = {'runs': len(index), 'read': len(rows), 'unchanged': len(kept),
+             'removed': 0 if previous is None else len(set(previous['run_id']) - seen)}
+    return index, stats
+
+
+def leaderboard(index, metric='MAE', ascending=True, per='tags.mlflow.runName', session=None):
+    """Best run for each model (or other `per` column) by `metric`, optionally within one
+    pycaret setup() session (tags.USI)."""
+    runs = index.dropna(subset=[f'metrics.{metric}'])
+    if session is not None:
+        runs = runs[runs['tags.USI'] == session]
+    runs = runs.sort_values(f'metrics.{metric}', ascending=ascending)
+    if per is not None:
+        runs = runs.drop_duplicates(per)
+    columns = [col for col in [per, 'experiment_name', 'start_time'] if col is not None]
+    columns += [f'metrics.{name}' for name in METRICS if f'metrics.{name}' in runs.columns]
+    board = runs[columns].rename(columns=lambda col: col.split('.', 1)[-1])
+    return board.rename(columns={'mlflow.runName': 'Model', 'experiment_name': 'Experiment', 'start_time': 'Run Date'})
+
+
+def sessions(index, metric='MAE'):
+    """One row per pycaret setup() session with its best model, newest first.
+
+    Metrics are only comparable within a session; some sessions were scored on the
+    Box-Cox transformed target and others in millions of USD.
+    """
+    runs = index.dropna(subset=[f'metrics.{metric}']).sort_values(f'metrics.{metric}')
+    best = runs.drop_duplicates('tags.USI').set_index('tags.USI')
+    summary = pd.DataFrame({
+        'Session': best.index,
+        'Started': runs.groupby('tags.USI')['start_time'].min().reindex(best.index).values,
+        'Runs': runs.groupby('tags.USI').size().reindex(best.index).values,
+        'Best Model': best['tags.mlflow.runName'].values,
+    })
+    for name in METRICS:
+        if f'metrics.{name}' in best.columns:
+            summary[name] = best[f'metrics.{name}'].values
+    return summary.sort_values('Started', ascending=False, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index the mlruns/ file store into a single table.')
+    parser.add_argument('--mlruns', default=str(MLRUNS_DIR))
+    parser.add_argument('--out', default=str(INDEX_PATH))
+    parser.add_argument('--top', type=int, default=0, help='print the N best models by MAE')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    index, stats = build_index(args.mlruns, args.out)
+    print(f"{stats['runs']} runs indexed ({stats['read']} read, {stats['unchanged']} unchanged, "
+          f"{stats['removed']} removed) in {time.perf_counter() - start:.2f}s")
+    if args.top:
+        print(leaderboard(index).head(args.top).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,8 @@
+### Locations of the repo's artifacts, resolved relative to the repo root so
+### scripts work no matter which directory they are launched from.
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+PICKLES_DIR = ROOT / 'pickles'
+MODELS_DIR = ROOT / 'models'
+DATA_DIR = ROOT / 'Data'
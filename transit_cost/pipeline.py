@@ -0,0 +1,663 @@
+### Scripted, cached version of the notebook pipeline (02 -> 05 -> 06 -> 10).
+# Each stage is a plain function of its upstream outputs and its parameters. A stage's cache
+# key hashes the module defining it (so the helpers and constants it uses too), its
+# parameters, the keys of the stages it reads and the contents of any other modules and files
+# it reads, so a stage only re-runs when one of those changes: editing a bucketing threshold
+# re-runs that bucket and what is built from it, nothing upstream.
+# Independent stages (e.g. the eight categorical buckets) run in parallel threads.
+#
+# Enrichment (climate, soil, population, GDP, ... from notebook 04, which isn't in the
+# repo) is cached per (country, city, start_year, end_year) in a store seeded from
+# pickles/df.pkl, so new rows only need the new keys filled. New keys get population,
+# area_km and union_density from transit_cost.entities; the rest of notebook 04's lookups
+# aren't in the repo, so until they're plugged in those keys are listed, with the values
+# found so far, in .pipeline_cache/pending_enrichment.csv and left out downstream, the same
+# way the notebooks drop rows with missing values.
+#
+#   python -m transit_cost.pipeline                 # build df_user and the train/unseen split
+#   python -m transit_cost.pipeline --fit           # ... and fit the blended user model
+#   python -m transit_cost.pipeline --fit --distill # ... and distill it (transit_cost.distill)
+#   python -m transit_cost.pipeline --fit --explain # ... and compute its SHAP values (transit_cost.explain)
+#   python -m transit_cost.pipeline --publish       # write the results to pickles/pipeline/
+#
+# Published frames sit next to, not over, the curated pickles the app and notebooks read:
+# the enrichment here approximates notebook 04 and fits Box-Cox lambdas for fewer columns.
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+
+from transit_cost.boxcox import boxcox
+from transit_cost.buckets import BUCKET_SPECS, SOIL_GROUPS, bucket, soil_type
+from transit_cost.features import CAT_FEATS, CONT_FEATS, INTERACTIONS, TARGET, interaction_frame, model_feature_order
+from transit_cost.paths import DATA_DIR, PICKLES_DIR, ROOT
+from transit_cost.schema import SCHEMA_PATH, compile_schema, save_schema
+
+CACHE_DIR = ROOT / '.pipeline_cache'
+COSTS_CSV = DATA_DIR / 'TransitCostData' / 'costs.csv'
+ENRICHED_SEED = PICKLES_DIR / 'df.pkl'
+SOIL_TABLE = PICKLES_DIR / 'df_soil.pkl'
+PUBLISH_DIR = PICKLES_DIR / 'pipeline'
+# Modules stages call into; their code is part of those stages' keys
+FEATURES_MODULE = ROOT / 'transit_cost' / 'features.py'
+BUCKETS_MODULE = ROOT / 'transit_cost' / 'buckets.py'
+SCHEMA_MODULE = ROOT / 'transit_cost' / 'schema.py'
+ENTITIES_MODULE = ROOT / 'transit_cost' / 'entities.py'
+BOXCOX_MODULE = ROOT / 'transit_cost' / 'boxcox.py'
+
+STAGES = {}
+
+
+class Stage:
+    def __init__(self, name, func, deps, params, sources):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.params = params
+        self.sources = tuple(sources)
+        # Stages that keep state besides their output get the running pipeline's cache dir
+        self.takes_cache_dir = 'cache_dir' in inspect.signature(func).parameters
+
+    def __call__(self, inputs, cache_dir=CACHE_DIR):
+        context = {'cache_dir': cache_dir} if self.takes_cache_dir else {}
+        return self.func(**inputs, **self.params, **context)
+
+
+def stage(deps=(), sources=(), **params):
+    """Register a pipeline stage; the function name is the stage name."""
+    def register(func):
+        STAGES[func.__name__] = Stage(func.__name__, func, deps, params, sources)
+        return func
+    return register
+
+
+### Notebook 02: cleaning
+COLUMN_NAMES = {
+    'ID': 'id', 'Country': 'country', 'City': 'city', 'Line': 'line', 'Phase': 'phase',
+    'Start year': 'start_year', 'End year': 'end_year', 'RR?': 'rr?', 'Length': 'length',
+    'TunnelPer': 'tunnel_per', 'Tunnel': 'tunnel', 'Elevated': 'elevated', 'Atgrade': 'at_grade',
+    'Stations': 'stations', 'Platform Length (Meters)': 'platform_len', 'Max Speed (km/hr)': 'max_speed',
+    'Track Gauge (mm)': 'track_gauge', 'Overhead?': 'overhead?', 'Source1': 'source_1', 'Cost': 'cost',
+    'Currency': 'currency', 'Year': 'year', 'PPP rate': 'ppp_rate', 'Real cost': 'cost_real',
+    'Cost/km (Millions)': 'cost_km', 'Cheap?': 'cheap', 'Clength': 'c_length', 'Ctunnel': 'c_tunnel',
+    'Anglo?': 'anglo', 'Inflation Index': 'inflation_index', 'Cost/km (2023 $)': 'cost_km_2023',
+    'Source2': 'source_2', 'Reference': 'reference', 'TrainType': 'train_type',
+    'Real cost (2023 $)': 'cost_real_2023',
+}
+# Dropped while cleaning; every other renamed column, and project_type, is read downstream
+DROPPED_COLUMNS = ['source_1', 'cheap', 'source_2', 'reference', 'platform_len']
+# Raw columns the pipeline reads (the id column is bookkeeping and may be 'id' or 'ID')
+CONSUMED_COLUMNS = [*(raw for raw, name in COLUMN_NAMES.items() if name not in DROPPED_COLUMNS and name != 'id'),
+                    'project_type']
+
+# Projects are identified by (country, city, line, phase), with a running count to tell apart
+# the few that share all four (transit_cost.refresh matches snapshots on the same key)
+PROJECT_KEY = ['Country', 'City', 'Line', 'Phase']
+PROJECT_KEY_NAMES = ['country', 'city', 'line', 'phase', 'occurrence']
+
+# Corrections notebook 02 made by hand after checking each project, by project key
+MANUAL_FIXES = [
+    (('US', 'Washington', 'Red Line', 'Wheaton to Glenmont', 0), {'tunnel': 2.5}),
+    (('IN', 'Pune', 'Line 3', '', 0), {'rr?': 1}),
+    (('SA', 'Mecca', 'Mecca Metro', '', 0), {'rr?': 1}),
+    (('JP', 'Tokyo', 'Monorail to Tokyo Station', '', 0), {'stations': 0}),
+    (('CN', 'Shanghai', 'Line 9', 'Phase 3', 0), {'stations': 1}),
+    (('KR', 'Seoul', 'GTX A', '', 0), {'stations': 2}),
+    (('CN', 'Guangzhou', 'Line 28', '', 0), {'stations': 4}),
+    (('CN', 'Shenzhen', 'Line 8', 'Phase 3', 0), {'stations': 7}),
+    (('CN', 'Guangzhou', 'Line 7', 'Phase 1', 0), {'stations': 7}),
+    (('CN', 'Guangzhou', 'Nansha-Zhuhai (Zhongshan) intercity (Line 18)', '', 0), {'stations': 7}),
+    (('CN', 'Guangzhou', 'Line 22', 'Northern Extension', 0), {'stations': 8}),
+    (('CN', 'Guangzhou', 'Line 6', 'Phase 3', 0), {'stations': 10}),
+    (('CN', 'Guangzhou', 'Line 9', '', 0), {'stations': 10}),
+    (('EG', 'Cairo', 'Line 5', '', 0), {'stations': 10}),
+    (('CN', 'Putian', 'F2 Line', '', 0), {'stations': 10}),
+    (('CN', 'Shanghai', 'Line 16', '', 0), {'stations': 13}),
+    (('CN', 'Nanjing', 'Line 4', 'Phase 1', 0), {'stations': 18}),
+    (('BH', 'Bahrain', 'Red & Blue', 'Phase 2', 0), {'stations': 18}),
+    (('SA', 'Ad Dammam', 'Dammam Metro (a-Sharqiya)', '', 0), {'stations': 18}),
+    (('CN', 'Shanghai', 'Line 3', '', 0), {'stations': 19}),
+    (('EG', 'Cairo', 'Line 6', 'All Phases', 0), {'stations': 26}),
+    (('CN', 'Xuzhou', 'Lines 1, 2 and 3', 'Phase 1', 0), {'stations': 54}),
+    (('QA', 'Doha', 'Doha Metro', '', 0), {'stations': 54}),
+    (('CN', 'Shenzhen', 'Line 11', 'Phase 2', 0), {'start_year': 2016, 'end_year': 2020}),
+    (('CN', 'Shenzhen', 'Line 7', '', 0), {'start_year': 2016, 'end_year': 2020}),
+    (('AR', 'Mendoza', 'Metrotranvia', 'Phase 2', 0), {'start_year': 2012, 'end_year': 2014}),
+    (('BR', 'Rio de Janeiro', 'Line 1', 'Extension Uruguai', 0), {'start_year': 2015, 'end_year': 2018}),
+    (('TW', 'Taipei', 'Songshan line (Green)', 'CKS Memorial Hall Extension', 0), {'start_year': 2014, 'end_year': 2023}),
+    (('IT', 'Sassari', 'Tranvia di Sassari', "S. Maria di Pisa-Sant'Orsola section", 0),
+     {'start_year': 2009, 'end_year': 2017}),
+]
+# Projects whose length is recomputed from their sections, and whose tunnel share from their length
+LENGTH_FROM_SECTIONS = [('US', 'San Francisco', 'BART - SFO Extension', 'Extension', 0)]
+TUNNEL_SHARE_FROM_LENGTH = [('US', 'Washington', 'Green Line', 'Anacostia to Branche Avenue', 0)]
+
+TRAIN_TYPES = {'Tramway': 'Streetcar', 'Tram': 'Streetcar', 'Monorail': 'Monorail/APM', 'APM': 'Monorail/APM'}
+
+
+def _to_float(series):
+    return pd.to_numeric(series.astype(str).str.replace(',', ''), errors='coerce')
+
+
+def check_columns(raw):
+    """Raise if a raw snapshot lacks any of the columns the pipeline reads."""
+    missing = [col for col in CONSUMED_COLUMNS if col not in raw.columns]
+    if missing:
+        raise ValueError(f'snapshot is missing the columns the pipeline reads: {", ".join(missing)}')
+
+
+def project_keys(raw):
+    """(country, city, line, phase, occurrence) for each row of a raw snapshot."""
+    parts = raw[PROJECT_KEY].fillna('').astype(str).apply(lambda col: col.str.strip())
+    occurrence = parts.groupby(PROJECT_KEY, sort=False).cumcount()
+    return pd.MultiIndex.from_arrays([*(parts[col] for col in PROJECT_KEY), occurrence], names=PROJECT_KEY_NAMES)
+
+
+@stage(sources=[COSTS_CSV])
+def raw_costs():
+    return pd.read_csv(COSTS_CSV)
+
+
+@stage(deps=['raw_costs'], manual_fixes=MANUAL_FIXES, length_from_sections=LENGTH_FROM_SECTIONS,
+       tunnel_share_from_length=TUNNEL_SHARE_FROM_LENGTH, train_types=TRAIN_TYPES,
+       excluded_train_types=['Regional Rail', 'Commuter Rail'])
+def cleaned(raw_costs, manual_fixes, length_from_sections, tunnel_share_from_length, train_types,
+            excluded_train_types):
+    # A slice of a snapshot (transit_cost.refresh) comes indexed by its project keys, since
+    # the running count in the key can't be recomputed from the slice alone
+    check_columns(raw_costs)
+    keys = raw_costs.index if raw_costs.index.names == PROJECT_KEY_NAMES else project_keys(raw_costs)
+    rows = dict(zip(keys, range(len(raw_costs))))
+    # Cleaned by position; the input's row labels are put back at the end
+    df = raw_costs.reset_index(drop=True).dropna(subset=['Country', 'Cost']).rename(columns=COLUMN_NAMES)
+    # id/line/phase are kept to identify projects; the notebook dropped them here
+    df = df.drop(columns=DROPPED_COLUMNS)
+    df[['elevated', 'tunnel', 'at_grade']] = df[['elevated', 'tunnel', 'at_grade']].fillna(0)
+    df.loc[df['tunnel_per'] == 1, ['elevated', 'at_grade']] = 0
+    df = df.dropna(subset=['length'])
+    for col in ['length', 'at_grade', 'elevated', 'tunnel', 'track_gauge', 'cost_real_2023']:
+        df[col] = _to_float(df[col])
+
+    present = lambda key: key in rows and rows[key] in df.index
+    for key, values in manual_fixes:
+        if present(key):
+            for col, value in values.items():
+                df.loc[rows[key], col] = value
+    for row in [rows[key] for key in length_from_sections if present(key)]:
+        df.loc[row, 'length'] = df.loc[row, ['tunnel', 'elevated', 'at_grade']].sum()
+    for row in [rows[key] for key in tunnel_share_from_length if present(key)]:
+        df.loc[row, 'tunnel_per'] = df.loc[row, 'tunnel'] / df.loc[row, 'length']
+    df['tunnel'] = df['tunnel_per'] * df['length']
+
+    df['start_year'] = df['start_year'].astype(int)
+    df['end_year'] = df['end_year'].astype(int)
+    df['duration'] = df['end_year'] - df['start_year']
+    df['train_type'] = df['train_type'].replace(train_types)
+    df = df[~df['train_type'].isin(excluded_train_types)]
+    return df.set_axis(raw_costs.index[df.index])
+
+
+### Notebook 04: enrichment, cached per location & period
+ENRICHMENT_KEY = ['country', 'city', 'start_year', 'end_year']
+_enrichment_lock = threading.Lock()
+
+
+def _enrichment_columns(seed, cleaned_columns):
+    return [col for col in seed.columns if col not in cleaned_columns and col not in ENRICHMENT_KEY]
+
+
+def load_enrichment_store(cache_dir=CACHE_DIR):
+    """Enrichment values by ENRICHMENT_KEY, seeded from the enriched frame the notebooks produced."""
+    path = os.path.join(cache_dir, 'enrichment.pkl')
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    with open(ENRICHED_SEED, 'rb') as f:
+        seed = pickle.load(f)
+    base_columns = set(COLUMN_NAMES.values()) | {'duration', 'project_type', 'stations_per_km'}
+    columns = _enrichment_columns(seed, base_columns)
+    # A few cities have line-level values (soil, elevation); the first line's are kept
+    return seed.groupby(ENRICHMENT_KEY)[columns].first()
+
+
+def fetch_enrichment(keys):
+    """Enrichment for keys that aren't in the store yet.
+
+    Only transit_cost.entities' ENRICHMENT_COLUMNS are filled; the API and raster lookups
+    of notebook 04 aren't part of the repo, plug them in here. Returns a frame indexed by
+    ENRICHMENT_KEY (empty when nothing can be fetched).
+    """
+    from transit_cost.entities import enrichment
+
+    if not len(keys):
+        return pd.DataFrame(index=pd.MultiIndex.from_tuples([], names=ENRICHMENT_KEY))
+    return enrichment(keys.to_frame(index=False))
+
+
+@stage(deps=['cleaned'], sources=[ENRICHED_SEED, ENTITIES_MODULE])
+def enriched(cleaned, cache_dir=CACHE_DIR):
+    with _enrichment_lock:
+        store = load_enrichment_store(cache_dir)
+        keys = pd.MultiIndex.from_frame(cleaned[ENRICHMENT_KEY]).unique()
+        pending = pd.DataFrame(index=keys.difference(store.index), columns=store.columns)
+        if len(pending):
+            fetched = fetch_enrichment(pending.index).reindex(index=pending.index, columns=store.columns)
+            complete = fetched.notna().all(axis=1)
+            if complete.any():
+                store = pd.concat([store, fetched[complete]])
+            pending = fetched[~complete]
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(os.path.join(cache_dir, 'enrichment.pkl'), 'wb') as f:
+            pickle.dump(store, f)
+        # The keys still missing values, with the values already found for them
+        pending.dropna(axis=1, how='all').reset_index().to_csv(os.path.join(cache_dir, 'pending_enrichment.csv'),
+                                                               index=False)
+
+    found = pd.MultiIndex.from_frame(cleaned[ENRICHMENT_KEY]).isin(store.index)
+    df = cleaned[found].join(store, on=ENRICHMENT_KEY)
+    df['stations_per_km'] = df['stations'] / df['length']
+    return df
+
+
+### Notebook 05: removing implausible projects & Box-Cox transforms
+COST_LIMITS = [
+    # (train_type, column, upper limit)
+    ('Streetcar', 'cost_km_2023', 500), ('Monorail/APM', 'cost_km_2023', 2000), ('MRT', 'cost_km_2023', 1500),
+    ('MRT', 'cost_real_2023', 20000), ('Light Rail', 'cost_real_2023', 20000),
+    ('Streetcar', 'cost_real_2023', 3000), ('Monorail/APM', 'cost_real_2023', 10000),
+]
+
+# Projects notebook 06 removed after checking them: (country, end_year, length)
+VERIFIED_DROPS = [('EG', 2025, 19.00), ('KR', 2025, 42.60), ('KR', 2028, 9.05), ('PT', 2025, 12.10)]
+
+
+@stage(deps=['enriched'], max_length=80, max_cost=240000, cost_limits=COST_LIMITS, verified_drops=VERIFIED_DROPS)
+def filtered(enriched, max_length, max_cost, cost_limits, verified_drops):
+    df = enriched[(enriched['length'] < max_length) & (enriched['cost_real_2023'] < max_cost)]
+    for train_type, col, limit in cost_limits:
+        df = df[~((df['train_type'] == train_type) & (df[col] >= limit))]
+    for country, end_year, length in verified_drops:
+        df = df[~((df['country'] == country) & (df['end_year'] == end_year) & np.isclose(df['length'], length))]
+    return df
+
+
+# Columns the user model needs in Box-Cox space (transformed as boxcox(x + 1))
+BOXCOX_COLUMNS = ['length', 'tunnel', 'at_grade', 'elevated', 'duration', 'stations', 'cost_real_2023']
+
+
+def apply_boxcox(df, lambdas):
+    """Add the `<col>_transformed` columns for each lambda in `lambdas`."""
+    df = df.copy()
+    for name, lmbda in lambdas.items():
+        df[name] = boxcox(df[name[:-len('_transformed')]].astype(float) + 1, lmbda)
+    return df
+
+
+@stage(deps=['filtered'], sources=[BOXCOX_MODULE], columns=BOXCOX_COLUMNS)
+def transformed(filtered, columns):
+    from scipy.stats import boxcox_normmax
+
+    lambdas = {f'{col}_transformed': boxcox_normmax(filtered[col].astype(float) + 1, method='mle') for col in columns}
+    return {'frame': apply_boxcox(filtered, lambdas), 'lambdas': lambdas}
+
+
+### Notebook 06: screening cost per km
+def cost_per_km(df):
+    return df['cost_real_2023_transformed'] / df['length_transformed']
+
+
+def screening_bounds(cost_km, zscore_limit, iqr_factor, passes):
+    """Range of transformed cost per km that survives the IQR screen and the z-score passes."""
+    q1, q3 = cost_km.quantile([0.25, 0.75])
+    low, high = q1 - iqr_factor * (q3 - q1), q3 + iqr_factor * (q3 - q1)
+    for _ in range(passes):
+        kept = cost_km[cost_km.between(low, high)]
+        mean, std = kept.mean(), kept.std(ddof=0)
+        low, high = max(low, mean - zscore_limit * std), min(high, mean + zscore_limit * std)
+    return low, high
+
+
+@stage(deps=['transformed'], zscore_limit=3, iqr_factor=1.5, passes=2)
+def screened(transformed, zscore_limit, iqr_factor, passes):
+    df = transformed['frame']
+    cost_km = cost_per_km(df)
+    return df[cost_km.between(*screening_bounds(cost_km, zscore_limit, iqr_factor, passes))]
+
+
+### Interaction terms (the definitions the app's feature schema uses too)
+@stage(deps=['screened'], sources=[FEATURES_MODULE], definitions=INTERACTIONS)
+def interactions(screened, definitions):
+    return interaction_frame(screened, definitions)
+
+
+### Notebook 10: categorical buckets (independent, so they run in parallel)
+def bucket_column(screened, spec):
+    return pd.Series(bucket(screened[spec['column']], spec), index=screened.index).astype(object)
+
+
+# One stage per bucket so changing one bucket's edges only re-runs that bucket
+for _name, _spec in BUCKET_SPECS.items():
+    STAGES[f'bucket_{_name}'] = Stage(f'bucket_{_name}', bucket_column, ['screened'], {'spec': _spec}, [BUCKETS_MODULE])
+
+
+@stage(deps=['screened'], sources=[SOIL_TABLE, BUCKETS_MODULE], groups=SOIL_GROUPS)
+def bucket_soil_type(screened, groups):
+    with open(SOIL_TABLE, 'rb') as f:
+        soil = pickle.load(f)
+    class_names = soil.drop_duplicates('wrb_class_value').set_index('wrb_class_value')['wrb_class_name']
+    return pd.Series(soil_type(screened['wrb_class_value'], class_names, groups), index=screened.index).astype(object)
+
+
+BUCKETS = ['soil_type', *BUCKET_SPECS]
+
+
+### The user model's frame (pickles/df_user.pkl)
+USER_COLUMNS = ['start_year', 'end_year', 'at_grade_transformed', 'elevated_transformed', 'duration_transformed',
+                'tunnel_transformed', 'stations_transformed', 'tunnel_MRT_interaction', 'at_grade_MRT_interaction',
+                'tunnel_asia_interaction', 'at_grade_asia_interaction', 'stations_Streetcar_interaction',
+                'stations_LightRail_interaction', 'stations_MRT_interaction', 'stations_tunnel_interaction',
+                'stations_atgrade_interaction', 'stations_elevated_interaction', 'duration_tunnel_interaction',
+                'duration_atgrade_interaction', 'duration_elevated_interaction', 'extension_tunnel_interaction',
+                'extension_atgrade_interaction', 'extension_elevated_interaction', TARGET,
+                'region', 'sub_region', 'train_type', 'project_type', 'soil_type', 'city_size', 'country_income_class',
+                'elevation_class', 'precipitation_type', 'temperature_category', 'poverty_rate', 'city_density_type']
+
+
+def user_rows(screened, interactions, buckets):
+    """df_user rows keeping the upstream index; `buckets` maps bucket name to its series."""
+    df = pd.concat([screened, interactions], axis=1)
+    for name in BUCKETS:
+        df[name] = buckets[name]
+    return df[USER_COLUMNS].dropna()
+
+
+def dedupe_user_rows(rows):
+    return rows.drop_duplicates(subset=['tunnel_transformed', 'elevated_transformed', TARGET]).reset_index(drop=True)
+
+
+@stage(deps=['screened', 'interactions'] + [f'bucket_{name}' for name in BUCKETS],
+       sources=[FEATURES_MODULE, BUCKETS_MODULE, SCHEMA_MODULE])
+def user_frame(screened, interactions, **buckets):
+    rows = user_rows(screened, interactions, {name: buckets[f'bucket_{name}'] for name in BUCKETS})
+    return dedupe_user_rows(rows)
+
+
+@stage(deps=['user_frame'], frac=0.8, random_state=786)
+def split(user_frame, frac, random_state):
+    data = user_frame.sample(frac=frac, random_state=random_state)
+    data_unseen = user_frame.drop(data.index)
+    return {'data': data.reset_index(drop=True), 'data_unseen': data_unseen.reset_index(drop=True)}
+
+
+@stage(deps=['user_frame', 'transformed'], sources=[SOIL_TABLE, FEATURES_MODULE, BUCKETS_MODULE, SCHEMA_MODULE])
+def feature_schema(user_frame, transformed):
+    return compile_schema(user_frame, transformed['lambdas'])
+
+
+### Notebook 10: the blended user model (pycaret)
+CATBOOST_GRID = {
+    'learning_rate': [0.01, 0.05, 0.1, 0.2], 'depth': [3, 4, 5, 6, 7, 8, 10], 'l2_leaf_reg': [1, 3, 5, 7, 9],
+    'bagging_temperature': [0.2, 0.5, 0.8, 1.0], 'border_count': [32, 64, 128, 255], 'iterations': [50, 100, 200, 300],
+    'random_strength': [0.5, 1, 2, 3], 'boosting_type': ['Ordered', 'Plain'], 'subsample': [0.5, 0.7, 0.9, 1.0],
+    'rsm': [0.5, 0.7, 0.9, 1.0], 'grow_policy': ['SymmetricTree', 'Depthwise', 'Lossguide'],
+}
+EXTRA_TREES_GRID = {
+    'n_estimators': [50, 100, 200, 300], 'max_depth': [None, 3, 4, 5, 6, 7], 'min_samples_split': [2, 5, 10],
+    'min_samples_leaf': [1, 2, 4], 'bootstrap': [True, False], 'max_features': ['sqrt', 'log2', 1.0],
+}
+
+
+@stage(deps=['split'], catboost_grid=CATBOOST_GRID, extra_trees_grid=EXTRA_TREES_GRID, n_iter=50, weights=[.7, .3])
+def user_model(split, catboost_grid, extra_trees_grid, n_iter, weights):
+    from pycaret.regression import (blend_models, create_model, ensemble_model, finalize_model, predict_model,
+                                    pull, setup, tune_model)
+
+    start = time.perf_counter()
+    setup(split['data'], target=TARGET, categorical_features=CAT_FEATS, numeric_features=['start_year'] + CONT_FEATS,
+          normalize=True, normalize_method='zscore', verbose=False, memory=False, session_id=786)
+    cat_tuned = tune_model(create_model('catboost', verbose=False), fold=10, n_iter=n_iter,
+                           custom_grid=catboost_grid, choose_better=False, optimize='R2', verbose=False)
+    et_tuned = tune_model(create_model('et', verbose=False), fold=10, n_iter=n_iter,
+                          custom_grid=extra_trees_grid, choose_better=False, optimize='R2', verbose=False)
+    et_bagged = ensemble_model(et_tuned, method='Bagging', fold=10, n_estimators=100, choose_better=True, verbose=False)
+    blended = blend_models([cat_tuned, et_bagged], weights=weights, verbose=False)
+    predict_model(blended, data=split['data_unseen'], verbose=False)
+    metrics = pull().iloc[0].to_dict()
+    final = finalize_model(blended)
+    # Kept so warm-start updates (transit_cost.update) can report the time they save
+    metrics['fit_seconds'] = time.perf_counter() - start
+    return {'model': final, 'metrics': metrics}
+
+
+@stage(deps=['user_model', 'split', 'feature_schema', 'transformed'],
+       sources=[ROOT / 'transit_cost' / 'distill.py', SCHEMA_MODULE, BOXCOX_MODULE], n_synthetic=10000)
+def distilled_model(user_model, split, feature_schema, transformed, n_synthetic):
+    from transit_cost.distill import compare, distill, passes_gate
+    from transit_cost.schema import FeatureSchema
+
+    teacher = user_model['model']
+    student = distill(teacher, FeatureSchema(feature_schema), split['data'], n_synthetic)
+    report = compare(teacher, student, split['data_unseen'], transformed['lambdas'])
+    return {'model': student, 'report': report, 'passed': passes_gate(report.loc['teacher'], report.loc['student'])}
+
+
+@stage(deps=['user_model', 'split'],
+       sources=[ROOT / 'transit_cost' / 'explain.py', ROOT / 'transit_cost' / 'incremental.py'])
+def explanations(user_model, split):
+    from transit_cost.explain import explain
+
+    return explain(user_model['model'], split['data'].drop(columns=[TARGET]))
+
+
+### Running the DAG
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Pipeline:
+    def __init__(self, stages=None, cache_dir=CACHE_DIR, workers=4):
+        self.stages = STAGES if stages is None else stages
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self._keys = {}
+
+    def key(self, name):
+        """Hash of the stage's module, parameters, source files and upstream keys."""
+        if name not in self._keys:
+            current = self.stages[name]
+            digest = hashlib.sha256()
+            digest.update(name.encode())
+            # The whole module, not just the function: stages call helpers and constants defined next to them
+            digest.update(_file_digest(inspect.getsourcefile(current.func)).encode())
+            digest.update(json.dumps(current.params, sort_keys=True, default=repr).encode())
+            for path in current.sources:
+                digest.update(_file_digest(path).encode())
+            for dep in current.deps:
+                digest.update(self.key(dep).encode())
+            self._keys[name] = digest.hexdigest()
+        return self._keys[name]
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, f'{name}-{self.key(name)[:16]}.pkl')
+
+    def _load(self, name):
+        with open(self._path(name), 'rb') as f:
+            return pickle.load(f)
+
+    def _ancestors(self, targets):
+        needed, stack = set(), list(targets)
+        while stack:
+            name = stack.pop()
+            if name not in needed:
+                needed.add(name)
+                stack.extend(self.stages[name].deps)
+        return needed
+
+    def run(self, targets, force=()):
+        """Build `targets`, re-running only stages whose key has no cached output.
+
+        Returns ({stage: output} for the targets, [(stage, status, seconds)]).
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        needed = self._ancestors(targets)
+        stale = {name for name in needed if name in force or not os.path.exists(self._path(name))}
+        # Everything downstream of a stale stage has a new key too, so this only adds forced ones
+        for name in list(needed):
+            if any(dep in stale for dep in self._ancestors([name]) - {name}):
+                stale.add(name)
+
+        outputs, report = {}, [(name, 'cached', 0.0) for name in sorted(needed - stale)]
+        lock = threading.Lock()
+
+        def load_inputs(name):
+            inputs = {}
+            for dep in self.stages[name].deps:
+                with lock:
+                    if dep not in outputs:
+                        outputs[dep] = self._load(dep)
+                    inputs[dep] = outputs[dep]
+            return inputs
+
+        def execute(name):
+            start = time.perf_counter()
+            result = self.stages[name](load_inputs(name), self.cache_dir)
+            with open(self._path(name), 'wb') as f:
+                pickle.dump(result, f)
+            with lock:
+                outputs[name] = result
+            return name, time.perf_counter() - start
+
+        pending, running = set(stale), {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending or running:
+                ready = [name for name in pending if not any(dep in pending or dep in running.values()
+                                                             for dep in self.stages[name].deps)]
+                for name in ready:
+                    pending.discard(name)
+                    running[pool.submit(execute, name)] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, seconds = future.result()
+                    del running[future]
+                    report.append((name, 'ran', seconds))
+
+        results = {}
+        for name in targets:
+            results[name] = outputs[name] if name in outputs else self._load(name)
+        return results, report
+
+    def prune(self):
+        """Delete cached outputs that no current stage key points at."""
+        current = {os.path.basename(self._path(name)) for name in self.stages}
+        removed = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.pkl') and '-' in entry.name and entry.name not in current:
+                os.remove(entry.path)
+                removed += 1
+        return removed
+
+
+def publish(results, publish_dir=PUBLISH_DIR):
+    """Write pipeline outputs under the names of the pickles they correspond to, in `publish_dir`."""
+    os.makedirs(publish_dir, exist_ok=True)
+    written = []
+
+    def dump(obj, name):
+        with open(os.path.join(publish_dir, name), 'wb') as f:
+            pickle.dump(obj, f)
+        written.append(name)
+
+    if 'user_frame' in results:
+        dump(results['user_frame'], 'df_user.pkl')
+    if 'split' in results:
+        dump(results['split']['data'], 'data_user.pkl')
+        dump(results['split']['data_unseen'], 'data_user_unseen.pkl')
+    if 'transformed' in results:
+        dump(results['transformed']['lambdas'], 'lambdas_dict.pkl')
+    if 'feature_schema' in results:
+        save_schema(results['feature_schema'], os.path.join(publish_dir, SCHEMA_PATH.name))
+        written.append(SCHEMA_PATH.name)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the data pipeline, re-running only what changed.')
+    parser.add_argument('--fit', action='store_true', help='also fit the blended user model (needs pycaret)')
+    parser.add_argument('--distill', action='store_true', help='with --fit, also distill a compact student model')
+    parser.add_argument('--explain', action='store_true', help='with --fit, also compute SHAP values of the model')
+    parser.add_argument('--force', nargs='*', default=[], help='stages to re-run even if cached')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--publish', action='store_true', help='write results to pickles/pipeline/ (and register the model)')
+    parser.add_argument('--prune', action='store_true', help='delete stale cache entries afterwards')
+    args = parser.parse_args()
+
+    targets = ['user_frame', 'split', 'transformed', 'feature_schema'] + (['user_model'] if args.fit else [])
+    if args.fit and args.distill:
+        targets.append('distilled_model')
+    if args.fit and args.explain:
+        targets.append('explanations')
+    pipeline = Pipeline(workers=args.workers)
+    start = time.perf_counter()
+    results, report = pipeline.run(targets, force=set(args.force))
+    for name, status, seconds in report:
+        print(f'{name:<30} {status:<7} {seconds:6.2f}s')
+    print(f'df_user: {results["user_frame"].shape}, built in {time.perf_counter() - start:.1f}s')
+    if 'distilled_model' in results:
+        from transit_cost.distill import print_report
+
+        print_report(results['distilled_model']['report'], results['distilled_model']['passed'])
+
+    pending_path = os.path.join(pipeline.cache_dir, 'pending_enrichment.csv')
+    pending = pd.read_csv(pending_path)
+    if len(pending):
+        print(f'{len(pending)} locations need enrichment, see {pending_path}')
+
+    if args.publish:
+        print(f'wrote to {PUBLISH_DIR}:', ', '.join(publish(results)))
+        if args.fit:
+            from transit_cost.registry import register_model
+            from transit_cost.update import DRIFT_METRIC, scores
+
+            import joblib
+
+            artifact = CACHE_DIR / 'user_model.pkl'
+            joblib.dump(results['user_model']['model'], artifact)
+            # pycaret's metrics are in Box-Cox space; updates measure drift on the holdout in USD
+            metrics = dict(results['user_model']['metrics'])
+            metrics[DRIFT_METRIC] = scores(results['user_model']['model'], results['split']['data_unseen'],
+                                           results['transformed']['lambdas'])[DRIFT_METRIC]
+            version = register_model(artifact, model_feature_order(results['user_frame']),
+                                     results['transformed']['lambdas'], metrics, schema=results['feature_schema'])
+            print(f'registered model {version} (promote it with python -m transit_cost.registry promote {version})')
+            if 'explanations' in results:
+                from transit_cost.explain import save
+                from transit_cost.registry import REGISTRY_DIR
+
+                save(results['explanations'], REGISTRY_DIR / version)
+            if results.get('distilled_model', {}).get('passed'):
+                artifact = CACHE_DIR / 'student_model.pkl'
+                joblib.dump(results['distilled_model']['model'], artifact)
+                report = results['distilled_model']['report']
+                version = register_model(artifact, model_feature_order(results['user_frame']),
+                                         results['transformed']['lambdas'],
+                                         {name: float(value) for name, value in report.loc['student'].items()},
+                                         schema=results['feature_schema'])
+                print(f'registered distilled model {version}')
+    if args.prune:
+        print(f'pruned {pipeline.prune()} stale cache entries')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+### On-demand sampling profiler for one rerun of the Streamlit app.
+# Operators enable it per request with ?profile=<PROFILE_TOKEN> (the token comes from the
+# environment, so without it the query parameter does nothing), or for every rerun with
+# PROFILE_RERUNS=1. A background thread then samples the script thread's stack every few
+# milliseconds, along with the prediction worker while it is inside a labelled section, and
+# the end of the rerun shows a flame graph, time per app section and a download of the
+# samples in collapsed-stack format (flamegraph.pl, speedscope).
+#
+# The app labels its own sections with `mark` (the label holds until the next mark, so a
+# page's blocks don't need re-indenting) and library code with `section`. Both return
+# immediately unless a profile is being recorded.
+#
+# A rerun can end without reaching `stop()`: an exception, st.rerun or st.stop unwinds the
+# script. The sampler watches for the frame that started the profile to leave the script
+# thread's stack and then stops itself, so no sampler thread or recording flag outlives its rerun.
+import hmac
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import pandas as pd
+
+from transit_cost.paths import ROOT
+
+SAMPLE_INTERVAL = 0.005
+# Background threads sampled while they are inside a labelled section
+SAMPLED_THREADS = ('prediction-worker', 'scenario-rescorer')
+# Flame graph nodes with less than this share of the samples are folded into their parent
+MIN_SHARE = 0.005
+
+_recording = 0
+_recording_lock = threading.Lock()
+_labels = {}
+
+
+class _Section:
+    def __init__(self, label):
+        self.label = label
+
+    def __enter__(self):
+        _labels.setdefault(threading.get_ident(), []).append(self.label)
+
+    def __exit__(self, *exc):
+        stack = _labels.get(threading.get_ident())
+        if stack:
+            stack.pop()
+
+
+class _NoSection:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_SECTION = _NoSection()
+
+
+def section(label):
+    """Context manager attributing the samples taken inside it to `label`."""
+    return _Section(label) if _recording else _NO_SECTION
+
+
+def mark(label):
+    """Attribute the calling thread's samples to `label` until the next mark."""
+    if _recording:
+        stack = _labels.setdefault(threading.get_ident(), [])
+        if stack:
+            stack[0] = label
+        else:
+            stack.append(label)
+
+
+def is_operator(given, environ=os.environ):
+    """Whether `given` is the operator token (PROFILE_TOKEN); never when no token is set."""
+    token = environ.get('PROFILE_TOKEN')
+    return bool(token) and given is not None and hmac.compare_digest(str(given), token)
+
+
+def requested(query_params, environ=os.environ):
+    """Whether an operator asked to profile this rerun."""
+    if environ.get('PROFILE_RERUNS') == '1':
+        return True
+    return is_operator(query_params.get('profile'), environ)
+
+
+def _frame_name(code):
+    path = code.co_filename
+    if path.startswith(str(ROOT)):
+        path = os.path.relpath(path, ROOT)
+    else:
+        path = os.path.basename(path)
+    return f'{code.co_name} ({path}:{code.co_firstlineno})'
+
+
+class SamplingProfiler:
+    """Samples the calling thread's stack (and labelled work on SAMPLED_THREADS) until stopped."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL, sampled_threads=SAMPLED_THREADS):
+        self.interval = interval
+        self.sampled_threads = sampled_threads
+        self.target = threading.get_ident()
+        self.samples = Counter()
+        self.elapsed = 0.0
+        self.finished = False
+        self._stop = threading.Event()
+        self._finish_lock = threading.Lock()
+        self._thread = None
+        self._owner = None
+
+    def start(self, label='app'):
+        """Start sampling; the profile ends with `stop()` or when the calling frame returns or raises."""
+        global _recording
+        with _recording_lock:
+            _recording += 1
+        self._label_stack = _labels[self.target] = [label]
+        self._owner = sys._getframe(1)
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._finish()
+        return self
+
+    def _finish(self):
+        global _recording
+        with self._finish_lock:
+            if self.finished:
+                return
+            self.finished = True
+            self.elapsed = time.perf_counter() - self._started
+            self._owner = None
+            with _recording_lock:
+                _recording -= 1
+            # A later profile of the same thread has its own labels by now
+            if _labels.get(self.target) is self._label_stack:
+                _labels.pop(self.target, None)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            taken, owner_running = [], False
+            for ident, frame in sys._current_frames().items():
+                if ident == self.target:
+                    thread_name = 'script'
+                elif names.get(ident) in self.sampled_threads and _labels.get(ident):
+                    thread_name = names[ident]
+                else:
+                    continue
+                stack = []
+                while frame is not None:
+                    owner_running = owner_running or frame is self._owner
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                label = ' / '.join(_labels.get(ident) or ['app'])
+                taken.append((thread_name, label, tuple(reversed(stack))))
+            if not owner_running:
+                # The rerun ended without stop(); these samples already belong to whatever ran next
+                self._finish()
+                return
+            self.samples.update(taken)
+
+    @property
+    def n_samples(self):
+        return sum(self.samples.values())
+
+    def collapsed(self):
+        """Samples in collapsed-stack format: `thread;section;frame;...;frame count` per line."""
+        lines = [';'.join([thread, label, *stack]).replace(' ', '_') + f' {count}'
+                 for (thread, label, stack), count in self.samples.most_common()]
+        return '\n'.join(lines) + '\n'
+
+    def sections(self):
+        """Samples and approximate seconds per (thread, section)."""
+        counts = Counter()
+        for (thread, label, _), count in self.samples.items():
+            counts[(thread, label)] += count
+        frame = pd.DataFrame([(thread, label, count) for (thread, label), count in counts.items()],
+                             columns=['thread', 'section', 'samples'])
+        script_samples = frame.loc[frame['thread'] == 'script', 'samples'].sum()
+        frame['seconds'] = frame['samples'] * (self.elapsed / script_samples if script_samples else self.interval)
+        return frame.sort_values('samples', ascending=False).reset_index(drop=True)
+
+    def flame_tree(self, min_share=MIN_SHARE):
+        """(ids, labels, parents, values) of the sample tree, for a plotly icicle."""
+        totals = Counter()
+        for (thread, label, stack), count in self.samples.items():
+            path = ()
+            for node in (thread, label, *stack):
+                path += (node,)
+                totals[path] += count
+        keep = {path for path, count in totals.items() if count >= min_share * self.n_samples}
+        ids = ['/'.join(path) for path in keep]
+        labels = [path[-1] for path in keep]
+        parents = ['/'.join(path[:-1]) for path in keep]
+        values = [totals[path] for path in keep]
+        return ids, labels, parents, values
+
+
+def render(profiler):
+    """Show a finished profile at the bottom of the page."""
+    import plotly.graph_objects as go
+    import streamlit as st
+
+    st.write('---------------------------')
+    st.subheader(f'Profile of this rerun: {profiler.elapsed:.2f}s, {profiler.n_samples} samples')
+    st.dataframe(profiler.sections(), use_container_width=True)
+    ids, labels, parents, values = profiler.flame_tree()
+    fig = go.Figure(go.Icicle(ids=ids, labels=labels, parents=parents, values=values, branchvalues='total',
+                              tiling=dict(orientation='v', flip='y'), maxdepth=12))
+    fig.update_layout(height=700, margin=dict(l=0, r=0, t=10, b=0))
+    st.plotly_chart(fig, use_container_width=True)
+    st.download_button('Download profile (collapsed stacks)', profiler.collapsed(),
+                       file_name=f'profile-{time.strftime("%Y%m%d-%H%M%S")}.folded', mime='text/plain')
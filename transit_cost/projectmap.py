@@ -0,0 +1,161 @@
+### Level-of-detail project map for the Data page.
+# Drawing every project of df_engineered as an SVG geo marker with its own hover data gets
+# slow as the dataset grows. Instead the projects are aggregated once, when the artifacts are
+# built, into a hierarchy saved to pickles/project_map.pkl:
+#   countries  one point per country (project-weighted centre of its cities)
+#   cities     one point per city
+#   projects   the projects themselves, sorted by (country, city) for cheap lookups
+# The map shows the countries at world level, a country's cities once it is selected and a
+# city's projects once that is selected, so the browser only ever receives the points of one
+# level, drawn with a WebGL map trace.
+#
+#   python -m transit_cost.projectmap    # rebuild pickles/project_map.pkl from pickles/df_engineered.pkl
+import argparse
+import pickle
+
+import numpy as np
+
+from transit_cost.paths import PICKLES_DIR
+
+MAP_PATH = PICKLES_DIR / 'project_map.pkl'
+SOURCE_PATH = PICKLES_DIR / 'df_engineered.pkl'
+PROJECT_COLUMNS = ['country', 'city', 'lat', 'lng', 'year', 'length', 'tunnel', 'elevated', 'stations', 'duration',
+                   'cost_real_2023', 'cost_km_2023']
+# Projects only have their city's coordinates, so at project level they are spread on a
+# small spiral around it (degrees) to be told apart
+PROJECT_SPREAD = 0.01
+
+
+def _aggregate(df, keys):
+    grouped = df.groupby(keys, sort=False)
+    frame = grouped.agg(lat=('lat', 'mean'), lng=('lng', 'mean'), projects=('length', 'size'),
+                        length=('length', 'sum'), cost_real_2023=('cost_real_2023', 'sum'),
+                        median_cost_km=('cost_km_2023', 'median'), first_year=('year', 'min'),
+                        last_year=('year', 'max'))
+    return frame.reset_index().sort_values('projects', ascending=False, ignore_index=True)
+
+
+def build_levels(df):
+    """{'countries', 'cities', 'projects'} frames of the map hierarchy for df_engineered."""
+    projects = df[PROJECT_COLUMNS].dropna(subset=['lat', 'lng']).sort_values(['country', 'city', 'year'])
+    cities = _aggregate(projects, ['country', 'city'])
+    # Weighted by projects, so a country's point sits near where most of its projects are
+    weighted = cities.assign(lat=cities['lat'] * cities['projects'], lng=cities['lng'] * cities['projects'])
+    countries = weighted.groupby('country').agg(
+        lat=('lat', 'sum'), lng=('lng', 'sum'), projects=('projects', 'sum'), cities=('city', 'size'),
+        length=('length', 'sum'), cost_real_2023=('cost_real_2023', 'sum'),
+        first_year=('first_year', 'min'), last_year=('last_year', 'max'))
+    countries['lat'] /= countries['projects']
+    countries['lng'] /= countries['projects']
+    countries['median_cost_km'] = projects.groupby('country')['cost_km_2023'].median()
+    countries = countries.reset_index().sort_values('projects', ascending=False, ignore_index=True)
+    return {
+        'countries': countries,
+        'cities': cities.set_index('country').sort_index(),
+        'projects': projects.set_index(['country', 'city']).sort_index(),
+    }
+
+
+def load_map(path=MAP_PATH):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def build_map(source=SOURCE_PATH, path=MAP_PATH):
+    with open(source, 'rb') as f:
+        levels = build_levels(pickle.load(f))
+    with open(path, 'wb') as f:
+        pickle.dump(levels, f)
+    return levels
+
+
+def cities(levels, country):
+    """Cities of one country, largest first."""
+    return levels['cities'].loc[[country]].reset_index().sort_values('projects', ascending=False, ignore_index=True)
+
+
+def projects(levels, country, city):
+    """Projects of one city, spread around its coordinates."""
+    frame = levels['projects'].loc[[(country, city)]].reset_index()
+    # Golden-angle spiral: evenly spaced points that grow outwards with the project count
+    i = np.arange(len(frame))
+    radius = PROJECT_SPREAD * np.sqrt(i / max(len(frame), 1))
+    angle = i * np.pi * (3 - np.sqrt(5))
+    frame['lat'] = frame['lat'] + radius * np.sin(angle)
+    frame['lng'] = frame['lng'] + radius * np.cos(angle) / np.cos(np.radians(frame['lat']))
+    return frame
+
+
+def _zoom(points):
+    # Smallest web-mercator zoom that fits the points' spread, roughly
+    span = max(np.ptp(points['lat']), np.ptp(points['lng']), 1e-3)
+    return float(np.clip(np.log2(360 / span) - 1, 1, 13))
+
+
+def figure(points, level):
+    """WebGL map of one level's points: sized by project count (or length), coloured by cost per km."""
+    import plotly.graph_objects as go
+
+    if level == 'projects':
+        size = np.sqrt(points['length'].clip(lower=0.5)) * 6
+        color = points['cost_km_2023']
+        text = points['city'] + ' (' + points['year'].astype(str) + ')'
+        hover = ('%{text}<br>%{customdata[0]:.1f} km, %{customdata[1]:.0f} stations<br>'
+                 '$%{customdata[2]:,.0f}M (2023), $%{customdata[3]:,.0f}M/km<extra></extra>')
+        customdata = points[['length', 'stations', 'cost_real_2023', 'cost_km_2023']]
+    else:
+        size = 6 + 4 * np.sqrt(points['projects'])
+        color = points['median_cost_km']
+        text = points['city'] if level == 'cities' else points['country']
+        hover = ('%{text}<br>%{customdata[0]} projects, %{customdata[1]:,.0f} km<br>'
+                 'median $%{customdata[2]:,.0f}M/km (2023)<extra></extra>')
+        customdata = points[['projects', 'length', 'median_cost_km']]
+    fig = go.Figure(go.Scattermapbox(
+        lat=points['lat'], lon=points['lng'], text=text, customdata=customdata, hovertemplate=hover,
+        mode='markers', marker=dict(size=size, color=color, colorscale='Viridis', cmin=0,
+                                    cmax=float(np.nanquantile(color, 0.95)) if len(points) else 1,
+                                    colorbar=dict(title='$M/km'), opacity=0.8)))
+    fig.update_layout(
+        mapbox=dict(style='carto-positron', zoom=1 if level == 'countries' else _zoom(points),
+                    center=dict(lat=float(points['lat'].mean()), lon=float(points['lng'].mean()))),
+        margin=dict(t=0, b=0, l=0, r=0), height=500,
+        paper_bgcolor='rgba(0,0,0,0)')
+    return fig
+
+
+def render(levels, key):
+    """Country/city drill-down controls and the map of the selected level, drawn in Streamlit."""
+    import streamlit as st
+
+    countries = levels['countries']
+    columns = st.columns(2)
+    country = columns[0].selectbox('Country', ['All countries', *countries['country']], key=f'{key}-country')
+    if country == 'All countries':
+        points, level = countries, 'countries'
+    else:
+        country_cities = cities(levels, country)
+        city = columns[1].selectbox('City', ['All cities', *country_cities['city']], key=f'{key}-city-{country}')
+        if city == 'All cities':
+            points, level = country_cities, 'cities'
+        else:
+            points, level = projects(levels, country, city), 'projects'
+    st.plotly_chart(figure(points, level), use_container_width=True)
+    if level == 'projects':
+        st.caption(f'{len(points):,} projects; marker size is the track length and colour the cost per km')
+    else:
+        st.caption(f'{len(points):,} {level}; marker size is the number of projects and colour the median cost per km')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-aggregate df_engineered into the levels of the project map.')
+    parser.add_argument('--source', default=str(SOURCE_PATH))
+    parser.add_argument('--out', default=str(MAP_PATH))
+    args = parser.parse_args()
+
+    levels = build_map(args.source, args.out)
+    print(f"{len(levels['countries'])} countries, {len(levels['cities'])} cities, "
+          f"{len(levels['projects'])} projects -> {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+### Incremental refresh from new Transit Costs Project snapshots.
+# Projects are matched between snapshots on (country, city, line, phase), with a running
+# count to tell apart the few projects that share all four. Only added and changed projects
+# (and ones still waiting on enrichment) go back through cleaning, enrichment and feature
+# engineering. The steps fitted on the whole dataset (Box-Cox lambdas, the cost per km
+# screen) keep the parameters from the last full build, so every other step is per row and
+# the patched frame matches what the full pipeline would build with those parameters.
+# Run with --rebuild after a large update to refit them.
+#
+#   python -m transit_cost.refresh                                  # refresh from the current costs.csv
+#   python -m transit_cost.refresh --diff History/costs.csv costs.csv
+#   python -m transit_cost.refresh --publish                        # ... and write pickles/pipeline/df_user.pkl
+import argparse
+import os
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+
+from transit_cost.paths import DATA_DIR
+from transit_cost.pipeline import (BUCKETS, CACHE_DIR, CONSUMED_COLUMNS, COSTS_CSV, PROJECT_KEY_NAMES, PUBLISH_DIR,
+                                   STAGES, apply_boxcox, check_columns, cost_per_km, dedupe_user_rows, project_keys,
+                                   screening_bounds, user_rows)
+
+STATE_PATH = CACHE_DIR / 'refresh_state.pkl'
+CHANGELOG_PATH = DATA_DIR / 'TransitCostData' / 'changelog.csv'
+
+def keyed(raw):
+    frame = raw.copy()
+    frame.index = project_keys(raw)
+    return frame
+
+
+def _same(old, new):
+    """Elementwise equality treating NaN == NaN and '1,200' == 1200.0."""
+    old_num = pd.to_numeric(old.astype(str).str.replace(',', ''), errors='coerce')
+    new_num = pd.to_numeric(new.astype(str).str.replace(',', ''), errors='coerce')
+    numeric = old_num.notna() & new_num.notna()
+    same_number = np.isclose(old_num.fillna(0), new_num.fillna(0), rtol=1e-9, atol=1e-9)
+    same_text = old.fillna('').astype(str).str.strip() == new.fillna('').astype(str).str.strip()
+    return np.where(numeric, same_number, same_text)
+
+
+def diff_snapshots(old, new):
+    """Changelog between two keyed snapshots: one row per added, changed or removed project.
+
+    Only the columns the pipeline reads are compared, and only those both snapshots have: a
+    column added since the old snapshot isn't a change to every project.
+    """
+    added = new.index.difference(old.index)
+    removed = old.index.difference(new.index)
+    common = new.index.intersection(old.index)
+    columns = [col for col in CONSUMED_COLUMNS if col in old.columns and col in new.columns]
+    before = old.reindex(index=common, columns=columns)
+    after = new.reindex(index=common, columns=columns)
+    differs = pd.DataFrame({col: ~_same(before[col], after[col]) for col in columns}, index=common)
+    changed = differs.index[differs.any(axis=1)]
+
+    def describe(key):
+        cols = differs.columns[differs.loc[key].to_numpy()]
+        return '; '.join(f'{col}: {before.at[key, col]} -> {after.at[key, col]}' for col in cols)
+
+    changelog = pd.concat([
+        pd.DataFrame({'status': 'added', 'changes': ''}, index=added),
+        pd.DataFrame({'status': 'changed', 'changes': [describe(key) for key in changed]}, index=changed),
+        pd.DataFrame({'status': 'removed', 'changes': ''}, index=removed),
+    ])
+    changelog.index = pd.MultiIndex.from_tuples(changelog.index, names=PROJECT_KEY_NAMES)
+    return changelog
+
+
+def _rekey(frame, raw, keys):
+    """Swap the raw row labels of a processed slice for project keys."""
+    return frame.set_axis(keys[raw.index.get_indexer(frame.index)])
+
+
+def _run(name, **inputs):
+    return STAGES[name](inputs)
+
+
+def enrich(raw_rows, keys):
+    """Cleaned and enriched rows for a slice of a raw snapshot with its project `keys` (row labels preserved)."""
+    # Cleaning applies the manual fixes by project key; hand it the keys of the whole snapshot
+    cleaned = _run('cleaned', raw_costs=raw_rows.set_axis(keys))
+    cleaned = cleaned.set_axis(raw_rows.index[keys.get_indexer(cleaned.index)])
+    return cleaned, _run('enriched', cleaned=cleaned)
+
+
+def fit(projects):
+    """Box-Cox lambdas & cost per km bounds, fitted on every project like the full pipeline."""
+    filtered = _run('filtered', enriched=projects)
+    lambdas = _run('transformed', filtered=filtered)['lambdas']
+    bounds = screening_bounds(cost_per_km(apply_boxcox(filtered, lambdas)), **STAGES['screened'].params)
+    return lambdas, bounds
+
+
+def score(projects, lambdas, bounds):
+    """df_user rows for enriched projects, with frozen lambdas & bounds."""
+    transformed = apply_boxcox(_run('filtered', enriched=projects), lambdas)
+    screened = transformed[cost_per_km(transformed).between(*bounds)]
+    buckets = {name: _run(f'bucket_{name}', screened=screened) for name in BUCKETS}
+    return user_rows(screened, _run('interactions', screened=screened), buckets)
+
+
+def build_state(raw):
+    """Full build: every project through the pipeline, refitting lambdas & bounds."""
+    check_columns(raw)
+    snapshot = keyed(raw)
+    cleaned, projects = enrich(raw, snapshot.index)
+    lambdas, bounds = fit(projects)
+    rows = score(projects, lambdas, bounds)
+    keys = snapshot.index
+    return {
+        'snapshot': snapshot,
+        'lambdas': lambdas,
+        'bounds': bounds,
+        'projects': _rekey(projects, raw, keys),
+        'user_rows': _rekey(rows, raw, keys),
+        'pending': set(keys[raw.index.get_indexer(cleaned.index.difference(projects.index))]),
+    }
+
+
+def refresh(state, raw):
+    """Patch `state` to the snapshot `raw`. Returns (state, changelog, stats)."""
+    check_columns(raw)
+    snapshot = keyed(raw)
+    changelog = diff_snapshots(state['snapshot'], snapshot)
+    stale = set(changelog.index[changelog['status'] != 'added'])
+    touched = set(changelog.index[changelog['status'] != 'removed']) | (state['pending'] & set(snapshot.index))
+
+    keys = snapshot.index
+    positions = np.sort(keys.get_indexer(list(touched))) if touched else []
+    delta = raw.iloc[positions]
+    if len(delta):
+        cleaned, projects = enrich(delta, keys[positions])
+        rows = _rekey(score(projects, state['lambdas'], state['bounds']), raw, keys)
+        pending = set(keys[raw.index.get_indexer(cleaned.index.difference(projects.index))])
+        projects = _rekey(projects, raw, keys)
+    else:
+        projects = rows = None
+        pending = set()
+
+    dropped = list(stale | touched)
+    state = dict(state)
+    for name, new_rows in (('projects', projects), ('user_rows', rows)):
+        kept = state[name].drop(index=dropped, errors='ignore')
+        combined = kept if new_rows is None else pd.concat([kept, new_rows])
+        # Keep snapshot order so the published frames read like a full build
+        state[name] = combined.iloc[np.argsort(keys.get_indexer(combined.index), kind='stable')]
+    state['snapshot'] = snapshot
+    state['pending'] = pending
+
+    stats = {status: int((changelog['status'] == status).sum()) for status in ('added', 'changed', 'removed')}
+    stats['reprocessed'] = len(delta)
+    stats['pending'] = len(pending)
+    return state, changelog, stats
+
+
+def derived_frames(state):
+    """Frames written to pickles/pipeline/ (the same ones the pipeline publishes)."""
+    return {'df_user.pkl': dedupe_user_rows(state['user_rows'])}
+
+
+def load_state(path=STATE_PATH):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def save_state(state, path=STATE_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def append_changelog(changelog, path=CHANGELOG_PATH, snapshot=None):
+    entries = changelog.reset_index()
+    entries.insert(0, 'snapshot', snapshot)
+    entries.insert(0, 'refreshed', pd.Timestamp.now().floor('s'))
+    entries.to_csv(path, mode='a', header=not os.path.exists(path), index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Refresh the modelling frames from a new costs.csv snapshot.')
+    parser.add_argument('--snapshot', default=str(COSTS_CSV))
+    parser.add_argument('--diff', nargs=2, metavar=('OLD', 'NEW'), help='only print the changelog between two snapshots')
+    parser.add_argument('--rebuild', action='store_true', help='reprocess every project and refit lambdas & bounds')
+    parser.add_argument('--publish', action='store_true', help='write the patched frames to pickles/pipeline/')
+    parser.add_argument('--changelog', default=str(CHANGELOG_PATH))
+    args = parser.parse_args()
+
+    if args.diff:
+        old, new = (keyed(pd.read_csv(path)) for path in args.diff)
+        changelog = diff_snapshots(old, new)
+        print(changelog['status'].value_counts().to_string(), end='\n\n')
+        print(changelog.reset_index().to_string(index=False, max_colwidth=60))
+        return
+
+    start = time.perf_counter()
+    raw = pd.read_csv(args.snapshot)
+    state = None if args.rebuild else load_state()
+    if state is None:
+        state = build_state(raw)
+        print(f'built state for {len(state["snapshot"])} projects')
+    else:
+        state, changelog, stats = refresh(state, raw)
+        print(f"{stats['added']} added, {stats['changed']} changed, {stats['removed']} removed; "
+              f"{stats['reprocessed']} projects reprocessed, {stats['pending']} waiting on enrichment")
+        if len(changelog):
+            append_changelog(changelog, args.changelog, os.path.basename(args.snapshot))
+    save_state(state)
+    print(f'done in {time.perf_counter() - start:.2f}s')
+
+    if args.publish:
+        os.makedirs(PUBLISH_DIR, exist_ok=True)
+        for name, frame in derived_frames(state).items():
+            with open(PUBLISH_DIR / name, 'wb') as f:
+                pickle.dump(frame, f)
+            print(f'wrote {name} {frame.shape}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,339 @@
+### On-disk registry of user model versions.
+# models/registry/registry.json records, for every version, the artifact (copied into
+# models/registry/<version>/model.pkl) with its sha256, the feature order, the Box-Cox lambdas
+# the model was trained with, its compiled feature schema (transit_cost.schema) and its
+# evaluation metrics.
+# Aliases ("current") point at a version; promoting a new version just rewrites the alias,
+# and running apps pick it up through ModelHandle without a restart.
+#
+#   python -m transit_cost.registry register models/finalized_user_model.pkl --version v2 --promote
+#   python -m transit_cost.registry promote v2
+#   python -m transit_cost.registry list
+#   python -m transit_cost.registry audit
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import sys
+import threading
+import time
+
+from transit_cost.features import model_feature_order
+from transit_cost.inference import DEFAULT_MODEL_PATH, load_model
+from transit_cost.paths import MODELS_DIR, PICKLES_DIR
+from transit_cost.schema import SCHEMA_PATH, load_schema, schema_for
+
+REGISTRY_DIR = MODELS_DIR / 'registry'
+INDEX_PATH = REGISTRY_DIR / 'registry.json'
+DEFAULT_ALIAS = 'current'
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_index(index_path=INDEX_PATH):
+    if not os.path.exists(index_path):
+        return {'aliases': {}, 'versions': {}}
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def write_index(index, index_path=INDEX_PATH):
+    # Write to a temp file and rename so readers never see a half-written index
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    tmp_path = f'{index_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_path, index_path)
+
+
+def _load_pickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def legacy_entry():
+    """Entry for the unregistered model the app used before the registry existed."""
+    return {
+        'version': 'unregistered',
+        'artifact': str(DEFAULT_MODEL_PATH),
+        'sha256': None,
+        'feature_order': list(model_feature_order(_load_pickle(PICKLES_DIR / 'df_user.pkl'))),
+        'lambdas': _load_pickle(PICKLES_DIR / 'lambdas_dict.pkl'),
+        'schema': load_schema() if os.path.exists(SCHEMA_PATH) else None,
+        'metrics': {},
+    }
+
+
+def register_model(artifact_path, feature_order, lambdas, metrics=None, version=None, promote=False,
+                   registry_dir=REGISTRY_DIR, schema=None):
+    """Copy an artifact into the registry and record its metadata. Returns the version name."""
+    if os.path.getsize(artifact_path) == 0:
+        raise ValueError(f'{artifact_path} is empty; refusing to register it')
+    index_path = os.path.join(registry_dir, 'registry.json')
+    index = read_index(index_path)
+    if version is None:
+        version = f'v{len(index["versions"]) + 1}'
+    if version in index['versions']:
+        raise ValueError(f'version {version} is already registered')
+
+    version_dir = os.path.join(registry_dir, version)
+    os.makedirs(version_dir, exist_ok=True)
+    artifact = os.path.join(version_dir, 'model.pkl')
+    shutil.copyfile(artifact_path, artifact)
+
+    index['versions'][version] = {
+        'artifact': os.path.relpath(artifact, registry_dir),
+        'sha256': file_sha256(artifact),
+        'feature_order': list(feature_order),
+        'lambdas': {name: float(value) for name, value in lambdas.items()},
+        'schema': schema,
+        'metrics': dict(metrics or {}),
+        'source': str(artifact_path),
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+    }
+    if promote or DEFAULT_ALIAS not in index['aliases']:
+        index['aliases'][DEFAULT_ALIAS] = version
+    write_index(index, index_path)
+    return version
+
+
+def promote(version, alias=DEFAULT_ALIAS, registry_dir=REGISTRY_DIR):
+    index_path = os.path.join(registry_dir, 'registry.json')
+    index = read_index(index_path)
+    if version not in index['versions']:
+        raise KeyError(f'unknown model version {version}')
+    index['aliases'][alias] = version
+    write_index(index, index_path)
+
+
+def resolve(alias=DEFAULT_ALIAS, registry_dir=REGISTRY_DIR):
+    """Registry entry (with absolute artifact path) that `alias` points at."""
+    index = read_index(os.path.join(registry_dir, 'registry.json'))
+    if alias not in index['aliases']:
+        if alias == DEFAULT_ALIAS and not index['versions']:
+            return legacy_entry()
+        raise KeyError(f'unknown model alias {alias}')
+    version = index['aliases'][alias]
+    entry = dict(index['versions'][version], version=version)
+    entry['artifact'] = os.path.join(registry_dir, entry['artifact'])
+    return entry
+
+
+def verify(entry):
+    """Raise if the artifact on disk no longer matches the recorded checksum."""
+    if entry['sha256'] is None:
+        return
+    actual = file_sha256(entry['artifact'])
+    if actual != entry['sha256']:
+        raise ValueError(f'checksum mismatch for model {entry["version"]}: '
+                         f'expected {entry["sha256"]}, found {actual}')
+
+
+class ModelHandle:
+    """Lazily loaded model behind a registry alias, swapped when the alias moves.
+
+    The registry index is stat'ed at most every `check_interval` seconds; when the alias
+    points at a new version, its artifact is verified and loaded while the old version keeps
+    serving, then entry, model and schema are swapped together and the swap callbacks run so
+    caches tied to the old version can be dropped. The new version is loaded in a background
+    thread under `_load_lock`; `_lock` only guards reading and swapping the three, so only the
+    first use of the first version's model waits for a load.
+    """
+
+    def __init__(self, alias=DEFAULT_ALIAS, registry_dir=REGISTRY_DIR, check_interval=5.0):
+        self.alias = alias
+        self.registry_dir = registry_dir
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._entry = None
+        self._model = None
+        self._schema = None
+        self._index_mtime = None
+        self._last_check = 0.0
+        self._swap_callbacks = []
+
+    def on_swap(self, callback):
+        """Register `callback(old_version, new_version)` to run after a hot swap."""
+        self._swap_callbacks.append(callback)
+
+    def _index_changed(self):
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return False
+        self._last_check = now
+        index_path = os.path.join(self.registry_dir, 'registry.json')
+        mtime = os.stat(index_path).st_mtime if os.path.exists(index_path) else None
+        changed = mtime != self._index_mtime
+        self._index_mtime = mtime
+        return changed
+
+    def _refresh(self):
+        """Re-resolve the alias if the index changed.
+
+        The first version is taken in place (its model is read on first use, by `_load`);
+        later ones are loaded by `_swap` in the background while the current one keeps serving.
+        """
+        with self._lock:
+            starting = self._entry is None
+            if not starting and not self._index_changed():
+                return
+        if starting:
+            with self._load_lock:
+                with self._lock:
+                    if self._entry is not None:
+                        return
+                entry = resolve(self.alias, self.registry_dir)
+                schema = schema_for(entry)
+                with self._lock:
+                    self._entry, self._schema = entry, schema
+        elif self._load_lock.acquire(blocking=False):
+            threading.Thread(target=self._swap, name=f'model-swap-{self.alias}', daemon=True).start()
+        else:
+            # A load is in progress; look at the index again on a later check
+            with self._lock:
+                self._index_mtime = None
+
+    def _swap(self):
+        """Load the version the alias points at and swap it in; runs with `_load_lock` held."""
+        with self._lock:
+            current = self._entry
+        try:
+            entry = resolve(self.alias, self.registry_dir)
+            if entry['version'] == current['version']:
+                return
+            schema = schema_for(entry)
+            verify(entry)
+            model = load_model(entry['artifact'])
+            with self._lock:
+                self._entry, self._model, self._schema = entry, model, schema
+        except Exception as exc:
+            print(f'could not load model {self.alias}: {exc!r}; still serving {current["version"]}', file=sys.stderr)
+            return
+        finally:
+            self._load_lock.release()
+        self._notify(current['version'], entry['version'])
+
+    def _load(self):
+        """The served (entry, model, schema), loading the model of the first version if needed."""
+        with self._lock:
+            served = self._entry, self._model, self._schema
+        if served[1] is not None:
+            return served
+        with self._load_lock:
+            with self._lock:
+                served = self._entry, self._model, self._schema
+            if served[1] is None:
+                verify(served[0])
+                model = load_model(served[0]['artifact'])
+                with self._lock:
+                    if self._entry is served[0]:
+                        self._model = model
+                served = served[0], model, served[2]
+        return served
+
+    def _notify(self, old_version, new_version):
+        # Outside the lock, so callbacks may use the handle themselves
+        for callback in list(self._swap_callbacks):
+            callback(old_version, new_version)
+
+    def entry(self):
+        """Registry entry of the version being served (re-resolved when the index changes)."""
+        self._refresh()
+        with self._lock:
+            return self._entry
+
+    @property
+    def version(self):
+        return self.entry()['version']
+
+    def served(self):
+        """(entry, model, schema) of one version, read together so a swap can't mix them."""
+        self._refresh()
+        return self._load()
+
+    @property
+    def model(self):
+        return self.served()[1]
+
+    @property
+    def schema(self):
+        """FeatureSchema of the version being served (no model load needed)."""
+        self._refresh()
+        with self._lock:
+            return self._schema
+
+
+### Command line
+def audit(models_dir=MODELS_DIR, registry_dir=REGISTRY_DIR):
+    """Artifacts in models/ that are empty or not registered."""
+    index = read_index(os.path.join(registry_dir, 'registry.json'))
+    registered = {entry['sha256'] for entry in index['versions'].values()}
+    rows = []
+    for name in sorted(os.listdir(models_dir)):
+        path = os.path.join(models_dir, name)
+        if not os.path.isfile(path):
+            continue
+        if os.path.getsize(path) == 0:
+            rows.append((name, 'empty'))
+        elif file_sha256(path) not in registered:
+            rows.append((name, 'unregistered'))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage registered user model versions.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    register_parser = commands.add_parser('register', help='register a model saved with pycaret save_model')
+    register_parser.add_argument('artifact')
+    register_parser.add_argument('--version')
+    register_parser.add_argument('--promote', action='store_true')
+
+    promote_parser = commands.add_parser('promote', help='point an alias at a registered version')
+    promote_parser.add_argument('version')
+    promote_parser.add_argument('--alias', default=DEFAULT_ALIAS)
+
+    commands.add_parser('list', help='show registered versions')
+    commands.add_parser('audit', help='show empty or unregistered files in models/')
+
+    args = parser.parse_args()
+    if args.command == 'register':
+        # Schema, lambdas & metrics default to the artifacts written by notebook 10
+        metrics = _load_pickle(PICKLES_DIR / 'combined_metrics.pkl')
+        user_metrics = metrics[metrics['Model'] == 'User Model'].tail(1)
+        version = register_model(
+            args.artifact,
+            feature_order=model_feature_order(_load_pickle(PICKLES_DIR / 'df_user.pkl')),
+            lambdas=_load_pickle(PICKLES_DIR / 'lambdas_dict.pkl'),
+            metrics=user_metrics.drop(columns=['Model', 'Version', 'Dataset']).iloc[0].to_dict() if len(user_metrics) else {},
+            version=args.version,
+            promote=args.promote,
+            schema=load_schema() if os.path.exists(SCHEMA_PATH) else None,
+        )
+        print(f'registered {version}')
+    elif args.command == 'promote':
+        promote(args.version, args.alias)
+        print(f'{args.alias} -> {args.version}')
+    elif args.command == 'list':
+        index = read_index()
+        current = index['aliases'].get(DEFAULT_ALIAS)
+        for version, entry in index['versions'].items():
+            marker = '*' if version == current else ' '
+            print(f'{marker} {version}  {entry["created"]}  {entry["sha256"][:12]}  {entry["metrics"]}')
+    elif args.command == 'audit':
+        for name, status in audit():
+            print(f'{status:>12}  models/{name}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+### Saved calculator scenarios.
+# A local SQLite file (scenarios.db at the repo root) keeps named calculator inputs as they
+# were entered, the length unit they were entered in (track lengths are converted to km only
+# when scoring), the currency they were viewed in and their predicted cost under each model
+# version that scored them. Every scenario
+# belongs to an owner, the app's id for one browser, and names are only unique per owner,
+# so visitors never see or overwrite each other's scenarios. Comparing scenarios only reads
+# stored predictions. When a new model version is promoted, ScenarioRescorer re-scores every
+# stored scenario on a background thread, in batches through the vectorized predictor, so
+# no page view ever waits on it.
+#
+#   python -m transit_cost.scenarios list
+#   python -m transit_cost.scenarios rescore     # score stored scenarios with the 'current' model
+#   python -m transit_cost.scenarios delete OWNER NAME
+import argparse
+import datetime
+import json
+import sqlite3
+import threading
+
+import pandas as pd
+
+from transit_cost.calculator import KM_PER_MILE
+from transit_cost.paths import ROOT
+
+SCENARIOS_DB = ROOT / 'scenarios.db'
+RESCORE_BATCH = 256
+# Inputs entered in the calculator's length unit
+TRACK_INPUTS = ['length', 'tunnel', 'at_grade', 'elevated']
+KM_PER_UNIT = {'Kilometers': 1.0, 'Miles': KM_PER_MILE}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenarios (
+    id INTEGER PRIMARY KEY,
+    owner TEXT NOT NULL,
+    name TEXT NOT NULL,
+    inputs TEXT NOT NULL,
+    unit TEXT NOT NULL,
+    currency TEXT NOT NULL,
+    saved TEXT NOT NULL,
+    UNIQUE (owner, name)
+);
+CREATE TABLE IF NOT EXISTS predictions (
+    scenario_id INTEGER NOT NULL REFERENCES scenarios(id) ON DELETE CASCADE,
+    model_version TEXT NOT NULL,
+    cost REAL NOT NULL,
+    scored TEXT NOT NULL,
+    PRIMARY KEY (scenario_id, model_version)
+);
+"""
+
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+def model_inputs(inputs, unit):
+    """Inputs as the model scores them: the track lengths in km."""
+    scale = KM_PER_UNIT[unit]
+    return {**inputs, **{name: float(inputs[name]) * scale for name in TRACK_INPUTS}}
+
+
+class ScenarioStore:
+    """Named calculator inputs and their predicted costs (millions of 2023 USD) per model version."""
+
+    def __init__(self, path=SCENARIOS_DB):
+        self.path = str(path)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            if 'unit' not in {row[1] for row in conn.execute('PRAGMA table_info(scenarios)')}:
+                # Stores written before the unit was kept have the length in km
+                conn.execute("ALTER TABLE scenarios ADD COLUMN unit TEXT NOT NULL DEFAULT 'Kilometers'")
+
+    def _connect(self):
+        # One short-lived connection per call: the app reads from script threads while the
+        # rescorer writes from its own
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA foreign_keys=ON')
+        return conn
+
+    def save(self, owner, name, inputs, unit, currency, cost=None, model_version=None):
+        """Save (or overwrite) `owner`'s scenario `name`, with its prediction if one is given.
+
+        `inputs` are the calculator's values as entered, track lengths in `unit` (a KM_PER_UNIT key).
+        """
+        if unit not in KM_PER_UNIT:
+            raise ValueError(f'unknown length unit {unit}')
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO scenarios (owner, name, inputs, unit, currency, saved) VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(owner, name) DO UPDATE SET inputs=excluded.inputs, unit=excluded.unit, '
+                'currency=excluded.currency, saved=excluded.saved',
+                (owner, name, json.dumps(inputs), unit, currency, _now()))
+            scenario_id = conn.execute('SELECT id FROM scenarios WHERE owner = ? AND name = ?',
+                                       (owner, name)).fetchone()[0]
+            # Predictions of the old inputs no longer apply
+            conn.execute('DELETE FROM predictions WHERE scenario_id = ?', (scenario_id,))
+            if cost is not None:
+                conn.execute('INSERT INTO predictions VALUES (?, ?, ?, ?)',
+                             (scenario_id, model_version, float(cost), _now()))
+
+    def delete(self, owner, name):
+        with self._connect() as conn:
+            return conn.execute('DELETE FROM scenarios WHERE owner = ? AND name = ?', (owner, name)).rowcount > 0
+
+    def names(self, owner):
+        with self._connect() as conn:
+            rows = conn.execute('SELECT name FROM scenarios WHERE owner = ? ORDER BY saved DESC, name', (owner,))
+            return [row[0] for row in rows]
+
+    def scenarios(self, owner, model_version=None):
+        """One row per scenario `owner` saved (every owner's if None): its inputs and its cost under
+        `model_version`, or under the most recently scored version while `model_version` hasn't scored it yet."""
+        where, params = ('', ()) if owner is None else (' WHERE owner = ?', (owner,))
+        with self._connect() as conn:
+            saved = pd.read_sql_query(f'SELECT * FROM scenarios{where} ORDER BY saved DESC, name', conn, params=params)
+            scored = pd.read_sql_query(
+                f'SELECT * FROM predictions WHERE scenario_id IN (SELECT id FROM scenarios{where}) ORDER BY scored',
+                conn, params=params)
+        scored['preferred'] = scored['model_version'] == model_version
+        latest = scored.sort_values(['preferred', 'scored']).drop_duplicates('scenario_id', keep='last')
+        frame = saved.merge(latest[['scenario_id', 'model_version', 'cost']], how='left',
+                            left_on='id', right_on='scenario_id')
+        frame['inputs'] = frame['inputs'].map(json.loads)
+        return frame.drop(columns=['id', 'scenario_id']).set_index('name' if owner is not None else ['owner', 'name'])
+
+    def compare(self, owner, names, model_version=None):
+        """Side-by-side table of `owner`'s scenarios: one column per scenario, its inputs and stored cost as rows."""
+        stored = self.scenarios(owner, model_version).loc[list(names)]
+        columns = {name: {'cost': row['cost'], 'model_version': row['model_version'], 'currency': row['currency'],
+                          'unit': row['unit'], **row['inputs']}
+                   for name, row in stored.iterrows()}
+        rows = list(dict.fromkeys(key for column in columns.values() for key in column))
+        return pd.DataFrame(columns).reindex(rows)
+
+    def unscored(self, model_version):
+        """{scenario id: model inputs} of scenarios without a prediction from `model_version`."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT id, inputs, unit FROM scenarios WHERE id NOT IN '
+                '(SELECT scenario_id FROM predictions WHERE model_version = ?)', (model_version,)).fetchall()
+        return {scenario_id: model_inputs(json.loads(inputs), unit) for scenario_id, inputs, unit in rows}
+
+    def record(self, model_version, costs):
+        """Store {scenario id: cost} predicted by `model_version`."""
+        scored = _now()
+        with self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)',
+                             [(scenario_id, model_version, float(cost), scored) for scenario_id, cost in costs.items()])
+
+
+def rescore(store, predict_batch, model_version, batch_size=RESCORE_BATCH):
+    """Score every stored scenario `model_version` hasn't scored yet; returns how many."""
+    pending = store.unscored(model_version)
+    ids = list(pending)
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        costs = predict_batch(pd.DataFrame([pending[scenario_id] for scenario_id in batch]))
+        store.record(model_version, dict(zip(batch, costs)))
+    return len(ids)
+
+
+class ScenarioRescorer:
+    """Re-scores a ScenarioStore on a background thread whenever `model_handle` swaps versions."""
+
+    def __init__(self, model_handle, store, batch_size=RESCORE_BATCH):
+        self.model_handle = model_handle
+        self.store = store
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._thread = None
+        self._again = False
+        self.last_error = None
+        model_handle.on_swap(lambda old_version, new_version: self.start())
+
+    def start(self):
+        """Start a catch-up pass (or queue one if a pass is already running)."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                self._again = True
+                return
+            self._thread = threading.Thread(target=self._run, name='scenario-rescorer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        from transit_cost.inference import predict_cost
+
+        while True:
+            try:
+                # Read here, in the rescoring thread, rather than in the swap callback that started it
+                entry, model, schema = self.model_handle.served()
+                rescore(self.store, lambda raw: predict_cost(model, raw, schema), entry['version'], self.batch_size)
+                self.last_error = None
+            except Exception as exc:
+                self.last_error = exc
+            with self._lock:
+                if not self._again:
+                    self._thread = None
+                    return
+                self._again = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage saved calculator scenarios.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='show saved scenarios and their latest predicted cost')
+    commands.add_parser('rescore', help="score stored scenarios with the 'current' model")
+    delete_parser = commands.add_parser('delete', help='delete a saved scenario')
+    delete_parser.add_argument('owner')
+    delete_parser.add_argument('name')
+    args = parser.parse_args()
+
+    store = ScenarioStore()
+    if args.command == 'list':
+        print(store.scenarios(None).drop(columns='inputs').to_string())
+    elif args.command == 'rescore':
+        from transit_cost.inference import load_model, predict_cost
+        from transit_cost.registry import resolve
+        from transit_cost.schema import schema_for
+
+        entry = resolve()
+        model, schema = load_model(entry['artifact']), schema_for(entry)
+        count = rescore(store, lambda raw: predict_cost(model, raw, schema), entry['version'])
+        print(f"scored {count} scenarios with {entry['version']}")
+    elif args.command == 'delete':
+        print('deleted' if store.delete(args.owner, args.name) else f'{args.owner} has no scenario named {args.name}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+### Compiled feature schema of the user model.
+# Everything needed to turn raw scenarios into the model's input frame, emitted once by the
+# training pipeline (pickles/feature_schema.json, and a copy with every registered version):
+# column order and dtypes, Box-Cox lambdas, interaction definitions, the category
+# vocabulary seen in training and the bucket specs for raw city attributes.
+# FeatureSchema resolves all of it up front, so scoring a request is just array arithmetic.
+#
+#   python -m transit_cost.schema    # compile pickles/feature_schema.json from df_user & lambdas_dict
+import json
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from transit_cost.boxcox import boxcox, inv_boxcox
+from transit_cost.buckets import BUCKET_SPECS, SOIL_GROUPS, bucket, soil_type
+from transit_cost.features import (CAT_FEATS, INTERACTIONS, TARGET, TRANSFORMED_INPUTS, interaction_values,
+                                   model_feature_order)
+from transit_cost.paths import PICKLES_DIR
+
+SCHEMA_PATH = PICKLES_DIR / 'feature_schema.json'
+SOIL_TABLE = PICKLES_DIR / 'df_soil.pkl'
+
+# Numeric model inputs passed through unchanged
+PASSTHROUGH = ['start_year', 'end_year']
+
+
+def compile_schema(df_user, lambdas, feature_order=None, soil_classes=None):
+    """JSON-serializable schema for a model trained on `df_user`."""
+    feature_order = list(model_feature_order(df_user) if feature_order is None else feature_order)
+    boxcox_columns = {f'{feat}_transformed': feat for feat in TRANSFORMED_INPUTS}
+    columns = {}
+    for name in feature_order:
+        if name in PASSTHROUGH:
+            columns[name] = {'kind': 'input', 'dtype': str(df_user[name].dtype)}
+        elif name in boxcox_columns:
+            columns[name] = {'kind': 'boxcox', 'dtype': 'float64', 'input': boxcox_columns[name],
+                             'lambda': float(lambdas[name])}
+        elif name in INTERACTIONS:
+            columns[name] = {'kind': 'interaction', 'dtype': 'float64', **INTERACTIONS[name]}
+        elif name in CAT_FEATS:
+            columns[name] = {'kind': 'category', 'dtype': 'object',
+                             'categories': sorted(df_user[name].dropna().unique().tolist())}
+        else:
+            raise ValueError(f"don't know how to build model input {name}")
+    if soil_classes is None and os.path.exists(SOIL_TABLE):
+        with open(SOIL_TABLE, 'rb') as f:
+            soil = pickle.load(f)
+        soil_classes = dict(soil.drop_duplicates('wrb_class_value')[['wrb_class_value', 'wrb_class_name']].to_numpy())
+    return {
+        'feature_order': feature_order,
+        'columns': columns,
+        'target': {'name': TARGET, 'lambda': float(lambdas[TARGET])},
+        'buckets': {name: spec for name, spec in BUCKET_SPECS.items() if name in feature_order},
+        'soil_groups': SOIL_GROUPS,
+        'soil_classes': {str(value): name for value, name in (soil_classes or {}).items()},
+    }
+
+
+def save_schema(schema, path=SCHEMA_PATH):
+    with open(path, 'w') as f:
+        json.dump(schema, f, indent=2)
+
+
+def load_schema(path=SCHEMA_PATH):
+    with open(path) as f:
+        return json.load(f)
+
+
+class FeatureSchema:
+    """A compiled schema; `build` turns raw scenarios into the model's input frame."""
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.feature_order = schema['feature_order']
+        columns = schema['columns']
+        self.passthrough = [name for name in self.feature_order if columns[name]['kind'] == 'input']
+        self.boxcox = [(name, columns[name]['input'], columns[name]['lambda'])
+                       for name in self.feature_order if columns[name]['kind'] == 'boxcox']
+        self.interactions = [(name, columns[name]) for name in self.feature_order if columns[name]['kind'] == 'interaction']
+        # Vocabularies in the order the calculator offers them: bucket labels low to high, else as stored
+        self.categories = {name: self._ordered(name, columns[name]['categories'])
+                           for name in self.feature_order if columns[name]['kind'] == 'category'}
+        self.dtypes = {name: np.dtype(columns[name]['dtype']) for name in self.feature_order}
+        self.numeric = [name for name in self.feature_order if name not in self.categories]
+        self.target_lambda = schema['target']['lambda']
+        self.soil_classes = {float(value): name for value, name in schema.get('soil_classes', {}).items()}
+
+    def _ordered(self, name, vocabulary):
+        labels = self.schema['buckets'].get(name, {}).get('labels', [])
+        return [*(label for label in labels if label in vocabulary),
+                *(value for value in vocabulary if value not in labels)]
+
+    @property
+    def inputs(self):
+        """Raw columns a scenario needs."""
+        return [*self.passthrough, *dict.fromkeys(raw for _, raw, _ in self.boxcox), *self.categories]
+
+    def _category(self, raw, name):
+        if name in raw.columns:
+            return raw[name].to_numpy(dtype=object)
+        # Batch scoring can pass raw city attributes instead of their buckets
+        spec = self.schema['buckets'].get(name)
+        if spec is not None and spec['column'] in raw.columns:
+            return np.asarray(bucket(raw[spec['column']], spec), dtype=object)
+        if name == 'soil_type' and 'wrb_class_value' in raw.columns:
+            return np.asarray(soil_type(raw['wrb_class_value'], self.soil_classes, self.schema['soil_groups']), dtype=object)
+        raise KeyError(f'scenarios need a {name} column')
+
+    def matrix(self, raw):
+        """(numeric block, {categorical column: values}) for raw scenarios.
+
+        The numeric block is one C-contiguous float array with the numeric inputs in model order.
+        """
+        raw = pd.DataFrame(raw)
+        values = {name: self._category(raw, name) for name in self.categories}
+        for name in self.passthrough:
+            values[name] = raw[name].to_numpy(dtype=float)
+        for name, raw_name, lmbda in self.boxcox:
+            values[name] = boxcox(raw[raw_name].to_numpy(dtype=float) + 1, lmbda)
+        for name, definition in self.interactions:
+            values[name] = interaction_values(definition, values)
+        numeric = np.empty((len(raw), len(self.numeric)))
+        for i, name in enumerate(self.numeric):
+            numeric[:, i] = values[name]
+        return numeric, {name: values[name] for name in self.categories}
+
+    def build(self, raw):
+        """Model input frame (columns in training order and dtype) for raw scenarios."""
+        numeric, categorical = self.matrix(raw)
+        columns = {name: numeric[:, i].astype(self.dtypes[name], copy=False) for i, name in enumerate(self.numeric)}
+        columns.update(categorical)
+        return pd.DataFrame({name: columns[name] for name in self.feature_order})
+
+    def raw_inputs(self, features):
+        """Raw scenarios that `build` turns back into the model input frame `features`."""
+        raw = pd.DataFrame(index=features.index)
+        for name in self.passthrough:
+            raw[name] = features[name]
+        for name, raw_name, lmbda in self.boxcox:
+            raw[raw_name] = inv_boxcox(features[name].to_numpy(dtype=float), lmbda) - 1
+        for name in self.categories:
+            raw[name] = features[name]
+        return raw
+
+    def unknown_categories(self, raw):
+        """{column: values not seen in training} for raw scenarios."""
+        raw = pd.DataFrame(raw)
+        unknown = {}
+        for name, vocabulary in self.categories.items():
+            values = set(self._category(raw, name)) - set(vocabulary)
+            if values:
+                unknown[name] = sorted(values, key=str)
+        return unknown
+
+
+def schema_for(entry):
+    """FeatureSchema of a registry entry; entries registered without one are compiled from df_user."""
+    if entry.get('schema'):
+        return FeatureSchema(entry['schema'])
+    with open(PICKLES_DIR / 'df_user.pkl', 'rb') as f:
+        df_user = pickle.load(f)
+    return FeatureSchema(compile_schema(df_user, entry['lambdas'], entry['feature_order']))
+
+
+def main():
+    with open(PICKLES_DIR / 'df_user.pkl', 'rb') as f:
+        df_user = pickle.load(f)
+    with open(PICKLES_DIR / 'lambdas_dict.pkl', 'rb') as f:
+        lambdas = pickle.load(f)
+    schema = compile_schema(df_user, lambdas)
+    save_schema(schema)
+    print(f"wrote {SCHEMA_PATH} ({len(schema['feature_order'])} inputs)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+### Telemetry of calculator predictions and running drift statistics.
+# Every calculator prediction (its inputs, predicted cost, latency and the model version
+# that scored it) is appended to an in-process deque, which needs no lock to append to, so
+# recording one costs the prediction path about a microsecond. A background thread drains
+# the deque every FLUSH_INTERVAL seconds into append-only Parquet files under telemetry/
+# (one row group per flush). A file is written as `.parquet.part` and renamed once it is
+# rotated (ROTATE_ROWS rows or ROTATE_SECONDS old) or the app exits, so readers only ever
+# see complete files.
+#
+# The same thread keeps running histograms of the logged inputs (bin edges are the training
+# quantiles of df_user) and category counts, saved to telemetry/drift_state.json after each
+# flush. A drift report (PSI per input, and KS for the numeric ones, against df_user) is
+# therefore a few array operations and never rescans the logs.
+#
+#   python -m transit_cost.telemetry drift      # drift report from the saved running state
+#   python -m transit_cost.telemetry rebuild    # recompute the running state from the Parquet logs
+import argparse
+import atexit
+import json
+import os
+import pickle
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+import numpy as np
+import pandas as pd
+
+from transit_cost.boxcox import inv_boxcox
+from transit_cost.features import CAT_FEATS, TARGET
+from transit_cost.paths import PICKLES_DIR, ROOT
+
+TELEMETRY_DIR = ROOT / 'telemetry'
+FLUSH_INTERVAL = 2.0
+ROTATE_ROWS = 50000
+ROTATE_SECONDS = 3600
+# Records held while the writer is behind; the oldest are dropped beyond this
+MAX_QUEUED = 100000
+
+NUMERIC_INPUTS = ['length', 'tunnel', 'at_grade', 'elevated', 'stations', 'duration', 'start_year', 'end_year']
+DRIFT_BINS = 20
+# Population stability index thresholds of the report's status column
+PSI_WATCH = 0.1
+PSI_DRIFT = 0.25
+# Floor on bin shares, so empty bins don't make the PSI infinite
+PSI_EPSILON = 1e-4
+
+
+def _columns():
+    import pyarrow as pa
+
+    return pa.schema([
+        ('logged_at', pa.timestamp('ms', tz='UTC')),
+        ('model_version', pa.string()),
+        ('cost', pa.float64()),
+        ('latency_ms', pa.float64()),
+        ('cached', pa.bool_()),
+        *[(name, pa.float64()) for name in NUMERIC_INPUTS],
+        *[(name, pa.string()) for name in CAT_FEATS],
+    ])
+
+
+def _frame(records):
+    """Log rows for (logged_at, inputs, cost, latency, model_version, cached) records."""
+    frame = pd.DataFrame.from_records([inputs for _, inputs, _, _, _, _ in records])
+    frame = frame.reindex(columns=[*NUMERIC_INPUTS, *CAT_FEATS])
+    frame[NUMERIC_INPUTS] = frame[NUMERIC_INPUTS].apply(pd.to_numeric, errors='coerce')
+    frame[CAT_FEATS] = frame[CAT_FEATS].applymap(lambda value: None if pd.isna(value) else str(value))
+    meta = pd.DataFrame({
+        'logged_at': pd.to_datetime([round(1000 * record[0]) for record in records], unit='ms', utc=True),
+        'model_version': [record[4] for record in records],
+        'cost': [float(record[2]) for record in records],
+        'latency_ms': [1000 * record[3] for record in records],
+        'cached': [bool(record[5]) for record in records],
+    })
+    return pd.concat([meta, frame], axis=1)
+
+
+### Drift
+def reference_inputs():
+    """Training scenarios (df_user) as raw calculator inputs, with their cost in millions of 2023 USD."""
+    from transit_cost.schema import SCHEMA_PATH, FeatureSchema, compile_schema, load_schema
+
+    with open(PICKLES_DIR / 'df_user.pkl', 'rb') as f:
+        df_user = pickle.load(f)
+    if os.path.exists(SCHEMA_PATH):
+        schema = FeatureSchema(load_schema())
+    else:
+        with open(PICKLES_DIR / 'lambdas_dict.pkl', 'rb') as f:
+            schema = FeatureSchema(compile_schema(df_user, pickle.load(f)))
+    raw = schema.raw_inputs(df_user)
+    raw['length'] = raw['tunnel'] + raw['at_grade'] + raw['elevated']
+    raw['cost'] = inv_boxcox(df_user[TARGET].to_numpy(dtype=float), schema.target_lambda)
+    return raw
+
+
+def psi(expected, actual, epsilon=PSI_EPSILON):
+    """Population stability index between two histograms over the same bins."""
+    expected = np.maximum(np.asarray(expected, dtype=float) / max(np.sum(expected), 1), epsilon)
+    actual = np.maximum(np.asarray(actual, dtype=float) / max(np.sum(actual), 1), epsilon)
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+
+def binned_ks(expected, actual):
+    """Kolmogorov-Smirnov statistic between two histograms over the same ordered bins.
+
+    Only compares the CDFs at the bin edges, so it is a lower bound on the exact statistic.
+    """
+    expected = np.cumsum(expected) / max(np.sum(expected), 1)
+    actual = np.cumsum(actual) / max(np.sum(actual), 1)
+    return float(np.max(np.abs(expected - actual)))
+
+
+class DriftMonitor:
+    """Running histograms of logged predictions against the training distribution."""
+
+    def __init__(self, reference, bins=DRIFT_BINS):
+        self.numeric = [name for name in [*NUMERIC_INPUTS, 'cost'] if name in reference.columns]
+        self.categorical = [name for name in CAT_FEATS if name in reference.columns]
+        # Inner edges only: values beyond the training range land in the first or last bin
+        self.edges = {name: np.unique(np.nanquantile(reference[name].to_numpy(dtype=float),
+                                                     np.linspace(0, 1, bins + 1)))[1:-1].tolist()
+                      for name in self.numeric}
+        self.expected = {name: self._histogram(name, reference[name]) for name in self.numeric}
+        self.expected.update({name: Counter(reference[name].dropna().astype(str)) for name in self.categorical})
+        self.counts = {name: np.zeros(len(self.edges[name]) + 1, dtype=np.int64) for name in self.numeric}
+        self.counts.update({name: Counter() for name in self.categorical})
+        self.n = 0
+        self._lock = threading.Lock()
+
+    def _histogram(self, name, values):
+        values = pd.to_numeric(values, errors='coerce').to_numpy(dtype=float)
+        values = values[~np.isnan(values)]
+        return np.bincount(np.searchsorted(self.edges[name], values, side='right'), minlength=len(self.edges[name]) + 1)
+
+    def update(self, frame):
+        """Add a frame of log rows to the running counts."""
+        numeric = {name: self._histogram(name, frame[name]) for name in self.numeric if name in frame.columns}
+        categorical = {name: Counter(frame[name].dropna().astype(str)) for name in self.categorical if name in frame.columns}
+        with self._lock:
+            for name, counts in numeric.items():
+                self.counts[name] += counts
+            for name, counts in categorical.items():
+                self.counts[name].update(counts)
+            self.n += len(frame)
+
+    def report(self):
+        """PSI (and binned KS for numeric inputs) of the logged predictions against training."""
+        with self._lock:
+            counts = {name: counts.copy() for name, counts in self.counts.items()}
+            n = self.n
+        rows = {}
+        for name in self.numeric:
+            rows[name] = {'kind': 'numeric', 'logged': int(counts[name].sum()),
+                          'psi': psi(self.expected[name], counts[name]), 'ks': binned_ks(self.expected[name], counts[name])}
+        for name in self.categorical:
+            categories = sorted(set(self.expected[name]) | set(counts[name]))
+            expected = [self.expected[name][category] for category in categories]
+            actual = [counts[name][category] for category in categories]
+            unseen = sum(count for category, count in counts[name].items() if category not in self.expected[name])
+            rows[name] = {'kind': 'category', 'logged': sum(actual), 'psi': psi(expected, actual), 'ks': np.nan,
+                          'unseen': unseen / max(sum(actual), 1)}
+        report = pd.DataFrame(rows).T.infer_objects()
+        report['status'] = np.where(report['logged'] == 0, 'no data',
+                                    np.where(report['psi'] >= PSI_DRIFT, 'drift',
+                                             np.where(report['psi'] >= PSI_WATCH, 'watch', 'stable')))
+        report.attrs['predictions'] = n
+        return report.sort_values('psi', ascending=False)
+
+    def state(self):
+        with self._lock:
+            return {
+                'edges': self.edges,
+                'counts': {name: (counts.tolist() if name in self.edges else dict(counts))
+                           for name, counts in self.counts.items()},
+                'n': self.n,
+            }
+
+    def restore(self, state):
+        """Continue from a saved state; ignored if it was binned differently (e.g. retrained on new data)."""
+        if state.get('edges') != self.edges:
+            return False
+        with self._lock:
+            for name in self.numeric:
+                self.counts[name] = np.asarray(state['counts'][name], dtype=np.int64)
+            for name in self.categorical:
+                self.counts[name] = Counter(state['counts'].get(name, {}))
+            self.n = state['n']
+        return True
+
+
+### Log writer
+class PredictionLog:
+    """Append-only Parquet log of predictions, written by a background thread, plus running drift statistics.
+
+    `record` is the only call made from the prediction path.
+    """
+
+    def __init__(self, directory=TELEMETRY_DIR, flush_interval=FLUSH_INTERVAL, rotate_rows=ROTATE_ROWS,
+                 rotate_seconds=ROTATE_SECONDS, reference=None):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.rotate_rows = rotate_rows
+        self.rotate_seconds = rotate_seconds
+        self._reference = reference
+        self._queue = deque(maxlen=MAX_QUEUED)
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._writer = None
+        self._path = None
+        self._opened = None
+        self._rows = 0
+        self.drift = None
+        self.last_error = None
+
+    def record(self, inputs, cost, latency, model_version, cached=False):
+        """Queue one prediction: its inputs, cost, seconds until the result and model version."""
+        self._queue.append((time.time(), inputs, cost, latency, model_version, cached))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='telemetry-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """Write what is queued and complete the current file."""
+        self._stop.set()
+        self.flush()
+        with self._write_lock:
+            self._rotate()
+
+    def drift_report(self):
+        if self.drift is None:
+            self._load_drift()
+        return self.drift.report()
+
+    @property
+    def state_path(self):
+        return self.directory / 'drift_state.json'
+
+    def _load_drift(self):
+        with self._write_lock:
+            if self.drift is not None:
+                return
+            drift = DriftMonitor(reference_inputs() if self._reference is None else self._reference)
+            if os.path.exists(self.state_path):
+                with open(self.state_path) as f:
+                    drift.restore(json.load(f))
+            self.drift = drift
+
+    def flush(self):
+        """Drain the queue into the current Parquet file and the drift counts."""
+        records = []
+        while True:
+            try:
+                records.append(self._queue.popleft())
+            except IndexError:
+                break
+        if not records:
+            return 0
+        try:
+            if self.drift is None:
+                self._load_drift()
+            frame = _frame(records)
+            with self._write_lock:
+                self._write(frame)
+                self.drift.update(frame)
+                self._save_state()
+            self.last_error = None
+        except Exception as exc:
+            # Telemetry must never take the app down; the records of a failed flush are lost.
+            # Reported once when flushes start failing, not on every interval after that
+            if self.last_error is None:
+                print(f'prediction telemetry: flush failed, {len(records)} records lost: {exc!r}', file=sys.stderr)
+            self.last_error = exc
+        return len(records)
+
+    def _write(self, frame):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self._writer is not None and (self._rows >= self.rotate_rows
+                                         or time.time() - self._opened >= self.rotate_seconds):
+            self._rotate()
+        if self._writer is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+            self._path = self.directory / f'predictions-{stamp}-{os.getpid()}.parquet.part'
+            self._writer = pq.ParquetWriter(str(self._path), _columns())
+            self._opened = time.time()
+            self._rows = 0
+        self._writer.write_table(pa.Table.from_pandas(frame, schema=_columns(), preserve_index=False))
+        self._rows += len(frame)
+
+    def _rotate(self):
+        # Called with the write lock held
+        if self._writer is None:
+            return
+        self._writer.close()
+        os.replace(self._path, self._path.with_suffix(''))
+        self._writer = None
+
+    def _save_state(self):
+        # Called with the write lock held
+        save_state(self.drift, self.state_path)
+
+
+def save_state(drift, path):
+    # Written whole then renamed, so a crash leaves the previous state
+    partial = path.with_suffix('.json.part')
+    with open(partial, 'w') as f:
+        json.dump(drift.state(), f)
+    os.replace(partial, path)
+
+
+def log_files(directory=TELEMETRY_DIR):
+    """Completed Parquet log files, oldest first."""
+    return sorted(directory.glob('predictions-*.parquet'))
+
+
+def rebuild(directory=TELEMETRY_DIR, reference=None):
+    """DriftMonitor recomputed from every completed log file, saved as the running state."""
+    import pyarrow.parquet as pq
+
+    drift = DriftMonitor(reference_inputs() if reference is None else reference)
+    for path in log_files(directory):
+        drift.update(pq.read_table(path).to_pandas())
+    directory.mkdir(parents=True, exist_ok=True)
+    save_state(drift, directory / 'drift_state.json')
+    return drift
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prediction telemetry and drift against the training data.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('drift', help='drift report from the saved running state')
+    commands.add_parser('rebuild', help='recompute the running state from the Parquet logs')
+    args = parser.parse_args()
+
+    if args.command == 'drift':
+        drift = DriftMonitor(reference_inputs())
+        if not os.path.exists(TELEMETRY_DIR / 'drift_state.json'):
+            print('no telemetry recorded yet')
+            return
+        with open(TELEMETRY_DIR / 'drift_state.json') as f:
+            if not drift.restore(json.load(f)):
+                print("the saved state was binned against different training data; run 'rebuild'")
+                return
+    else:
+        drift = rebuild()
+        print(f'rebuilt from {len(log_files())} log files')
+    report = drift.report()
+    print(f"{report.attrs['predictions']} predictions logged")
+    print(report.to_string(float_format='{:.4f}'.format))
+
+
+if __name__ == '__main__':
+    main()
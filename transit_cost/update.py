@@ -0,0 +1,228 @@
+### Warm-start updates of the blended user model.
+# A full retrain reruns the 10-fold, 50-iteration tune_model searches for both CatBoost and
+# ExtraTrees. When a refresh only adds a few projects, the tuned hyperparameters are still
+# good, so an update keeps the fitted preprocessing and the current model's components and:
+#   - continues boosting the CatBoost component from its trees (CatBoost's init_model),
+#   - grows extra trees for the (bagged) ExtraTrees component with warm_start,
+#   - re-picks the blend weights on the validation rows.
+# If the current model already does much worse on the new validation rows than it did when
+# it was registered (DRIFT_METRIC, in millions of 2023 USD, against the same metric in its
+# registry entry), the data has drifted too far for that and a full retrain runs instead. So
+# does an entry with no DRIFT_METRIC to compare against, e.g. the unregistered legacy model.
+#
+#   python -m transit_cost.update                    # update the 'current' model on pickles/df_user.pkl
+#   python -m transit_cost.update --compare          # ... and also retrain fully to compare
+import argparse
+import copy
+import pickle
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from transit_cost.boxcox import inv_boxcox
+from transit_cost.features import TARGET, model_feature_order
+from transit_cost.inference import blend_parts, load_model
+from transit_cost.paths import PICKLES_DIR
+from transit_cost.pipeline import CACHE_DIR, STAGES
+
+# Retrain fully when the current model's validation DRIFT_METRIC is this many times its registered one
+DRIFT_METRIC = 'MAE (USD millions)'
+DRIFT_LIMIT = 1.25
+WEIGHT_STEP = 0.05
+
+
+def _features(preprocess, df):
+    X = df.drop(columns=[TARGET])
+    return X if preprocess is None else preprocess.transform(X)
+
+
+def continue_boosting(model, X, y, extra_iterations):
+    """Copy of a fitted CatBoost model boosted `extra_iterations` more rounds on (X, y)."""
+    # A fitted CatBoost model can't be re-parameterised; start from its params instead
+    updated = type(model)(**dict(model.get_params(), iterations=extra_iterations, verbose=False))
+    updated.fit(X, y, init_model=model)
+    return updated
+
+
+def grow_trees(model, X, y, growth):
+    """Copy of a fitted forest/bagging model with `growth` times as many estimators again, fitted on (X, y)."""
+    updated = copy.deepcopy(model)
+    updated.set_params(warm_start=True, n_estimators=model.n_estimators + max(1, round(model.n_estimators * growth)))
+    updated.fit(X, y)
+    updated.set_params(warm_start=False)
+    return updated
+
+
+def update_component(model, X, y, extra_iterations, growth):
+    if type(model).__name__ == 'CatBoostRegressor':
+        return continue_boosting(model, X, y, extra_iterations)
+    if 'warm_start' in model.get_params():
+        return grow_trees(model, X, y, growth)
+    raise TypeError(f"don't know how to warm-start {type(model).__name__}")
+
+
+def blend_weights(predictions, y, step=WEIGHT_STEP):
+    """Weights (summing to 1) for two components minimising MAE on the validation rows."""
+    grid = np.round(np.arange(0, 1 + step / 2, step), 4)
+    errors = [np.abs(w * predictions[:, 0] + (1 - w) * predictions[:, 1] - y).mean() for w in grid]
+    best = grid[int(np.argmin(errors))]
+    return [float(best), float(1 - best)]
+
+
+def scores(model, df, lambdas):
+    predicted = model.predict(df.drop(columns=[TARGET]))
+    actual = df[TARGET].to_numpy()
+    residual = predicted - actual
+    cost_error = inv_boxcox(predicted, lambdas[TARGET]) - inv_boxcox(actual, lambdas[TARGET])
+    return {
+        'MAE': float(np.abs(residual).mean()),
+        'R2': float(1 - (residual ** 2).sum() / ((actual - actual.mean()) ** 2).sum()),
+        'MAE (USD millions)': float(np.abs(cost_error).mean()),
+    }
+
+
+def warm_start(model, train, validation, extra_iterations=200, growth=0.2):
+    """Updated copy of a fitted blend; the preprocessing is kept as fitted."""
+    preprocess, blend = blend_parts(model)
+    X_train, y_train = _features(preprocess, train), train[TARGET].to_numpy()
+    X_valid, y_valid = _features(preprocess, validation), validation[TARGET].to_numpy()
+
+    components = [update_component(est, X_train, y_train, extra_iterations, growth) for est in blend.estimators_]
+    updated_blend = copy.copy(blend)
+    updated_blend.estimators_ = components
+    updated_blend.named_estimators_ = type(blend.named_estimators_)(
+        **{name: est for (name, _), est in zip(blend.estimators, components)})
+    if len(components) == 2:
+        predictions = np.column_stack([est.predict(X_valid) for est in components])
+        updated_blend.weights = blend_weights(predictions, y_valid)
+
+    if preprocess is None:
+        return updated_blend
+    updated = copy.copy(model)
+    updated.steps = [*model.steps[:-1], (model.steps[-1][0], updated_blend)]
+    return updated
+
+
+def full_retrain(train, validation):
+    """The notebook-10 tune/bag/blend procedure (needs pycaret)."""
+    result = STAGES['user_model']({'split': {'data': train, 'data_unseen': validation}})
+    return result['model']
+
+
+def update_model(model, entry, train, validation, drift_limit=DRIFT_LIMIT, compare=False, **kwargs):
+    """Warm-start `model` (the registry `entry` it was loaded from) on new data.
+
+    Falls back to a full retrain when its validation DRIFT_METRIC has drifted past
+    `drift_limit` times the registered one, or when the entry has no DRIFT_METRIC (there is
+    then nothing to tell drift from). Returns (new model, report).
+    """
+    lambdas = entry['lambdas']
+    before = scores(model, validation, lambdas)
+    registered = entry['metrics'].get(DRIFT_METRIC)
+    drift = before[DRIFT_METRIC] / registered if registered else None
+    report = {'parent': entry['version'], 'drift': drift, 'before': before}
+
+    start = time.perf_counter()
+    if drift is None or drift > drift_limit:
+        report['mode'] = 'retrain'
+        updated = full_retrain(train, validation)
+    else:
+        report['mode'] = 'update'
+        updated = warm_start(model, train, validation, **kwargs)
+    report['seconds'] = time.perf_counter() - start
+    report['after'] = scores(updated, validation, lambdas)
+
+    if compare and report['mode'] == 'update':
+        start = time.perf_counter()
+        retrained = full_retrain(train, validation)
+        report['retrain_seconds'] = time.perf_counter() - start
+        report['retrain'] = scores(retrained, validation, lambdas)
+    elif 'fit_seconds' in entry['metrics']:
+        report['retrain_seconds'] = entry['metrics']['fit_seconds']
+    return updated, report
+
+
+def print_report(report):
+    print(f"{report['mode']} of {report['parent']} in {report['seconds']:.1f}s", end='')
+    if report.get('retrain_seconds'):
+        print(f" (full retrain: {report['retrain_seconds']:.1f}s, saved {report['retrain_seconds'] - report['seconds']:.1f}s)")
+    else:
+        print()
+    if report['drift'] is not None:
+        print(f"validation / registered {DRIFT_METRIC}: {report['drift']:.2f} (limit {DRIFT_LIMIT})")
+    else:
+        print(f"{report['parent']} has no registered {DRIFT_METRIC} to measure drift against; retrained fully")
+    rows = {'current model': report['before'], report['mode']: report['after']}
+    if 'retrain' in report:
+        rows['full retrain'] = report['retrain']
+    print(pd.DataFrame(rows).T.to_string(float_format='{:.4f}'.format))
+
+
+def _load_pickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def split_new_rows(df_user, data, data_unseen, frac=0.8, random_state=786):
+    """Train/validation frames for an update.
+
+    Rows the current model was trained on (`data`) stay in training and its holdout
+    (`data_unseen`) stays in validation; only projects new to `df_user` are split, the
+    same way notebook 10 splits, so nothing the model has seen is used to validate it.
+    """
+    seen = pd.concat([data, data_unseen])
+    new_rows = df_user.merge(seen.drop_duplicates(), how='left', indicator=True)
+    new_rows = new_rows[new_rows['_merge'] == 'left_only'].drop(columns='_merge')
+    new_train = new_rows.sample(frac=frac, random_state=random_state)
+    train = pd.concat([data, new_train], ignore_index=True)
+    validation = pd.concat([data_unseen, new_rows.drop(new_train.index)], ignore_index=True)
+    return train, validation, len(new_rows)
+
+
+def main():
+    from transit_cost.registry import DEFAULT_ALIAS, register_model, resolve
+
+    parser = argparse.ArgumentParser(description='Update the user model on new data without a full retrain.')
+    parser.add_argument('--alias', default=DEFAULT_ALIAS, help='registry alias of the model to update')
+    parser.add_argument('--data', default=str(PICKLES_DIR / 'df_user.pkl'), help='refreshed df_user')
+    parser.add_argument('--extra-iterations', type=int, default=200, help='CatBoost rounds to add')
+    parser.add_argument('--growth', type=float, default=0.2, help='fraction of ExtraTrees estimators to add')
+    parser.add_argument('--drift-limit', type=float, default=DRIFT_LIMIT)
+    parser.add_argument('--compare', action='store_true', help='also run a full retrain and compare')
+    parser.add_argument('--promote', action='store_true', help='promote the new version and save its train/validation split')
+    args = parser.parse_args()
+
+    entry = resolve(args.alias)
+    model = load_model(entry['artifact'])
+    df_user, data, data_unseen = (_load_pickle(path) for path in
+                                  (args.data, PICKLES_DIR / 'data_user.pkl', PICKLES_DIR / 'data_user_unseen.pkl'))
+    train, validation, n_new = split_new_rows(df_user, data, data_unseen)
+    print(f'{n_new} new projects; {len(train)} training rows, {len(validation)} validation rows')
+    updated, report = update_model(model, entry, train, validation, args.drift_limit, args.compare,
+                                   extra_iterations=args.extra_iterations, growth=args.growth)
+    print_report(report)
+
+    CACHE_DIR.mkdir(exist_ok=True)
+    artifact = CACHE_DIR / f"{report['mode']}-of-{entry['version']}.pkl"
+    joblib.dump(updated, artifact)
+    metrics = dict(report['after'])
+    if report['mode'] == 'retrain':
+        metrics['fit_seconds'] = report['seconds']
+    else:
+        metrics['update_seconds'] = report['seconds']
+        if report.get('retrain_seconds'):
+            metrics['fit_seconds'] = report['retrain_seconds']
+    version = register_model(artifact, model_feature_order(df_user), entry['lambdas'], metrics, promote=args.promote,
+                             schema=entry.get('schema'))
+    print(f'registered {version}' + (' (promoted)' if args.promote else ''))
+    if args.promote:
+        # The next update needs to know what this version was trained and validated on
+        for frame, name in ((train, 'data_user.pkl'), (validation, 'data_user_unseen.pkl')):
+            with open(PICKLES_DIR / name, 'wb') as f:
+                pickle.dump(frame, f)
+
+
+if __name__ == '__main__':
+    main()
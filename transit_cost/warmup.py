@@ -0,0 +1,272 @@
+### Start-up warm-up and readiness probe for the Streamlit app.
+# Streamlit only runs the app script when the first visitor connects, so on a cold container
+# that visitor pays for deserializing the model, the lazy imports inside sklearn/CatBoost and
+# the first scoring calls. The app's shared resources (model handle, prediction worker,
+# what-if curve cache, scenario store, dataset explorer) are therefore built here, once per process, and a
+# warm-up pass loads the model and runs representative calculator scenarios through them,
+# filling the prediction and curve caches.
+#
+# A small HTTP server answers the orchestrator's probes:
+#   GET /ready   200 once warm-up has finished, 503 before (or if it failed)
+#   GET /warmup  warm-up status and per-step timings as JSON
+#   GET /drift   drift of the logged calculator predictions against training (transit_cost.telemetry),
+#                for operators only: send the profiling token (PROFILE_TOKEN) as
+#                `Authorization: Bearer <token>`; without one set, /drift answers 403 to everyone
+#
+#   python -m transit_cost.warmup                       # run the warm-up here and print the timings
+#   python -m transit_cost.warmup --serve [-- ARGS]     # warm up while starting `streamlit run streamlit/app.py ARGS`
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from transit_cost.calculator import FEATURE_RANGES_KM, SUB_REGIONS_BY_REGION
+from transit_cost.paths import ROOT
+
+READINESS_PORT = int(os.environ.get('READINESS_PORT', 8502))
+APP_PATH = ROOT / 'streamlit' / 'app.py'
+
+
+class AppResources:
+    """Everything the app shares between sessions, built once per process."""
+
+    def __init__(self):
+        from transit_cost.accuracy import SegmentMetrics
+        from transit_cost.comparables import load_index
+        from transit_cost.explorer import Explorer
+        from transit_cost.live import worker_for
+        from transit_cost.registry import ModelHandle
+        from transit_cost.scenarios import ScenarioRescorer, ScenarioStore
+        from transit_cost.telemetry import PredictionLog
+        from transit_cost.whatif import curve_cache_for
+
+        self.model_handle = ModelHandle()
+        self.telemetry = PredictionLog().start()
+        self.prediction_worker = worker_for(self.model_handle, telemetry=self.telemetry)
+        self.curve_cache = curve_cache_for(self.model_handle)
+        self.scenario_store = ScenarioStore()
+        self.explorer = Explorer()
+        self.comparables = load_index()
+        self.segment_metrics = SegmentMetrics(self.model_handle)
+        # Saved scenarios are re-scored in the background when a new version is promoted,
+        # and once now in case one was promoted while the app was down
+        ScenarioRescorer(self.model_handle, self.scenario_store).start()
+
+
+_resources = None
+_resources_lock = threading.Lock()
+
+
+def app_resources():
+    global _resources
+    with _resources_lock:
+        if _resources is None:
+            _resources = AppResources()
+        return _resources
+
+
+### Scenarios
+def calculator_inputs(categories, **overrides):
+    """Calculator inputs as the app submits them: the widgets' defaults, then `overrides`.
+
+    `categories` is the served schema's vocabulary, which the widgets offer in order.
+    Values have the types the widgets return, so warmed cache entries match real requests.
+    """
+    inputs = {
+        'length': float(FEATURE_RANGES_KM['length'][0]), 'tunnel': 0.0, 'at_grade': 0.0, 'elevated': 0.0,
+        'duration': int(FEATURE_RANGES_KM['duration'][0]), 'stations': int(FEATURE_RANGES_KM['stations'][0]),
+        'start_year': 2023,
+        **{feat: options[0] for feat, options in categories.items()},
+        'project_type': 'New',
+    }
+    inputs.update(overrides)
+    choices = SUB_REGIONS_BY_REGION.get(inputs['region'], categories['sub_region'])
+    if 'sub_region' not in overrides:
+        trained = [choice for choice in choices if choice in categories['sub_region']]
+        inputs['sub_region'] = (trained or choices)[0]
+    inputs['end_year'] = inputs['start_year'] + inputs['duration']
+    return inputs
+
+
+def representative_scenarios(categories):
+    """The default scenario and variations on it covering every train type and region."""
+    scenarios = [calculator_inputs(categories)]
+    for train_type in categories['train_type']:
+        for length, tunnel_share in ((5.0, 0.0), (10.0, 0.5), (20.0, 1.0)):
+            scenarios.append(calculator_inputs(
+                categories, train_type=train_type, length=length, tunnel=length * tunnel_share,
+                at_grade=length * (1 - tunnel_share), stations=int(length), duration=5))
+    for region in categories['region']:
+        scenarios.append(calculator_inputs(categories, region=region, length=10.0, tunnel=10.0, stations=8, duration=6))
+    return scenarios
+
+
+### Warm-up
+class WarmupState:
+    def __init__(self):
+        self.ready = threading.Event()
+        self.started = None
+        self.finished = None
+        self.timings = {}
+        self.error = None
+        self.scenarios = 0
+
+    def as_dict(self):
+        return {
+            'ready': self.ready.is_set(),
+            'started': self.started,
+            'finished': self.finished,
+            'seconds': {step: round(seconds, 4) for step, seconds in self.timings.items()},
+            'scenarios': self.scenarios,
+            'error': None if self.error is None else repr(self.error),
+        }
+
+
+WARMUP = WarmupState()
+
+
+def run_warmup(state=WARMUP, resources=None):
+    """Load the model & artifacts and run representative scenarios through the app's caches."""
+    state.started = time.time()
+
+    def step(name, func):
+        start = time.perf_counter()
+        result = func()
+        state.timings[name] = time.perf_counter() - start
+        return result
+
+    try:
+        resources = step('resources', lambda: resources or app_resources())
+        handle = resources.model_handle
+        step('load model', lambda: handle.model)
+        schema = step('load schema', lambda: handle.schema)
+        scenarios = representative_scenarios(schema.categories)
+        state.scenarios = len(scenarios)
+        worker = resources.prediction_worker
+        # Warm-up requests are kept out of the telemetry, which is for visitors' scenarios
+        step('first prediction', lambda: worker.submit(f'warmup-{uuid.uuid4().hex}', scenarios[0], record=False).result())
+        # One session per scenario so none supersedes another; the worker scores them as one batch
+        step('prediction cache', lambda: [future.result() for future in
+                                          [worker.submit(f'warmup-{uuid.uuid4().hex}', inputs, record=False)
+                                           for inputs in scenarios]])
+        # Rebuilds the Data page's explorer database if a source pickle has changed
+        step('dataset explorer', lambda: [resources.explorer.options(dataset) for dataset in resources.explorer.datasets])
+        step('comparable projects', lambda: [resources.comparables.query(inputs) for inputs in scenarios])
+        step('what-if curves', lambda: [resources.curve_cache.curves(inputs) for inputs in scenarios])
+        step('segment metrics', resources.segment_metrics.report)
+        # The calculator page imports its plotting library on first use
+        step('plotting imports', lambda: __import__('plotly.graph_objects'))
+    except Exception as exc:
+        state.error = exc
+    finally:
+        state.finished = time.time()
+        state.timings['total'] = state.finished - state.started
+    if state.error is None:
+        state.ready.set()
+    return state
+
+
+### Readiness probe
+class _ProbeHandler(BaseHTTPRequestHandler):
+    state = WARMUP
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/ready':
+            status, payload = 200 if self.state.ready.is_set() else 503, self.state.as_dict()
+        elif self.path.rstrip('/') == '/warmup':
+            status, payload = 200, self.state.as_dict()
+        elif self.path.rstrip('/') == '/drift':
+            status, payload = self._drift() if self._operator() else (403, {'error': 'operator token required'})
+        else:
+            self.send_error(404)
+            return
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _operator(self):
+        from transit_cost.profiling import is_operator
+
+        scheme, _, token = self.headers.get('Authorization', '').partition(' ')
+        return scheme.lower() == 'bearer' and is_operator(token.strip())
+
+    def _drift(self):
+        if _resources is None:
+            return 503, {'error': 'the app has not started yet'}
+        try:
+            report = _resources.telemetry.drift_report()
+        except Exception as exc:
+            return 500, {'error': repr(exc)}
+        return 200, {'predictions': report.attrs['predictions'],
+                     'inputs': json.loads(report.to_json(orient='index'))}
+
+    def log_message(self, format, *args):
+        # Probes hit this every few seconds; keep them out of the app's logs
+        pass
+
+
+def serve_probes(port=READINESS_PORT, state=WARMUP):
+    """Serve /ready, /warmup and the operators' /drift on a daemon thread; None if the port is taken."""
+    handler = type('ProbeHandler', (_ProbeHandler,), {'state': state})
+    try:
+        server = ThreadingHTTPServer(('0.0.0.0', port), handler)
+    except OSError as exc:
+        print(f'readiness probe not started on port {port}: {exc}', file=sys.stderr)
+        return None
+    threading.Thread(target=server.serve_forever, name='readiness-probe', daemon=True).start()
+    return server
+
+
+_started = False
+_start_lock = threading.Lock()
+
+
+def start(port=READINESS_PORT):
+    """Start the probe server and the warm-up thread (once per process)."""
+    global _started
+    with _start_lock:
+        if _started:
+            return WARMUP
+        _started = True
+    serve_probes(port)
+    threading.Thread(target=run_warmup, name='warmup', daemon=True).start()
+    return WARMUP
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Warm up the app and serve a readiness probe.')
+    parser.add_argument('--serve', action='store_true', help='start the Streamlit app in this process while warming up')
+    parser.add_argument('--port', type=int, default=READINESS_PORT, help='port of the readiness probe')
+    parser.add_argument('streamlit_args', nargs=argparse.REMAINDER, help='arguments passed on to `streamlit run`')
+    args = parser.parse_args()
+
+    if args.serve:
+        # Imported before the warm-up thread starts importing the model's dependencies, so the
+        # two threads don't both import pandas & plotly at once
+        from streamlit.web import cli
+
+        # Run as `python -m`, this file is __main__, a different module from the
+        # transit_cost.warmup the app imports. Warm up that one, so the warmed resources are the
+        # ones the app serves from and the app's own start() finds them already started.
+        from transit_cost import warmup
+
+        warmup.start(args.port)
+        extra = [arg for arg in args.streamlit_args if arg != '--']
+        sys.argv = ['streamlit', 'run', str(APP_PATH), *extra]
+        sys.exit(cli.main())
+
+    state = run_warmup()
+    print(json.dumps(state.as_dict(), indent=2))
+    # Leave the worker's daemon thread to exit with the interpreter
+    sys.exit(0 if state.ready.is_set() else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+### What-if curves for the calculator.
+# Cost versus one input (length, tunnel share or stations) with everything else held at the
+# user's selections. The sliders are discrete, so each curve is a fixed grid of scenarios:
+# the first time a context is seen the whole grid is scored in one batch and the resulting
+# vector is cached; redrawing the curve afterwards is a lookup.
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from transit_cost.features import CAT_FEATS
+from transit_cost.live import batch_predictor
+
+# Grids match the calculator sliders (0.1 km steps, whole stations)
+LENGTH_GRID = np.round(np.arange(0.5, 20.0 + 1e-9, 0.1), 1)
+TUNNEL_SHARE_GRID = np.round(np.linspace(0.0, 1.0, 21), 2)
+STATIONS_GRID = np.arange(0, 26)
+
+AXES = ['length', 'tunnel_share', 'stations']
+
+
+def _shares(inputs):
+    allocated = float(inputs['tunnel']) + float(inputs['at_grade']) + float(inputs['elevated'])
+    if allocated <= 0:
+        # Nothing allocated yet on the sliders; sweep an all at-grade line
+        return {'tunnel': 0.0, 'at_grade': 1.0, 'elevated': 0.0}
+    return {part: float(inputs[part]) / allocated for part in ('tunnel', 'at_grade', 'elevated')}
+
+
+def axis_grid(axis):
+    return {'length': LENGTH_GRID, 'tunnel_share': TUNNEL_SHARE_GRID, 'stations': STATIONS_GRID}[axis]
+
+
+def axis_scenarios(axis, inputs):
+    """Raw scenarios along `axis`, one row per grid point, other inputs as selected."""
+    grid = axis_grid(axis)
+    raw = pd.DataFrame([inputs] * len(grid))
+    if axis == 'length':
+        # Keep the tunnel/at-grade/elevated split of the selection while the line grows
+        shares = _shares(inputs)
+        for part, share in shares.items():
+            raw[part] = grid * share
+        raw['length'] = grid
+    elif axis == 'tunnel_share':
+        length = float(inputs['length'])
+        above = float(inputs['at_grade']) + float(inputs['elevated'])
+        at_grade_share = float(inputs['at_grade']) / above if above > 0 else 1.0
+        raw['tunnel'] = grid * length
+        raw['at_grade'] = (1 - grid) * length * at_grade_share
+        raw['elevated'] = (1 - grid) * length * (1 - at_grade_share)
+    elif axis == 'stations':
+        raw['stations'] = grid
+    return raw
+
+
+def context_key(axis, inputs):
+    """Everything a curve along `axis` depends on except the swept input itself."""
+    key = [axis, tuple(inputs[feat] for feat in CAT_FEATS), inputs['duration']]
+    if axis == 'length':
+        key += [round(share, 4) for share in _shares(inputs).values()]
+        key.append(inputs['stations'])
+    elif axis == 'tunnel_share':
+        above = float(inputs['at_grade']) + float(inputs['elevated'])
+        key += [round(float(inputs['length']), 4),
+                round(float(inputs['at_grade']) / above, 4) if above > 0 else 1.0,
+                inputs['stations']]
+    elif axis == 'stations':
+        key += [round(float(inputs[part]), 4) for part in ('tunnel', 'at_grade', 'elevated')]
+    return tuple(key)
+
+
+class CurveCache:
+    """Bounded LRU of predicted cost vectors keyed by `context_key`.
+
+    `predict_batch` returns (costs, model version), as transit_cost.live.batch_predictor does.
+    """
+
+    def __init__(self, predict_batch, max_entries=256):
+        self._predict_batch = predict_batch
+        self.max_entries = max_entries
+        self._curves = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        with self._lock:
+            self._curves.clear()
+
+    def curves(self, inputs, axes=AXES):
+        """{axis: (grid, costs)} for the selection; missing curves are scored in one batch."""
+        keys = {axis: context_key(axis, inputs) for axis in axes}
+        with self._lock:
+            found = {}
+            for axis, key in keys.items():
+                if key in self._curves:
+                    self._curves.move_to_end(key)
+                    found[axis] = self._curves[key]
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+
+        missing = [axis for axis in axes if axis not in found]
+        if missing:
+            scenarios = [axis_scenarios(axis, inputs) for axis in missing]
+            costs, _ = self._predict_batch(pd.concat(scenarios, ignore_index=True))
+            costs = np.asarray(costs, dtype=float)
+            bounds = np.cumsum([0] + [len(frame) for frame in scenarios])
+            with self._lock:
+                for axis, start, stop in zip(missing, bounds[:-1], bounds[1:]):
+                    found[axis] = costs[start:stop]
+                    self._curves[keys[axis]] = found[axis]
+                while len(self._curves) > self.max_entries:
+                    self._curves.popitem(last=False)
+
+        return {axis: (axis_grid(axis), found[axis]) for axis in axes}
+
+
+def curve_cache_for(model_handle, **kwargs):
+    """CurveCache scoring with `model_handle`'s model, emptied when a new version is promoted."""
+    cache = CurveCache(batch_predictor(model_handle), **kwargs)
+    model_handle.on_swap(lambda old_version, new_version: cache.clear())
+    return cache